@@ -0,0 +1,67 @@
+"""
+Cold start import time of the API/event Lambda per route. Every sample is a fresh interpreter that
+imports handler.py and then the modules the route imports when it runs, which is what a cold
+container pays before the route does any work. "all routes" is what importing the handler cost
+when it loaded every route up front. "webhook ingress" is the separate webhook Lambda
+(webhook_handler.py), which imports only the SQS client.
+
+    python benchmarks/bench_cold_start.py --repeat 7
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PACKAGE = "hubspot_snowflake_export"
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# the imports in handler.py's routes
+ROUTES = {
+    "webhook ingress": [],
+    "webhook": [],
+    "manual sync trigger": [],
+    "deal API": [f"{PACKAGE}.handle_deal", f"{PACKAGE}.utils.hubspot_api", f"{PACKAGE}.utils.snowflake_db"],
+    "events (schedule, single, bulk, back fill)": [f"{PACKAGE}.events"],
+    "MANUAL_SYNC": [f"{PACKAGE}.bulk_events_new"],
+    "MANUAL_SYNC_OLD": [f"{PACKAGE}.bulk_events"],
+    "all routes": [f"{PACKAGE}.events", f"{PACKAGE}.bulk_events_new", f"{PACKAGE}.bulk_events"],
+}
+# entry module of the Lambda serving the route, handler.py unless listed
+ENTRIES = {"webhook ingress": "webhook_handler"}
+
+SAMPLE = """
+import importlib, time
+started = time.perf_counter()
+import {package}.{entry} as handler
+client = {client!r}
+if client:
+    handler.get_client(client)
+for module in {modules!r}:
+    importlib.import_module(module)
+print(time.perf_counter() - started)
+"""
+
+
+def sample(modules, client, entry="handler"):
+    env = {**os.environ, "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1")}
+    output = subprocess.run([sys.executable, "-c", SAMPLE.format(package=PACKAGE, entry=entry, modules=modules,
+                                                                   client=client)],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    clients = {"webhook ingress": "sqs", "webhook": "sqs", "manual sync trigger": "lambda", "all routes": "sqs"}
+    for route, modules in ROUTES.items():
+        samples = [sample(modules, clients.get(route), ENTRIES.get(route, "handler")) for _ in range(args.repeat)]
+        print(f"{route:<44} median {statistics.median(samples) * 1000:7.1f} ms   "
+              f"min {min(samples) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Connections opened per sync: pooled HubspotClient vs one connection per call.
+
+Runs a local HTTP/1.1 stub in place of api.hubapi.com and replays the per-deal call pattern of
+handle_deal (deal, company association, company, owners, pipeline stages, line items).
+
+    python benchmarks/bench_connection_pool.py --deals 200
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    connections = 0
+    requests_served = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubHandler.lock:
+            StubHandler.connections += 1
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        with StubHandler.lock:
+            StubHandler.requests_served += 1
+        body = json.dumps({"id": "1", "properties": {"name": "stub", "domain": "stub.com"}, "results": [],
+                           "email": "stub@stub.com", "firstName": "Stub", "lastName": "Owner",
+                           "userId": 1}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-HubSpot-RateLimit-Max", "1000000")
+        self.send_header("X-HubSpot-RateLimit-Interval-Milliseconds", "10000")
+        self.send_header("X-HubSpot-RateLimit-Remaining", "1000000")
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_sync(hubspot_api, deals):
+    for deal_id in range(deals):
+        hubspot_api.get_deal(str(deal_id))
+        hubspot_api.get_deal_to_company_association(str(deal_id))
+        hubspot_api.get_company_details("1")
+        hubspot_api.call_owner_api("1", False)
+        hubspot_api.get_deal_pipeline_stages("74948272")
+        hubspot_api.get_line_items_by_ids(["1", "2"])
+
+
+def measure(hubspot_api, client, deals):
+    hubspot_api.hubspot_client = client
+    StubHandler.connections = 0
+    StubHandler.requests_served = 0
+    started = time.perf_counter()
+    run_sync(hubspot_api, deals)
+    elapsed = time.perf_counter() - started
+    client.close()
+    return StubHandler.connections, StubHandler.requests_served, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--deals", type=int, default=200)
+    parser.add_argument("--pool-size", type=int, default=10)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["HUBSPOT_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault("HUBSPOT_API_KEY", "stub")
+
+    from hubspot_snowflake_export.utils import hubspot_api
+
+    for label, client in (("per-call connections", hubspot_api.HubspotClient(keep_alive=False)),
+                          ("pooled keep-alive", hubspot_api.HubspotClient(pool_size=args.pool_size))):
+        connections, served, elapsed = measure(hubspot_api, client, args.deals)
+        print(f"{label:<22} requests={served:<6} connections={connections:<6} "
+              f"elapsed={elapsed:.2f}s ({served / elapsed:.0f} req/s)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Transform of HubSpot deals into DEALS_TEMP values: the former per-deal build_deal_row vs build_deal_columns, and
+writing the load file from the columns as gzip CSV vs Parquet (when pyarrow is installed). Purely local,
+the deals, owners and companies are synthetic.
+
+    python benchmarks/bench_deal_transform.py --deals 5000 50000
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def make_deals(count):
+    """:return: deals, deal id -> company, owner id -> owner summary and pipeline stages, as fetch_deal_enrichments returns them"""
+    random.seed(count)
+    owner_details = {str(i): {"id": str(i), "name": f"Owner {i}", "email": f"owner{i}@stub.com", "archived": False}
+                     for i in range(60)}
+    companies = [{"id": str(i), "name": f"Company {i}", "domain": f"company{i}.com"} for i in range(300)]
+    deals = []
+    deals_with_companies = {}
+    for i in range(count):
+        deal_id = str(10_000_000 + i)
+        deals.append({"id": deal_id, "properties": {
+            "dealname": f"Deal {i}", "hubspot_owner_id": str(random.randrange(70)),
+            "delivery_lead": random.choice(["", None, str(random.randrange(60))]), "solution_lead": str(random.randrange(60)),
+            "hs_all_collaborator_owner_ids": random.choice(["", None, "1;2;3", "4;5"]), "pipeline": "74948272",
+            "dealstage": random.choice(["closedwon", "appointmentscheduled"]), "work_ahead": random.choice(["No", "blank", "Yes"]),
+            "expected_project_start_date": random.choice(["", "2025-01-01T00:00:00Z"]), "closedate": None,
+            "engagement_type__cloned_": "Project", "expected_project_duration_in_months": random.choice(["", "6"]),
+            "hs_createdate": "2024-05-01T00:00:00Z", "hs_lastmodifieddate": "2025-05-01T00:00:00Z",
+            "ns_project_id__finance_only_": None, "amount": random.choice(["", "12500.50"]), "dealtype": "newbusiness",
+            "revenue_type": "Services", "deal_currency_code": random.choice([None, "USD", "EUR"]),
+            "n2026_book": random.choice([None, "Adams_Portfolio"]), "offering": "Data",
+            "description": "multi-line\ndescription with C:\\path", "tech_involved": "Snowflake"}})
+        if i % 10:
+            deals_with_companies[deal_id] = random.choice(companies)
+    pipeline_stages = {"74948272": {"closedwon": "Closed Won", "appointmentscheduled": "Appointment Scheduled"}}
+    return deals, deals_with_companies, owner_details, pipeline_stages
+
+
+def build_deal_row(deal, deals_with_companies, owner_details, pipeline_stages):
+    """
+    One deal as a DEALS_TEMP row dict, the per-deal loop build_deal_columns replaced, kept here as
+    the baseline and to check build_deal_columns builds the same values.
+    """
+    from hubspot_snowflake_export.bulk_events import get_2026_book_lead_email
+    from hubspot_snowflake_export.utils.jsonlib import dumps_column
+    from hubspot_snowflake_export.utils.row_hash import row_hash, properties_hash
+
+    deal_id = deal['id']
+    deal_properties = deal['properties']
+    stage_name = pipeline_stages.get(deal_properties["pipeline"], {}).get(deal_properties['dealstage'])
+
+    curr_time = datetime.now(pytz.timezone('America/New_York'))
+
+    if deal_properties['work_ahead'] in ['No', 'blank']:
+        work_ahead = 'No'
+    else:
+        work_ahead = deal_properties['work_ahead']
+    deal_owner_details = owner_details.get(deal_properties['hubspot_owner_id'], {})
+    delivery_lead_details = owner_details.get(deal_properties['delivery_lead'], {})
+    solution_lead_details = owner_details.get(deal_properties['solution_lead'], {})
+    company_details = deals_with_companies.get(deal_id, {})
+    deal_collaborators_str = deal_properties['hs_all_collaborator_owner_ids']
+    deal_collaborators = []
+    if deal_collaborators_str:
+        deal_collaborators = [owner_details.get(collaborator_id)
+                              for collaborator_id in
+                              deal_collaborators_str.split(";")]
+
+    deal_data_raw = {
+        "DEAL_ID": deal_id,
+        "DEAL_NAME": deal_properties['dealname'],
+        "DEAL_OWNER": dumps_column(deal_owner_details),
+        "DEAL_OWNER_ID": deal_properties['hubspot_owner_id'],
+        "DEAL_OWNER_EMAIL": deal_owner_details.get('email'),
+        "DEAL_OWNER_NAME": deal_owner_details.get('name'),
+        "DELIVERY_LEAD_ID": deal_properties['delivery_lead'],
+        "DELIVERY_LEAD_EMAIL": delivery_lead_details.get('email'),
+        "DELIVERY_LEAD_NAME": delivery_lead_details.get('name'),
+        "SOLUTION_LEAD_ID": deal_properties['solution_lead'],
+        "SOLUTION_LEAD_EMAIL": solution_lead_details.get('email'),
+        "SOLUTION_LEAD_NAME": solution_lead_details.get('name'),
+        "DEAL_STAGE_ID": deal_properties['dealstage'],
+        "DEAL_STAGE_NAME": stage_name,
+        "COMPANY_ID": company_details.get('id'),
+        "COMPANY_NAME": company_details.get('name', None),
+        "DEAL_TO_COMPANY_ASSOCIATIONS": dumps_column(company_details),
+        "PIPELINE_ID": deal_properties['pipeline'],
+        "PROJECT_START_DATE": deal_properties['expected_project_start_date'],
+        "PROJECT_CLOSE_DATE": deal_properties['closedate'],
+        "ENGAGEMENT_TYPE": deal_properties['engagement_type__cloned_'],
+        "DURATION_IN_MONTHS": deal_properties['expected_project_duration_in_months'],
+        "DEAL_COLLABORATORS": dumps_column(deal_collaborators),
+        "DEAL_CREATED_ON": deal_properties['hs_createdate'],
+        "DEAL_UPDATED_ON": deal_properties['hs_lastmodifieddate'],
+        "IS_ARCHIVED": False,
+        "COMPANY_DOMAIN": company_details.get('domain'),
+        "NS_PROJECT_ID": deal_properties['ns_project_id__finance_only_'],
+        "DEAL_AMOUNT_IN_COMPANY_CURRENCY": deal_properties['amount'],
+        "DEAL_TYPE": deal_properties['dealtype'],
+        "SPECIAL_FIELDS_UPDATED_ON": datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "WORK_AHEAD": work_ahead,
+        "LAST_REFRESHED_ON": curr_time,
+        "REVENUE_TYPE": deal_properties['revenue_type'],
+        "CURRENCY": deal_properties.get('deal_currency_code') or 'USD',
+        "BOOK_LEADS_2026": deal_properties.get('n2026_book'),
+        "BOOK_2026_EMAIL": get_2026_book_lead_email(deal_properties.get('n2026_book')),
+        "OFFERING": deal_properties.get('offering'),
+        "DESCRIPTION": deal_properties.get('description'),
+        "TECH_INVOLVED": deal_properties.get('tech_involved')
+    }
+
+    timestamp_fields = [
+        'PROJECT_START_DATE', 'PROJECT_CLOSE_DATE', 'DEAL_CREATED_ON',
+        'DEAL_UPDATED_ON', 'SPECIAL_FIELDS_UPDATED_ON', 'LAST_REFRESHED_ON'
+    ]
+    for field in timestamp_fields:
+        if deal_data_raw.get(field) is not None and str(deal_data_raw.get(field)).strip() == '':
+            print(f"Field {field} is missing for Deal: {deal_id}, value is {deal_data_raw.get(field)}")
+            deal_data_raw[field] = None
+
+    # number_fields = ['COMPANY_ID', 'DURATION_IN_MONTHS', 'DEAL_AMOUNT_IN_COMPANY_CURRENCY']
+    number_fields = [
+        "DURATION_IN_MONTHS",
+        "DEAL_AMOUNT_IN_COMPANY_CURRENCY",
+        "DEAL_OWNER_ID",
+        "COMPANY_ID",
+        "PIPELINE_ID",
+        "NS_PROJECT_ID",
+        "DELIVERY_LEAD_ID",
+        "SOLUTION_LEAD_ID"
+        # Add more if you know they are numeric
+    ]
+    for field in number_fields:
+        if deal_data_raw.get(field) is not None and str(deal_data_raw.get(field)).strip() == '':
+            print(f"Field {field} is missing for Deal: {deal_id}, value is {deal_data_raw.get(field)}")
+            deal_data_raw[field] = None
+
+    deal_data_raw["ROW_HASH"] = row_hash(deal_data_raw)
+    deal_data_raw["PROPERTIES_HASH"] = properties_hash(deal_properties)
+    return deal_data_raw
+
+
+def timed(run):
+    # the row path prints one line per blank field, keep it out of the terminal but in the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        result = run()
+        return time.perf_counter() - started, result
+
+
+def bench_transform(deals, deals_with_companies, owner_details, pipeline_stages):
+    from hubspot_snowflake_export.bulk_events import DEALS_TEMP_KEYS
+    from hubspot_snowflake_export.bulk_events_new import build_deal_columns
+    from hubspot_snowflake_export.utils.sql import row_values, column_rows
+
+    row_elapsed, rows = timed(lambda: [build_deal_row(deal, deals_with_companies, owner_details, pipeline_stages)
+                                       for deal in deals])
+    column_elapsed, columns = timed(lambda: build_deal_columns(deals, deals_with_companies, owner_details,
+                                                               pipeline_stages))
+    assert row_values(rows, DEALS_TEMP_KEYS) == column_rows(columns, DEALS_TEMP_KEYS)
+    print(f"transform  deals={len(deals):<7} rows {row_elapsed:.2f}s   columns {column_elapsed:.2f}s   "
+          f"({row_elapsed / column_elapsed:.1f}x)")
+    return columns
+
+
+def bench_file(columns):
+    from hubspot_snowflake_export.bulk_events import DEALS_TEMP_COLUMNS
+    from hubspot_snowflake_export.utils import snowflake_loader
+
+    writers = [("csv.gz", lambda path: snowflake_loader.write_csv_rows(
+        path, zip(*(columns[key] for _, key in DEALS_TEMP_COLUMNS))))]
+    if snowflake_loader.pyarrow is not None:
+        writers.append(("parquet", lambda path: snowflake_loader.write_parquet(path, DEALS_TEMP_COLUMNS, columns)))
+    else:
+        print("pyarrow is not installed, skipping the Parquet write")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, write in writers:
+            path = os.path.join(tmp_dir, f"deals.{label}")
+            elapsed, _ = timed(lambda: write(path))
+            print(f"{label:<10} deals={len(columns['DEAL_ID']):<7} {elapsed:.2f}s ({os.path.getsize(path) / 1024:.0f} KiB)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--deals", type=int, nargs="+", default=[5000, 50000])
+    args = parser.parse_args()
+
+    for count in args.deals:
+        columns = bench_transform(*make_deals(count))
+        bench_file(columns)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Line item diffing for deals with many line items: the linear scans of check_line_items_updation and
+get_deleted_line_item_ids as they were (one scan of the stored line items per updated line item)
+vs diff_line_items (one dict lookup per line item). Purely local, no HubSpot or Snowflake access.
+
+    python benchmarks/bench_line_item_diff.py --line-items 100 500 2000
+    python benchmarks/bench_line_item_diff.py --line-items 1000 --changed 0.1 --repeat 20
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hubspot_snowflake_export.handle_deal import diff_line_items, to_float  # noqa: E402
+
+
+def make_line_items(count, changed, deal_id="1001"):
+    """
+    :return: stored rows (EXISTING_LINE_ITEM_COLUMNS) and rows to write (LINE_ITEM_COLUMNS) for one deal,
+        with the share `changed` of line items updated, plus one line item added and one removed
+    """
+    random.seed(count)
+    existing = [(str(i), f"Line item {i}", Decimal(f"{i}.50"), Decimal("2"), Decimal(f"{2 * i + 1}.00"),
+                 datetime(2025, 5, 1), deal_id, "USD") for i in range(count)]
+    rows = []
+    for i in range(1, count + 1):
+        amount = f"{2 * i + 1}" if random.random() >= changed else f"{2 * i + 3}"
+        rows.append((str(i), f"Line item {i}", f"{i}.5", "2", amount, "2025-01-01T00:00:00Z", "2025-05-01T00:00:00Z",
+                     deal_id, "USD"))
+    return existing, rows
+
+
+def linear_diff(existing_line_items, line_item_rows):
+    """The scan check_line_items_updation did for every line item, plus the old list based delete set."""
+    inserts, updates = [], []
+    for row in line_item_rows:
+        existing = next((d for d in existing_line_items if str(d[0]) == row[0]), None)
+        if existing is None:
+            inserts.append(row)
+        elif existing[1] != row[1] or to_float(str(existing[4])) != to_float(str(row[4])):
+            updates.append(row)
+    existing_line_item_ids = [str(item[0]) for item in existing_line_items]
+    deletes = [item_id for item_id in existing_line_item_ids if item_id not in [row[0] for row in line_item_rows]]
+    return inserts, updates, deletes
+
+
+def timed(run, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = run()
+    return (time.perf_counter() - started) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--line-items", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--changed", type=float, default=0.05, help="share of line items with a new amount")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for count in args.line_items:
+        existing, rows = make_line_items(count, args.changed)
+        linear_elapsed, (linear_inserts, linear_updates, linear_deletes) = timed(
+            lambda: linear_diff(existing, rows), args.repeat)
+        indexed_elapsed, (inserts, updates, deletes) = timed(lambda: diff_line_items(existing, rows), args.repeat)
+        assert (len(inserts), len(updates), set(deletes)) == (len(linear_inserts), len(linear_updates), set(linear_deletes))
+        print(f"line items={count:<6} linear {linear_elapsed * 1000:9.2f} ms   indexed {indexed_elapsed * 1000:7.2f} ms   "
+              f"({len(inserts)} new, {len(updates)} changed, {len(deletes)} deleted, "
+              f"{len(rows) - len(inserts) - len(updates)} not written)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Rows/sec loading DEALS_TEMP: executemany (batched INSERTs) vs gzip CSV + PUT + COPY INTO.
+
+Needs the Snowflake credentials used by the Lambda (SF_ACCOUNT, SF_USER, SF_PASSWORD, SF_WAREHOUSE,
+SF_DATABASE, SF_SCHEMA, SF_ROLE) and an existing HUBSPOT_DEALS table to clone the temp table from.
+Nothing is written outside the session's temporary table and stage.
+
+    python benchmarks/bench_snowflake_load.py --rows 1000 5000 20000
+    python benchmarks/bench_snowflake_load.py --rows 50000 --local-only   # only time the file write
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def make_rows(count):
+    return [{
+        "DEAL_ID": str(10_000_000 + i),
+        "DEAL_NAME": f"Deal {i} \"quoted\", with comma",
+        "DEAL_OWNER": '{"id": "1", "name": "Stub Owner", "email": "owner@stub.com"}',
+        "DEAL_OWNER_ID": str(i % 50),
+        "DEAL_OWNER_EMAIL": "owner@stub.com",
+        "DEAL_OWNER_NAME": "Stub Owner",
+        "DEAL_STAGE_ID": "closedwon",
+        "DEAL_STAGE_NAME": "Closed Won",
+        "COMPANY_ID": str(i % 300),
+        "COMPANY_NAME": "Stub Company",
+        "DEAL_TO_COMPANY_ASSOCIATIONS": '{"id": "1", "name": "Stub Company", "domain": "stub.com"}',
+        "PIPELINE_ID": "74948272",
+        "PROJECT_START_DATE": "2025-01-01T00:00:00Z",
+        "PROJECT_CLOSE_DATE": None,
+        "ENGAGEMENT_TYPE": "Project",
+        "DURATION_IN_MONTHS": "6",
+        "DEAL_COLLABORATORS": "[]",
+        "DEAL_CREATED_ON": "2024-05-01T00:00:00Z",
+        "DEAL_UPDATED_ON": "2025-05-01T00:00:00Z",
+        "IS_ARCHIVED": False,
+        "COMPANY_DOMAIN": "stub.com",
+        "NS_PROJECT_ID": None,
+        "DEAL_AMOUNT_IN_COMPANY_CURRENCY": "12500.50",
+        "DEAL_TYPE": "newbusiness",
+        "WORK_AHEAD": "No",
+        "DELIVERY_LEAD_ID": None,
+        "DELIVERY_LEAD_EMAIL": None,
+        "DELIVERY_LEAD_NAME": None,
+        "SOLUTION_LEAD_ID": "7",
+        "SOLUTION_LEAD_EMAIL": "lead@stub.com",
+        "SOLUTION_LEAD_NAME": "Stub Lead",
+        "REVENUE_TYPE": "Services",
+        "CURRENCY": "USD",
+        "BOOK_LEADS_2026": None,
+        "BOOK_2026_EMAIL": None,
+        "OFFERING": "Data",
+        "DESCRIPTION": "multi-line\ndescription with C:\\path",
+        "TECH_INVOLVED": "Snowflake",
+    } for i in range(count)]
+
+
+def bench_local(rows):
+    from hubspot_snowflake_export.bulk_events import DEALS_TEMP_COLUMNS
+    from hubspot_snowflake_export.utils.snowflake_loader import write_csv_gz
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "deals.csv.gz")
+        started = time.perf_counter()
+        write_csv_gz(path, DEALS_TEMP_COLUMNS, rows)
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(path)
+    print(f"csv.gz write   rows={len(rows):<7} {elapsed:.2f}s ({len(rows) / elapsed:.0f} rows/s, {size / 1024:.0f} KiB)")
+
+
+def bench_snowflake(rows):
+    from hubspot_snowflake_export.bulk_events import DEALS_TEMP_COLUMNS, DEALS_TEMP_KEYS, DEALS_TEMP_EXPRESSIONS
+    from hubspot_snowflake_export.utils.config import SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE, SF_DEALS_TABLE
+    from hubspot_snowflake_export.utils.snowflake_db import create_sf_connection, close_sf_connection
+    from hubspot_snowflake_export.utils.snowflake_loader import copy_rows_into
+    from hubspot_snowflake_export.utils.sql import insert_statement, row_values
+
+    insert_sql = insert_statement("DEALS_TEMP", DEALS_TEMP_KEYS, DEALS_TEMP_EXPRESSIONS)
+    insert_rows = row_values(rows, DEALS_TEMP_KEYS)
+
+    sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    try:
+        sf_cursor = sf_conn.cursor()
+        for label, load in (("executemany", lambda: sf_cursor.executemany(insert_sql, insert_rows)),
+                            ("PUT + COPY", lambda: copy_rows_into(sf_cursor, "DEALS_TEMP", DEALS_TEMP_COLUMNS, rows,
+                                                                  DEALS_TEMP_EXPRESSIONS))):
+            sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE DEALS_TEMP LIKE {SF_DEALS_TABLE}")
+            started = time.perf_counter()
+            load()
+            elapsed = time.perf_counter() - started
+            loaded = sf_cursor.execute("SELECT COUNT(*) FROM DEALS_TEMP").fetchone()[0]
+            print(f"{label:<14} rows={loaded:<7} {elapsed:.2f}s ({loaded / elapsed:.0f} rows/s)")
+    finally:
+        sf_conn.rollback()
+        close_sf_connection(sf_conn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--local-only", action="store_true")
+    args = parser.parse_args()
+
+    for count in args.rows:
+        rows = make_rows(count)
+        bench_local(rows)
+        if not args.local_only:
+            bench_snowflake(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Per-statement compile time of the deal MERGE: values inlined into the SQL text (the old f-string
+statements) vs one cached statement text with bind parameters.
+
+Locally, times building the SQL text for each deal. Against Snowflake, runs both variants into a
+temporary clone of HUBSPOT_DEALS, each under its own QUERY_TAG, and reads COMPILATION_TIME from
+INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION. Needs the Snowflake credentials used by the Lambda
+(SF_ACCOUNT, SF_USER, SF_PASSWORD, SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE).
+
+    python benchmarks/bench_sql_binding.py --deals 200
+    python benchmarks/bench_sql_binding.py --deals 2000 --local-only
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_snowflake_load import make_rows  # noqa: E402
+
+BENCH_TABLE = "DEALS_BIND_BENCH"
+
+
+def to_sql_literal(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+
+def literal_merge(table, columns, row):
+    """The deal MERGE the way handle_deal used to build it, with every value inlined."""
+    return f"""
+        MERGE INTO {table} AS target
+        USING (SELECT {", ".join(f"{to_sql_literal(value)} AS {column}" for column, value in zip(columns, row))}) AS source
+        ON target.DEAL_ID = source.DEAL_ID
+        WHEN MATCHED THEN
+            UPDATE SET {", ".join(f"target.{column} = source.{column}" for column in columns if column != "DEAL_ID")}
+        WHEN NOT MATCHED THEN
+            INSERT ({", ".join(columns)})
+            VALUES ({", ".join(f"source.{column}" for column in columns)})
+    """
+
+
+def make_deal_rows(count):
+    from hubspot_snowflake_export.handle_deal import DEAL_COLUMNS
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return [tuple(row.get(column, now) for column in DEAL_COLUMNS) for row in make_rows(count)]
+
+
+def bench_local(rows):
+    from hubspot_snowflake_export.handle_deal import DEAL_COLUMNS
+    from hubspot_snowflake_export.utils.sql import merge_statement, statement_cache_info
+
+    started = time.perf_counter()
+    for row in rows:
+        literal_merge("DEALS", DEAL_COLUMNS, row)
+    literal_elapsed = time.perf_counter() - started
+
+    merge_statement.cache_clear()
+    started = time.perf_counter()
+    for _ in rows:
+        merge_statement("DEALS", DEAL_COLUMNS, ("DEAL_ID",))
+    bound_elapsed = time.perf_counter() - started
+
+    print(f"build literal  deals={len(rows):<6} {literal_elapsed * 1e6 / len(rows):.1f} us/statement")
+    print(f"build bound    deals={len(rows):<6} {bound_elapsed * 1e6 / len(rows):.1f} us/statement "
+          f"({statement_cache_info()['merge']})")
+
+
+def bench_snowflake(rows):
+    from hubspot_snowflake_export.handle_deal import DEAL_COLUMNS
+    from hubspot_snowflake_export.utils.config import SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE, SF_DEALS_TABLE
+    from hubspot_snowflake_export.utils.snowflake_db import create_sf_connection, close_sf_connection
+    from hubspot_snowflake_export.utils.sql import merge_statement
+
+    sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    try:
+        sf_cursor = sf_conn.cursor()
+        sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE {BENCH_TABLE} LIKE {SF_DEALS_TABLE}")
+        variants = (
+            ("literal", lambda row: sf_cursor.execute(literal_merge(BENCH_TABLE, DEAL_COLUMNS, row))),
+            ("bound", lambda row: sf_cursor.execute(merge_statement(BENCH_TABLE, DEAL_COLUMNS, ("DEAL_ID",)), row)),
+        )
+        for label, run in variants:
+            sf_cursor.execute(f"TRUNCATE TABLE {BENCH_TABLE}")
+            sf_cursor.execute(f"ALTER SESSION SET QUERY_TAG = 'bench_sql_binding_{label}'")
+            started = time.perf_counter()
+            for row in rows:
+                run(row)
+            elapsed = time.perf_counter() - started
+            print(f"execute {label:<7} deals={len(rows):<6} {elapsed * 1000 / len(rows):.1f} ms/statement wall")
+        sf_cursor.execute("ALTER SESSION UNSET QUERY_TAG")
+
+        sf_cursor.execute("""
+            SELECT QUERY_TAG, COUNT(*), AVG(COMPILATION_TIME), AVG(EXECUTION_TIME)
+            FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 10000))
+            WHERE QUERY_TAG LIKE 'bench_sql_binding_%' AND QUERY_TYPE = 'MERGE'
+            GROUP BY QUERY_TAG
+            ORDER BY QUERY_TAG
+        """)
+        for query_tag, count, compilation_ms, execution_ms in sf_cursor.fetchall():
+            print(f"{query_tag:<26} statements={count:<6} compile {compilation_ms:.1f} ms, execute {execution_ms:.1f} ms")
+    finally:
+        sf_conn.rollback()
+        close_sf_connection(sf_conn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--deals", type=int, default=200)
+    parser.add_argument("--local-only", action="store_true")
+    args = parser.parse_args()
+
+    rows = make_deal_rows(args.deals)
+    bench_local(rows)
+    if not args.local_only:
+        bench_snowflake(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import traceback
+from datetime import datetime, timezone
+
+from .handle_deal import parse_owner_details, create_deal_update_request, build_deal_data, to_number, \
+    select_existing_line_items, write_line_item_diff, COMPANY_COLUMNS, OWNER_COLUMNS, COLLABORATOR_COLUMNS, DEAL_COLUMNS
+from .utils.concurrency import run_task_graph, chunks
+from .utils.config import SF_COMPANIES_TABLE, SF_DEAL_OWNERS_TABLE, SF_DEAL_COLLABORATORS_TABLE, SF_DEALS_TABLE, \
+    BATCH_UPSERT_SIZE
+from .utils.hubspot_api import get_company_associations_of_deals, \
+    get_stage_label, get_pipeline_stages, get_associated_line_items_of_deals, get_line_items_by_ids_batch
+from .utils.company_cache import company_cache
+from .utils.owner_directory import owner_directory
+from .utils.row_hash import filter_changed_deals, ROW_CHANGED_CONDITION
+from .utils.sql import merge_statement
+
+
+def merge_rows(sf_cursor, table, columns, key_columns, rows, update_when=None):
+    """
+    Upsert rows with a single MERGE whose source is one multi-row VALUES list of bind parameters.
+    :param rows: list of tuples in the order of columns, at most one per key
+    :param update_when: condition a matched row has to meet to be updated
+    """
+    if not rows:
+        return
+    sf_cursor.execute(merge_statement(table, columns, key_columns, len(rows), update_when=update_when),
+                      [value for row in rows for value in row])
+    print(f"Upserted {len(rows)} rows into {table}")
+
+
+def get_owner_ids(deal_properties):
+    owner_ids = {deal_properties['hubspot_owner_id'], deal_properties['delivery_lead'], deal_properties['solution_lead']}
+    if deal_properties['hs_all_collaborator_owner_ids']:
+        owner_ids.update(deal_properties['hs_all_collaborator_owner_ids'].split(';'))
+    return {owner_id for owner_id in owner_ids if owner_id}
+
+
+def associated_company_ids(company_associations):
+    """:return: deal id -> id of its first associated company, the one its row is written with"""
+    return {deal_id: str(associations[0]['toObjectId']) if associations else None
+            for deal_id, associations in company_associations.items()}
+
+
+def fetch_batch_enrichments(deals, sf_cursor, force=False):
+    """
+    Companies, owners, pipeline stages and line items of a batch of deals, with batch reads
+    and one lookup per distinct owner instead of one set of calls per deal. Companies and owners
+    are only looked up for the deals whose row changed, line items for every deal.
+    """
+    deal_ids = [deal['id'] for deal in deals]
+
+    def get_changed_deals(company_associations):
+        company_ids = associated_company_ids(company_associations)
+        return filter_changed_deals(sf_cursor, deals, force,
+                                    {deal_id: company_ids.get(deal_id) for deal_id in deal_ids})
+
+    def get_companies(company_associations, changed_deals):
+        company_ids = associated_company_ids(company_associations)
+        company_ids = list({company_ids[deal['id']] for deal in changed_deals if company_ids.get(deal['id'])})
+        # HubSpot's name as it is, like handle_company_details, the deal's COMPANY_NAME falls back to the domain
+        return {company_id: {"id": company_id, "name": company['properties'].get('name', "") or "",
+                             "domain": company['properties'].get('domain', "")}
+                for company_id, company in company_cache.get_companies(company_ids).items() if company['properties']}
+
+    def get_owners(changed_deals):
+        owner_ids = list(set().union(*(get_owner_ids(deal['properties']) for deal in changed_deals)))
+        return {owner_id: parse_owner_details(owner) for owner_id, owner in owner_directory.get_owners(owner_ids).items()}
+
+    def get_line_items(line_item_associations):
+        line_item_ids = list({line_item_id for line_item_ids in line_item_associations.values()
+                              for line_item_id in line_item_ids})
+        return get_line_items_by_ids_batch(line_item_ids)
+
+    return run_task_graph({
+        "company_associations": (lambda: get_company_associations_of_deals(deal_ids), []),
+        "changed_deals": (get_changed_deals, ["company_associations"]),
+        "companies": (get_companies, ["company_associations", "changed_deals"]),
+        "owners": (get_owners, ["changed_deals"]),
+        # warms the stage cache alongside the other lookups, get_stage_label reads it per deal
+        "pipeline_stages": (get_pipeline_stages, []),
+        "line_item_associations": (lambda: get_associated_line_items_of_deals(deal_ids), []),
+        "line_items": (get_line_items, ["line_item_associations"]),
+    })
+
+
+def upsert_deals_batch(deals, sf_cursor, force=False):
+    """
+    Upsert a batch of deals (search, batch read or get_deal results) with one statement per
+    target table: companies, owners, collaborators, deals, then the line item diff.
+    Produces the same rows as handle_deal for each deal. The rows of deals whose exported properties
+    and company are unchanged are skipped before enrichment unless force is set, the line items of
+    every deal are diffed.
+    """
+    if not deals:
+        return
+    enrichments = fetch_batch_enrichments(deals, sf_cursor, force)
+    owners = enrichments["owners"]
+    curr_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    companies = {}
+    owners_to_upsert = {}
+    collaborator_rows = {}
+    deal_rows = {}
+    for deal in enrichments["changed_deals"]:
+        deal_id = deal['id']
+        deal_properties = {**deal['properties'], 'updatedAt': deal['updatedAt']}
+
+        company_associations = enrichments["company_associations"].get(deal_id)
+        company_details = None
+        if company_associations:
+            company_details = enrichments["companies"].get(str(company_associations[0]['toObjectId']))
+            if company_details:
+                companies[company_details['id']] = company_details
+            else:
+                company_associations = None
+
+        owner_details = owners.get(deal_properties['hubspot_owner_id']) if deal_properties['hubspot_owner_id'] else None
+        if owner_details:
+            owners_to_upsert[owner_details['id']] = owner_details
+        collaborators_details = []
+        if deal_properties['hs_all_collaborator_owner_ids']:
+            collaborators_details = [owners[collaborator_id]
+                                     for collaborator_id in deal_properties['hs_all_collaborator_owner_ids'].split(";")
+                                     if collaborator_id in owners]
+        for collaborator in collaborators_details:
+            owners_to_upsert[collaborator['id']] = collaborator
+            collaborator_rows[(deal_id, collaborator['id'])] = (deal_id, curr_time, collaborator['id'])
+
+        stage_name = get_stage_label(deal_properties['pipeline'], deal_properties['dealstage'])
+        deals_request = create_deal_update_request(owner_details, collaborators_details, company_associations)
+        deal_data = build_deal_data(deal_id, deals_request, deal_properties, owner_details, company_details,
+                                    stage_name, owners.get(deal_properties['delivery_lead'], {}),
+                                    owners.get(deal_properties['solution_lead'], {}))
+        deal_rows[deal_id] = tuple(None if deal_data[column] == '' else deal_data[column] for column in DEAL_COLUMNS)
+
+    company_rows = company_cache.rows_to_write(
+        [(company['id'], company['name'] or "", company['domain'] or "") for company in companies.values()])
+    merge_rows(sf_cursor, SF_COMPANIES_TABLE, COMPANY_COLUMNS, ("COMPANY_ID",), company_rows)
+    company_cache.mark_written(company_rows)
+    merge_rows(sf_cursor, SF_DEAL_OWNERS_TABLE, OWNER_COLUMNS, ("OWNER_ID",),
+               [(owner['id'], owner['name'], owner['email'], owner['is_archived'])
+                for owner in owners_to_upsert.values()])
+    merge_rows(sf_cursor, SF_DEAL_COLLABORATORS_TABLE, COLLABORATOR_COLUMNS, ("DEAL_ID", "OWNER_ID"),
+               list(collaborator_rows.values()))
+    merge_rows(sf_cursor, SF_DEALS_TABLE, DEAL_COLUMNS, ("DEAL_ID",), list(deal_rows.values()), ROW_CHANGED_CONDITION)
+    upsert_line_items_batch(sf_cursor, [deal['id'] for deal in deals], enrichments["line_item_associations"],
+                            enrichments["line_items"])
+    print(f"Upserted {len(deal_rows)} Deals")
+
+
+def upsert_line_items_batch(sf_cursor, deal_ids, line_item_associations, line_items):
+    """
+    Replace the line items of deal_ids with one SELECT, one DELETE and one MERGE of the changed line items.
+    Like handle_line_items, a failure here is logged and does not fail the deals.
+    """
+    try:
+        existing_line_items = select_existing_line_items(sf_cursor, deal_ids)
+        line_item_rows = []
+        line_item_ids = []
+        for deal_id in deal_ids:
+            for line_item_id in line_item_associations.get(deal_id, []):
+                line_item_ids.append(line_item_id)
+                line_item = line_items.get(line_item_id)
+                if line_item:
+                    line_item_rows.append((line_item['id'], line_item['name'], to_number(line_item['price']),
+                                           to_number(line_item['quantity']), to_number(line_item['amount']),
+                                           line_item['created_at'], line_item['updated_at'], deal_id,
+                                           line_item['currency'] or 'USD'))
+        write_line_item_diff(sf_cursor, existing_line_items, line_item_rows, line_item_ids)
+    except Exception:
+        traceback.print_exc()
+        print(f"Failed to upsert line items for the deals - {deal_ids}")
+
+
+def upsert_deals_in_batches(deals, sf_cursor, batch_size=BATCH_UPSERT_SIZE, force=False):
+    for deals_batch in chunks(deals, batch_size):
+        upsert_deals_batch(deals_batch, sf_cursor, force)
@@ -1,4 +1,3 @@
-import json
 import traceback
 from datetime import datetime, timezone, timedelta
 
@@ -6,9 +5,27 @@ import pytz
 
 from .utils.config import SF_DEALS_TABLE, SF_LINE_ITEMS_TABLE, SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, \
     SF_ROLE
-from .utils.hubspot_api import fetch_updated_or_created_deals, get_all_companies, get_all_stages, get_all_owners, \
+from .utils.hubspot_api import fetch_updated_or_created_deals, get_all_companies, get_pipeline_stages, \
     get_all_line_items
-from .utils.snowflake_db import close_sf_connection, create_sf_connection
+from .utils.jsonlib import dumps_once
+from .utils.owner_directory import owner_directory
+from .utils.row_hash import row_hash, properties_hash, filter_changed_deals, ROW_CHANGED_CONDITION
+from .utils.snowflake_db import release_sf_connection, get_sf_connection
+from .utils.sql import insert_statement, row_values
+
+DEALS_TEMP_COLUMNS = [(column, column) for column in [
+    "DEAL_ID", "DEAL_NAME", "DEAL_OWNER", "DEAL_OWNER_ID", "DEAL_OWNER_EMAIL", "DEAL_OWNER_NAME", "DEAL_STAGE_ID",
+    "DEAL_STAGE_NAME", "COMPANY_ID", "COMPANY_NAME", "DEAL_TO_COMPANY_ASSOCIATIONS", "PIPELINE_ID",
+    "PROJECT_START_DATE", "PROJECT_CLOSE_DATE", "ENGAGEMENT_TYPE", "DURATION_IN_MONTHS", "DEAL_COLLABORATORS",
+    "DEAL_CREATED_ON", "DEAL_UPDATED_ON", "IS_ARCHIVED", "COMPANY_DOMAIN", "NS_PROJECT_ID",
+    "DEAL_AMOUNT_IN_COMPANY_CURRENCY", "DEAL_TYPE", "WORK_AHEAD", "DELIVERY_LEAD_ID", "DELIVERY_LEAD_EMAIL",
+    "DELIVERY_LEAD_NAME", "SOLUTION_LEAD_ID", "SOLUTION_LEAD_EMAIL", "SOLUTION_LEAD_NAME", "REVENUE_TYPE", "CURRENCY",
+    "BOOK_LEADS_2026", "BOOK_2026_EMAIL", "OFFERING", "DESCRIPTION", "TECH_INVOLVED", "ROW_HASH", "PROPERTIES_HASH"]]
+DEALS_TEMP_KEYS = tuple(column for column, _ in DEALS_TEMP_COLUMNS)
+DEALS_TEMP_EXPRESSIONS = (("SPECIAL_FIELDS_UPDATED_ON", "CURRENT_TIMESTAMP()"), ("LAST_REFRESHED_ON", "CURRENT_TIMESTAMP()"))
+LINE_ITEMS_TEMP_COLUMNS = [("LINE_ITEM_ID", "id"), ("NAME", "name"), ("PRICE", "price"), ("QUANTITY", "quantity"),
+                           ("AMOUNT", "amount"), ("CREATED_ON", "created_at"), ("UPDATED_ON", "updated_at"),
+                           ("DEAL_ID", "deal_id")]
 
 
 def get_2026_book_lead_email(book_lead_name):
@@ -51,9 +68,20 @@ def sync_deals(event):
     print(f"Deals Updated/Created Since: {formatted_datetime} - {len(updated_deals_since)}")
     deals_with_companies = get_all_companies()
     print("done company details")
-    pipeline_stages = get_all_stages()
+    # only the rows of deals whose exported properties or company changed are written, line items of every deal
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    try:
+        updated_deals_since = filter_changed_deals(
+            sf_conn.cursor(), updated_deals_since, event.get('force', False),
+            {deal['id']: deals_with_companies.get(deal['id'], {}).get('id') for deal in updated_deals_since})
+    finally:
+        release_sf_connection(sf_conn)
+    pipeline_stages = get_pipeline_stages()
     print("done pipeline stages")
-    owner_details = get_all_owners()
+    owner_details = owner_directory.get_owner_summaries(
+        {owner_id for deal in updated_deals_since for owner_id in
+         [deal['properties']['hubspot_owner_id'], deal['properties']['delivery_lead'], deal['properties']['solution_lead']]
+         + (deal['properties']['hs_all_collaborator_owner_ids'] or '').split(';')})
     print("done owner details")
     deals_with_line_items = get_all_line_items()
     print("done line items")
@@ -62,7 +90,7 @@ def sync_deals(event):
     for line_items_of_deal in deals_with_line_items.values():
         line_items.extend(line_items_of_deal)
     print("done line items fetch")
-    sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
     try:
         for line_item in line_items:
             for key in ['price', 'quantity', 'amount']:
@@ -72,6 +100,8 @@ def sync_deals(event):
         sf_cursor = sf_conn.cursor()
 
         raw_deals = []
+        # the same owners and companies are on thousands of deals, serialise each once
+        owner_json, company_json, collaborators_json = {}, {}, {}
         for deal in updated_deals_since:
             deal_id = deal['id']
             # handle_deal_upsert(deal, sf_cursor, deals_with_companies, deals_with_line_items, owner_details, pipeline_stages)
@@ -98,7 +128,7 @@ def sync_deals(event):
             deal_data_raw = {
                 "DEAL_ID": deal_id,
                 "DEAL_NAME": deal_properties['dealname'],
-                "DEAL_OWNER": json.dumps(deal_owner_details),
+                "DEAL_OWNER": dumps_once(owner_json, deal_properties['hubspot_owner_id'], deal_owner_details),
                 "DEAL_OWNER_ID": deal_properties['hubspot_owner_id'],
                 "DEAL_OWNER_EMAIL": deal_owner_details.get('email'),
                 "DEAL_OWNER_NAME": deal_owner_details.get('name'),
@@ -112,13 +142,13 @@ def sync_deals(event):
                 "DEAL_STAGE_NAME": stage_name,
                 "COMPANY_ID": company_details.get('id'),
                 "COMPANY_NAME": company_details.get('name', None),
-                "DEAL_TO_COMPANY_ASSOCIATIONS": json.dumps(company_details),
+                "DEAL_TO_COMPANY_ASSOCIATIONS": dumps_once(company_json, company_details.get('id'), company_details),
                 "PIPELINE_ID": deal_properties['pipeline'],
                 "PROJECT_START_DATE": deal_properties['expected_project_start_date'],
                 "PROJECT_CLOSE_DATE": deal_properties['closedate'],
                 "ENGAGEMENT_TYPE": deal_properties['engagement_type__cloned_'],
                 "DURATION_IN_MONTHS": deal_properties['expected_project_duration_in_months'],
-                "DEAL_COLLABORATORS": json.dumps(deal_collaborators),
+                "DEAL_COLLABORATORS": dumps_once(collaborators_json, deal_collaborators_str or '', deal_collaborators),
                 "DEAL_CREATED_ON": deal_properties['hs_createdate'],
                 "DEAL_UPDATED_ON": deal_properties['hs_lastmodifieddate'],
                 "IS_ARCHIVED": False,
@@ -164,39 +194,24 @@ def sync_deals(event):
                     print(f"Field {field} is missing for Deal: {deal_id}, value is {deal_data_raw.get(field)}")
                     deal_data_raw[field] = None
 
+            deal_data_raw["ROW_HASH"] = row_hash(deal_data_raw)
+            deal_data_raw["PROPERTIES_HASH"] = properties_hash(deal_properties)
             raw_deals.append(deal_data_raw)
         print("done raw deals")
         #     create temp table for upsert
         sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE DEALS_TEMP LIKE {SF_DEALS_TABLE}")
         # insert this data into temp table
         print("Inserting data into temp table")
-        sf_cursor.executemany("""INSERT INTO DEALS_TEMP (DEAL_ID, DEAL_NAME, DEAL_OWNER, DEAL_OWNER_ID,
-            DEAL_OWNER_EMAIL, DEAL_OWNER_NAME, DEAL_STAGE_ID, DEAL_STAGE_NAME, COMPANY_ID, COMPANY_NAME,
-            DEAL_TO_COMPANY_ASSOCIATIONS, PIPELINE_ID, PROJECT_START_DATE, PROJECT_CLOSE_DATE, ENGAGEMENT_TYPE,
-            DURATION_IN_MONTHS, DEAL_COLLABORATORS, DEAL_CREATED_ON, DEAL_UPDATED_ON, IS_ARCHIVED, COMPANY_DOMAIN,
-            NS_PROJECT_ID, DEAL_AMOUNT_IN_COMPANY_CURRENCY, DEAL_TYPE, SPECIAL_FIELDS_UPDATED_ON, WORK_AHEAD,
-            LAST_REFRESHED_ON, DELIVERY_LEAD_ID, DELIVERY_LEAD_EMAIL, DELIVERY_LEAD_NAME, SOLUTION_LEAD_ID,
-            SOLUTION_LEAD_EMAIL, SOLUTION_LEAD_NAME, REVENUE_TYPE, CURRENCY, BOOK_LEADS_2026, BOOK_2026_EMAIL, OFFERING,
-            DESCRIPTION, TECH_INVOLVED)
-             VALUES
-            (%(DEAL_ID)s, %(DEAL_NAME)s, %(DEAL_OWNER)s, %(DEAL_OWNER_ID)s, %(DEAL_OWNER_EMAIL)s,
-            %(DEAL_OWNER_NAME)s, %(DEAL_STAGE_ID)s, %(DEAL_STAGE_NAME)s, %(COMPANY_ID)s, %(COMPANY_NAME)s,
-            %(DEAL_TO_COMPANY_ASSOCIATIONS)s, %(PIPELINE_ID)s, %(PROJECT_START_DATE)s, %(PROJECT_CLOSE_DATE)s,
-            %(ENGAGEMENT_TYPE)s, %(DURATION_IN_MONTHS)s, %(DEAL_COLLABORATORS)s, %(DEAL_CREATED_ON)s,
-            %(DEAL_UPDATED_ON)s, %(IS_ARCHIVED)s, %(COMPANY_DOMAIN)s, %(NS_PROJECT_ID)s,
-            %(DEAL_AMOUNT_IN_COMPANY_CURRENCY)s, %(DEAL_TYPE)s, CURRENT_TIMESTAMP(), %(WORK_AHEAD)s,
-            CURRENT_TIMESTAMP(), %(DELIVERY_LEAD_ID)s, %(DELIVERY_LEAD_EMAIL)s, %(DELIVERY_LEAD_NAME)s,
-            %(SOLUTION_LEAD_ID)s, %(SOLUTION_LEAD_EMAIL)s, %(SOLUTION_LEAD_NAME)s, %(REVENUE_TYPE)s, %(CURRENCY)s,
-            %(BOOK_LEADS_2026)s, %(BOOK_2026_EMAIL)s, %(OFFERING)s,
-            %(DESCRIPTION)s, %(TECH_INVOLVED)s)""",
-                              raw_deals)
+        if raw_deals:
+            sf_cursor.executemany(insert_statement("DEALS_TEMP", DEALS_TEMP_KEYS, DEALS_TEMP_EXPRESSIONS),
+                                  row_values(raw_deals, DEALS_TEMP_KEYS))
         # upsert from temp table to main table
         print("Upserting data into main table")
         sf_cursor.execute(f"""
             MERGE INTO {SF_DEALS_TABLE} AS target
             USING DEALS_TEMP AS source
             ON target.DEAL_ID = source.DEAL_ID
-            WHEN MATCHED THEN
+            WHEN MATCHED AND {ROW_CHANGED_CONDITION} THEN
                 UPDATE SET target.DEAL_NAME = source.DEAL_NAME,
                 target.DEAL_OWNER = source.DEAL_OWNER,
                 target.DEAL_OWNER_ID = source.DEAL_OWNER_ID,
@@ -235,7 +250,9 @@ def sync_deals(event):
                 target.BOOK_2026_EMAIL = source.BOOK_2026_EMAIL,
                 target.OFFERING = source.OFFERING,
                 target.DESCRIPTION = source.DESCRIPTION,
-                target.TECH_INVOLVED = source.TECH_INVOLVED
+                target.TECH_INVOLVED = source.TECH_INVOLVED,
+                target.ROW_HASH = source.ROW_HASH,
+                target.PROPERTIES_HASH = source.PROPERTIES_HASH
             WHEN NOT MATCHED THEN
                 INSERT (DEAL_ID, DEAL_NAME, DEAL_OWNER, DEAL_OWNER_ID, DEAL_OWNER_EMAIL, DEAL_OWNER_NAME,
                 DEAL_STAGE_ID, DEAL_STAGE_NAME, COMPANY_ID, COMPANY_NAME, DEAL_TO_COMPANY_ASSOCIATIONS,
@@ -244,7 +261,7 @@ def sync_deals(event):
                 DEAL_AMOUNT_IN_COMPANY_CURRENCY, DEAL_TYPE, SPECIAL_FIELDS_UPDATED_ON, WORK_AHEAD, LAST_REFRESHED_ON,
                 DELIVERY_LEAD_ID, DELIVERY_LEAD_EMAIL, DELIVERY_LEAD_NAME, SOLUTION_LEAD_ID, SOLUTION_LEAD_EMAIL,
                 SOLUTION_LEAD_NAME, REVENUE_TYPE, CURRENCY, BOOK_LEADS_2026, BOOK_2026_EMAIL, OFFERING,
-                DESCRIPTION, TECH_INVOLVED)
+                DESCRIPTION, TECH_INVOLVED, ROW_HASH, PROPERTIES_HASH)
                 VALUES (source.DEAL_ID, source.DEAL_NAME, source.DEAL_OWNER, source.DEAL_OWNER_ID,
                 source.DEAL_OWNER_EMAIL, source.DEAL_OWNER_NAME, source.DEAL_STAGE_ID, source.DEAL_STAGE_NAME,
                 source.COMPANY_ID, source.COMPANY_NAME, source.DEAL_TO_COMPANY_ASSOCIATIONS, source.PIPELINE_ID,
@@ -255,17 +272,17 @@ def sync_deals(event):
                 source.DELIVERY_LEAD_EMAIL, source.DELIVERY_LEAD_NAME, source.SOLUTION_LEAD_ID,
                 source.SOLUTION_LEAD_EMAIL, source.SOLUTION_LEAD_NAME, source.REVENUE_TYPE, source.CURRENCY,
                 source.BOOK_LEADS_2026, source.BOOK_2026_EMAIL, source.OFFERING,
-                source.DESCRIPTION, source.TECH_INVOLVED)
+                source.DESCRIPTION, source.TECH_INVOLVED, source.ROW_HASH, source.PROPERTIES_HASH)
         """
                           )
         print(f"Done - Deals Updated/Created Since: {sync_from}")
         # #####################################################################
         sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE LINE_ITEMS_TEMP LIKE {SF_LINE_ITEMS_TABLE}")
-        sf_cursor.executemany("""INSERT INTO LINE_ITEMS_TEMP (LINE_ITEM_ID, NAME, PRICE, QUANTITY, AMOUNT, CREATED_ON, UPDATED_ON, DEAL_ID)
-            VALUES (%(id)s, %(name)s, %(price)s, %(quantity)s, %(amount)s, %(created_at)s, %(updated_at)s, %(deal_id)s)""",
-                              line_items)
-        sf_cursor.execute(f"DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE DEAL_ID IN (%(line_items_deals)s)",
-                          {'line_items_deals': line_items_deals})
+        sf_cursor.executemany(insert_statement("LINE_ITEMS_TEMP", tuple(column for column, _ in LINE_ITEMS_TEMP_COLUMNS)),
+                              row_values(line_items, [key for _, key in LINE_ITEMS_TEMP_COLUMNS]))
+        if line_items_deals:
+            # line_items_deals are the deals in LINE_ITEMS_TEMP, a subquery instead of one bind variable per deal
+            sf_cursor.execute(f"DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE DEAL_ID IN (SELECT DEAL_ID FROM LINE_ITEMS_TEMP)")
 
         sf_cursor.execute(f"""
             MERGE INTO {SF_LINE_ITEMS_TABLE} AS target
@@ -296,4 +313,4 @@ def sync_deals(event):
 
     finally:
         sf_conn.commit()
-        close_sf_connection(sf_conn)
+        release_sf_connection(sf_conn)
@@ -1,18 +1,34 @@
-import json
+import asyncio
 import traceback
 from collections import defaultdict
 from datetime import datetime, timezone, timedelta
 
 import pytz
 
-from .bulk_events import get_2026_book_lead_email
+from .bulk_events import get_2026_book_lead_email, DEALS_TEMP_COLUMNS, DEALS_TEMP_KEYS, DEALS_TEMP_EXPRESSIONS
 from .utils.config import SF_DEALS_TABLE, SF_LINE_ITEMS_TABLE, SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, \
-    SF_ROLE
-from .utils.hubspot_api import fetch_updated_or_created_deals, get_all_stages, get_all_owners, \
-    get_associated_companies_of_deals, \
-    get_associated_line_items_of_deals, get_line_items_by_ids_batch, get_companies_by_ids_batch, \
-    get_owners_by_ids_users_search
-from .utils.snowflake_db import close_sf_connection, create_sf_connection
+    SF_ROLE, HUBSPOT_SEARCH_SHARDS, SYNC_CHUNK_SIZE, SYNC_JOB_MIN_REMAINING_MS
+from .utils.hubspot_api import fetch_updated_or_created_deals, get_pipeline_stages, \
+    iter_deals_by_modified_windows, to_epoch_ms, get_associated_companies_of_deals, \
+    get_associated_line_items_of_deals, get_line_items_by_ids_batch, parse_company
+from .utils.concurrency import run_task_graph, map_concurrently, chunks
+from .utils.hubspot_api_async import AsyncHubspotClient
+from .utils.snowflake_db import release_sf_connection, get_sf_connection
+from .utils.company_cache import company_cache
+from .utils.jsonlib import dumps_column
+from .utils.owner_directory import owner_directory
+from .utils.row_hash import row_hashes, properties_hashes, filter_changed_deals, ensure_hash_columns, ROW_CHANGED_CONDITION
+from .utils.snowflake_loader import use_copy, copy_rows_into, copy_columns_into
+from .utils.sql import insert_statement, row_values, column_rows, placeholders
+from .utils import sync_jobs
+from .utils.s3 import advance_watermark
+
+LINE_ITEMS_TEMP_COLUMNS = [("LINE_ITEM_ID", "id"), ("NAME", "name"), ("PRICE", "price"), ("QUANTITY", "quantity"),
+                           ("AMOUNT", "amount"), ("CREATED_ON", "created_at"), ("UPDATED_ON", "updated_at"),
+                           ("DEAL_ID", "deal_id"), ("CURRENCY", "currency")]
+# returned by sync_deals when a job goes on in another invocation
+JOB_CONTINUED = "continued"
+
 
 def get_list_of_owner_ids(deals):
     owner_ids = set()
@@ -28,292 +44,354 @@ def get_list_of_owner_ids(deals):
     return list(owner_ids)
 
 
-def sync_deals(event):
+def fetch_deal_enrichments(deals, sf_cursor, force=False, pipeline_stages=None, owner_details=None):
+    """
+    Fetch companies, owners, pipeline stages and line items for a list of deals.
+    Independent lookups run concurrently, and association reads feed the object reads that
+    depend on them, so the wall-clock is the slowest chain instead of the sum of every call.
+    Companies and owners are only looked up for the deals whose row changed (filter_changed_deals,
+    returned as changed_deals), line items for every deal.
+    :param pipeline_stages: stages already fetched by an earlier chunk of the same sync
+    :param owner_details: owners already fetched by earlier chunks, only missing owners are fetched and added
+    """
+    deal_ids = [deal['id'] for deal in deals]
+
+    def get_changed_deals(deals_to_associated_company_ids):
+        return filter_changed_deals(sf_cursor, deals, force,
+                                    {deal_id: deals_to_associated_company_ids.get(deal_id) for deal_id in deal_ids})
+
+    def get_companies(deals_to_associated_company_ids, changed_deals):
+        company_ids = list({deals_to_associated_company_ids[deal['id']] for deal in changed_deals
+                            if deals_to_associated_company_ids.get(deal['id'])})
+        return {company_id: parse_company(company)
+                for company_id, company in company_cache.get_companies(company_ids).items()}
+
+    def get_line_items(deals_to_associated_line_item_ids):
+        line_item_ids = list({line_item_id for line_item_ids in deals_to_associated_line_item_ids.values()
+                              for line_item_id in line_item_ids})
+        return get_line_items_by_ids_batch(line_item_ids)
+
+    def get_owners(changed_deals):
+        if owner_details is None:
+            return owner_directory.get_owner_summaries(get_list_of_owner_ids(changed_deals))
+        missing_owner_ids = [owner_id for owner_id in get_list_of_owner_ids(changed_deals)
+                             if owner_id not in owner_details]
+        if missing_owner_ids:
+            owner_details.update(owner_directory.get_owner_summaries(missing_owner_ids))
+        return owner_details
+
+    results = run_task_graph({
+        "deals_to_associated_company_ids": (lambda: get_associated_companies_of_deals(deal_ids), []),
+        "changed_deals": (get_changed_deals, ["deals_to_associated_company_ids"]),
+        "company_details": (get_companies, ["deals_to_associated_company_ids", "changed_deals"]),
+        "pipeline_stages": ((lambda: pipeline_stages) if pipeline_stages is not None else get_pipeline_stages, []),
+        "owner_details": (get_owners, ["changed_deals"]),
+        "deals_to_associated_line_item_ids": (lambda: get_associated_line_items_of_deals(deal_ids), []),
+        "line_item_details": (get_line_items, ["deals_to_associated_line_item_ids"]),
+    })
+
+    deals_to_associated_company_ids = results["deals_to_associated_company_ids"]
+    company_details = results["company_details"]
+    deals_with_companies = {deal['id']: company_details.get(deals_to_associated_company_ids.get(deal['id']), {})
+                            for deal in results["changed_deals"]}
+
+    line_item_id_to_deal_id_mapping = {}
+    for deal_id, line_item_ids in results["deals_to_associated_line_item_ids"].items():
+        for line_item_id in line_item_ids:
+            line_item_id_to_deal_id_mapping[line_item_id] = deal_id
+    deals_with_line_items = defaultdict(list)
+    for line_item_id, details in results["line_item_details"].items():
+        deals_with_line_items[line_item_id_to_deal_id_mapping[line_item_id]].append({**details, 'deal_id': line_item_id_to_deal_id_mapping[line_item_id]})
+
+    return {"changed_deals": results["changed_deals"],
+            "deals_with_companies": deals_with_companies,
+            "pipeline_stages": results["pipeline_stages"],
+            "owner_details": results["owner_details"],
+            "deals_with_line_items": deals_with_line_items}
+
+
+def to_search_datetime(sync_from):
+    parsed_datetime = datetime.strptime(sync_from, "%Y-%m-%dT%H:%M:%S%z")
+    desired_timezone = pytz.timezone('UTC')
+    converted_datetime = parsed_datetime.astimezone(desired_timezone)
+    return converted_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def iter_deal_chunks(pages, chunk_size=SYNC_CHUNK_SIZE):
+    """
+    Regroup search pages into chunks of about chunk_size deals. A deal seen again in a later page is
+    only passed on again when that copy is newer, so overlapping windows do not load it twice.
+    """
+    deal_updated_at = {}
+    # deal id -> deal, a newer copy of a deal still in the chunk replaces the older one
+    chunk = {}
+    for page in pages:
+        for deal in page:
+            updated_at = deal.get('updatedAt', '')
+            if deal['id'] in deal_updated_at and updated_at <= deal_updated_at[deal['id']]:
+                continue
+            deal_updated_at[deal['id']] = updated_at
+            chunk[deal['id']] = deal
+        if len(chunk) >= chunk_size:
+            yield list(chunk.values())
+            chunk = {}
+    if chunk:
+        yield list(chunk.values())
+
+
+def sync_deal_chunk(sf_cursor, deals, pipeline_stages, owner_details, force=False, json_cache=None, stage=None):
+    """
+    Enrich, transform and load the deals of one chunk. Only the deals whose exported properties or
+    company changed get their row written, the line items of every deal are loaded.
+    :param stage: (deals table, line items table) to append the rows to instead of upserting them,
+        a fan-out worker's staging tables (fanout_sync.py)
+    :return: pipeline stages, so later chunks reuse them
+    """
+    enrichments = fetch_deal_enrichments(deals, sf_cursor, force, pipeline_stages=pipeline_stages,
+                                         owner_details=owner_details)
+    deals_with_line_items = enrichments["deals_with_line_items"]
+    line_items = clean_line_items([line_item for line_items_of_deal in deals_with_line_items.values()
+                                   for line_item in line_items_of_deal])
+    deal_columns = build_deal_columns(enrichments["changed_deals"], enrichments["deals_with_companies"],
+                                      enrichments["owner_details"], enrichments["pipeline_stages"], json_cache)
+    if stage is not None:
+        stage_deals(sf_cursor, *stage, deal_columns, line_items)
+    else:
+        load_deals(sf_cursor, deal_columns, line_items, list(deals_with_line_items.keys()))
+    return enrichments["pipeline_stages"]
+
+
+def load_deal_pages(pages, event, stop=None, stage=None):
+    """
+    Enrich and load search pages in chunks of SYNC_CHUNK_SIZE, each committed on its own. Pages are
+    fetched in the background while the current chunk is enriched and loaded.
+    :param stop: called after every committed chunk, True stops before the next one
+    :param stage: staging tables, see sync_deal_chunk
+    :return: deals synced and whether every page was loaded
+    """
+    sf_conn = None
+    synced = 0
+    pipeline_stages = None
+    owner_details = {}
+    json_cache = {}
+    deal_chunks = iter_deal_chunks(pages, event.get('chunk_size', SYNC_CHUNK_SIZE))
+    try:
+        for deals in deal_chunks:
+            if sf_conn is None:
+                sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+                sf_cursor = sf_conn.cursor()
+            pipeline_stages = sync_deal_chunk(sf_cursor, deals, pipeline_stages, owner_details,
+                                              event.get('force', False), json_cache, stage)
+            sf_conn.commit()
+            synced += len(deals)
+            print(f"Synced {synced} Deals")
+            if stop is not None and stop():
+                return synced, False
+        return synced, True
+    except Exception as ex:
+        print(traceback.format_exc())
+        if sf_conn is not None:
+            sf_conn.rollback()
+        print(f"Failed Sync after {synced} deals - {ex}")
+        raise
+
+    finally:
+        # stops the background page fetch when the chunks were not all loaded
+        deal_chunks.close()
+        if hasattr(pages, 'close'):
+            pages.close()
+        if sf_conn is not None:
+            release_sf_connection(sf_conn)
+
+
+def sync_deals(event, context=None):
+    """
+    Stream deals from HubSpot to Snowflake in chunks of SYNC_CHUNK_SIZE, so memory does not grow with
+    the size of the sync and the first rows land after one chunk. A sync_from sync runs as a
+    checkpointed job (sync_deals_job).
+    :return: JOB_CONTINUED when the job goes on in another invocation
+    """
     sync_from = event.get('sync_from', None)
     deal_ids = event.get('deal_ids', [])
 
-    if not sync_from and not deal_ids:
+    if event.get('job_id') or sync_from:
+        return sync_deals_job(event, context)
+    if not deal_ids:
         print("Missing sync_from / deal_ids in the request. Exiting.")
         return
-    formatted_datetime = None
-    updated_deals_since = []
-    if sync_from:
-        parsed_datetime = datetime.strptime(sync_from, "%Y-%m-%dT%H:%M:%S%z")
-        desired_timezone = pytz.timezone('UTC')
-        converted_datetime = parsed_datetime.astimezone(desired_timezone)
-        formatted_datetime = converted_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
-        updated_deals_since = fetch_updated_or_created_deals(start_date_time=formatted_datetime)
-
-    elif deal_ids:
-        deal_ids = list(set(deal_ids))
-        deals_as_batch_of_100 =  [deal_ids[i:i + 100] for i in range(0, len(deal_ids), 100)]
-        for deal_ids_batch in deals_as_batch_of_100:
-            updated_deals_since.extend(fetch_updated_or_created_deals(start_date_time=formatted_datetime, deal_ids=deal_ids_batch))
-
-
-    if len(updated_deals_since) <= 0:
-        print(f"No Deals Updated/Created Since: {formatted_datetime}")
+    pages = map_concurrently(
+        lambda deal_ids_batch: fetch_updated_or_created_deals(start_date_time=None, deal_ids=deal_ids_batch),
+        chunks(list(set(deal_ids)), 100))
+    synced, _ = load_deal_pages(pages, event)
+    if synced <= 0:
+        print(f"No Deals found for {len(deal_ids)} deal ids")
+
+
+def sync_deals_job(event, context=None):
+    """
+    Sync deals modified since sync_from window by window, oldest first, saving the job after every
+    window (utils/sync_jobs.py). With less than SYNC_JOB_MIN_REMAINING_MS left the job stops after the
+    current chunk and invokes the function again, a window that did not finish is fetched again (its
+    committed deals are skipped by their PROPERTIES_HASH) and later windows are made shorter. Windows
+    with less than a chunk of deals make the next one longer. An event with a job_id resumes that job.
+    """
+    if event.get('job_id'):
+        job = sync_jobs.load_job(event['job_id'], event)
+        print(f"Resuming sync job {job['job_id']} from {sync_jobs.to_iso_ms(job['checkpoint_ms'])}")
+    else:
+        job = sync_jobs.new_job(to_epoch_ms(to_search_datetime(event['sync_from'])) + 1, event)
+        print(f"Started sync job {job['job_id']} for deals modified since {event['sync_from']}")
+        # failure emails show the event, with the job_id to resume from
+        event['job_id'] = job['job_id']
+    job['status'] = "PROCESSING"
+    sync_jobs.save_job(job)
+
+    def out_of_time():
+        return context is not None and context.get_remaining_time_in_millis() < SYNC_JOB_MIN_REMAINING_MS
+
+    try:
+        window = sync_jobs.next_window(job)
+        while window is not None:
+            if out_of_time():
+                sync_jobs.continue_job(job, context)
+                return JOB_CONTINUED
+            window_start_ms, window_end_ms = window
+            pages = iter_deals_by_modified_windows(sync_jobs.to_iso_ms(window_start_ms - 1),
+                                                   sync_jobs.to_iso_ms(window_end_ms),
+                                                   shards=event.get('shards', HUBSPOT_SEARCH_SHARDS))
+            synced, finished = load_deal_pages(pages, event, stop=out_of_time)
+            if not finished:
+                sync_jobs.shrink_window(job)
+                sync_jobs.continue_job(job, context)
+                return JOB_CONTINUED
+            # a window with less than one chunk of deals is cheap, try a longer one next
+            sync_jobs.finish_window(job, window_end_ms, synced,
+                                    grow=synced < event.get('chunk_size', SYNC_CHUNK_SIZE))
+            sync_jobs.save_job(job)
+            print(f"Sync job {job['job_id']} synced up to {sync_jobs.to_iso_ms(window_end_ms)}, "
+                  f"{job['synced']} deals in {job['windows']} windows")
+            window = sync_jobs.next_window(job)
+    except Exception:
+        job['status'] = "FAILED"
+        sync_jobs.save_job(job)
+        raise
+
+    job['status'] = "COMPLETED"
+    sync_jobs.save_job(job)
+    advance_watermark("MANUAL_SYNC", sync_jobs.to_iso_ms(job['until_ms']))
+    if job['synced'] <= 0:
+        print(f"No Deals Updated/Created Since: {event.get('sync_from')}")
+
+
+async def fetch_deal_enrichments_async(client, deals, owner_details, pipeline_stages_task, sf_cursor, force=False):
+    """
+    Async counterpart of fetch_deal_enrichments for one page of deals. Owners already resolved
+    by earlier pages are taken from owner_details instead of being fetched again.
+    """
+    deal_ids = [deal['id'] for deal in deals]
+
+    async def get_companies(deals_to_associated_company_ids, changed_deals):
+        company_ids = list({deals_to_associated_company_ids[deal['id']] for deal in changed_deals
+                            if deals_to_associated_company_ids.get(deal['id'])})
+        companies = await asyncio.to_thread(company_cache.get_companies, company_ids)
+        company_details = {company_id: parse_company(company) for company_id, company in companies.items()}
+        return {deal['id']: company_details.get(deals_to_associated_company_ids.get(deal['id']), {})
+                for deal in changed_deals}
+
+    async def get_line_items():
+        deals_to_associated_line_item_ids = await client.get_associated_line_items_of_deals(deal_ids)
+        line_item_id_to_deal_id_mapping = {line_item_id: deal_id
+                                           for deal_id, line_item_ids in deals_to_associated_line_item_ids.items()
+                                           for line_item_id in line_item_ids}
+        line_item_details = await client.get_line_items_by_ids_batch(list(line_item_id_to_deal_id_mapping.keys()))
+        deals_with_line_items = defaultdict(list)
+        for line_item_id, details in line_item_details.items():
+            deal_id = line_item_id_to_deal_id_mapping[line_item_id]
+            deals_with_line_items[deal_id].append({**details, 'deal_id': deal_id})
+        return deals_with_line_items
+
+    async def get_owners(changed_deals):
+        missing_owner_ids = [owner_id for owner_id in get_list_of_owner_ids(changed_deals)
+                             if owner_id not in owner_details]
+        if missing_owner_ids:
+            owner_details.update(await asyncio.to_thread(owner_directory.get_owner_summaries, missing_owner_ids))
+        return owner_details
+
+    async def get_changed_deals_enrichments():
+        # companies and owners only for the deals whose row changed
+        deals_to_associated_company_ids = await client.get_associated_companies_of_deals(deal_ids)
+        changed_deals = await asyncio.to_thread(
+            filter_changed_deals, sf_cursor, deals, force,
+            {deal_id: deals_to_associated_company_ids.get(deal_id) for deal_id in deal_ids})
+        deals_with_companies, owners = await asyncio.gather(
+            get_companies(deals_to_associated_company_ids, changed_deals), get_owners(changed_deals))
+        return changed_deals, deals_with_companies, owners
+
+    (changed_deals, deals_with_companies, owners), deals_with_line_items, pipeline_stages = await asyncio.gather(
+        get_changed_deals_enrichments(), get_line_items(), pipeline_stages_task)
+    return {"changed_deals": changed_deals,
+            "deals_with_companies": deals_with_companies,
+            "pipeline_stages": pipeline_stages,
+            "owner_details": owners,
+            "deals_with_line_items": deals_with_line_items}
+
+
+async def sync_deals_async(event):
+    """
+    Async variant of sync_deals. Each search page is enriched and transformed as soon as it
+    arrives, while later pages are still in flight; the Snowflake load runs once at the end.
+    Needs the optional httpx dependency.
+    """
+    sync_from = event.get('sync_from', None)
+    deal_ids = list(set(event.get('deal_ids', [])))
+
+    if not sync_from and not deal_ids:
+        print("Missing sync_from / deal_ids in the request. Exiting.")
         return
-    list_of_owner_ids = get_list_of_owner_ids(updated_deals_since)
-    print(f"Deals Updated/Created Since: {formatted_datetime} - {len(updated_deals_since)}")
-    deal_ids = [deal['id'] for deal in updated_deals_since]
-    deals_to_associated_company_ids = get_associated_companies_of_deals(deal_ids)
-    # company_id_to_deal_id_mapping = {v:k for k, v in deals_to_associated_company_ids.items()}
-    company_ids = list(set(deals_to_associated_company_ids.values()))
-    company_details = get_companies_by_ids_batch(company_ids)
-    deals_with_companies = {deal_id: company_details.get(deals_to_associated_company_ids.get(deal_id), {}) for deal_id in deal_ids}
-    # deals_with_companies = get_all_companies()
-    print("done company details")
-    pipeline_stages = get_all_stages()
-    print("done pipeline stages")
-    # owner_details = get_all_owners()
-    owner_details = get_owners_by_ids_users_search(owner_ids=list_of_owner_ids)
-    print("done owner details")
-    deals_to_associated_line_item_ids = get_associated_line_items_of_deals(deal_ids)
-    line_item_id_to_deal_id_mapping = {}
-    for deal_id, line_item_ids in deals_to_associated_line_item_ids.items():
-        for line_item_id in line_item_ids:
-            line_item_id_to_deal_id_mapping[line_item_id] = deal_id
-    line_item_ids = list(set(line_item_id_to_deal_id_mapping.keys()))
+    formatted_datetime = to_search_datetime(sync_from) if sync_from else None
 
-    # deals_with_line_items = get_all_line_items()
-    line_item_details = get_line_items_by_ids_batch(line_item_ids)
-    deals_with_line_items = defaultdict(list)
-    for line_item_id, details in line_item_details.items():
-        deals_with_line_items[line_item_id_to_deal_id_mapping[line_item_id]].append({**details, 'deal_id': line_item_id_to_deal_id_mapping[line_item_id]})
-    print("done line items")
-    line_items_deals = [deal_id for deal_id in deals_with_line_items.keys()]
-    line_items = []
-    for line_items_of_deal in deals_with_line_items.values():
-        line_items.extend(line_items_of_deal)
-    print("done line items fetch")
-    sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    transformed = []
+    deal_updated_at = {}
+    owner_details = {}
+    json_cache = {}
+
+    async def transform_page(deals):
+        enrichments = await fetch_deal_enrichments_async(client, deals, owner_details, pipeline_stages_task,
+                                                         sf_conn.cursor(), event.get('force', False))
+        changed_deals = enrichments["changed_deals"]
+        transformed.append((deals, changed_deals,
+                            build_deal_columns(changed_deals, enrichments["deals_with_companies"],
+                                               enrichments["owner_details"], enrichments["pipeline_stages"],
+                                               json_cache),
+                            enrichments["deals_with_line_items"]))
+
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
     try:
-        for line_item in line_items:
-            for key in ['price', 'quantity', 'amount']:
-                if line_item[key] is not None and line_item[key].strip() == '':
-                    print(f"Field {key} is missing for Line Item: {line_item['id']}, value is {line_item[key]}")
-                    line_item[key] = None
-        sf_cursor = sf_conn.cursor()
-
-        raw_deals = []
-        for deal in updated_deals_since:
-            deal_id = deal['id']
-            # handle_deal_upsert(deal, sf_cursor, deals_with_companies, deals_with_line_items, owner_details, pipeline_stages)
-            deal_properties = deal['properties']
-            stage_name = pipeline_stages.get(deal_properties["pipeline"], {}).get(deal_properties['dealstage'])
-
-            curr_time = datetime.now(pytz.timezone('America/New_York'))
-
-            if deal_properties['work_ahead'] in ['No', 'blank']:
-                work_ahead = 'No'
-            else:
-                work_ahead = deal_properties['work_ahead']
-            deal_owner_details = owner_details.get(deal_properties['hubspot_owner_id'], {})
-            delivery_lead_details = owner_details.get(deal_properties['delivery_lead'], {})
-            solution_lead_details = owner_details.get(deal_properties['solution_lead'], {})
-            company_details = deals_with_companies.get(deal_id, {})
-            deal_collaborators_str = deal_properties['hs_all_collaborator_owner_ids']
-            deal_collaborators = []
-            if deal_collaborators_str:
-                deal_collaborators = [owner_details.get(collaborator_id)
-                                      for collaborator_id in
-                                      deal_collaborators_str.split(";")]
-
-            deal_data_raw = {
-                "DEAL_ID": deal_id,
-                "DEAL_NAME": deal_properties['dealname'],
-                "DEAL_OWNER": json.dumps(deal_owner_details),
-                "DEAL_OWNER_ID": deal_properties['hubspot_owner_id'],
-                "DEAL_OWNER_EMAIL": deal_owner_details.get('email'),
-                "DEAL_OWNER_NAME": deal_owner_details.get('name'),
-                "DELIVERY_LEAD_ID": deal_properties['delivery_lead'],
-                "DELIVERY_LEAD_EMAIL": delivery_lead_details.get('email'),
-                "DELIVERY_LEAD_NAME": delivery_lead_details.get('name'),
-                "SOLUTION_LEAD_ID": deal_properties['solution_lead'],
-                "SOLUTION_LEAD_EMAIL": solution_lead_details.get('email'),
-                "SOLUTION_LEAD_NAME": solution_lead_details.get('name'),
-                "DEAL_STAGE_ID": deal_properties['dealstage'],
-                "DEAL_STAGE_NAME": stage_name,
-                "COMPANY_ID": company_details.get('id'),
-                "COMPANY_NAME": company_details.get('name', None),
-                "DEAL_TO_COMPANY_ASSOCIATIONS": json.dumps(company_details),
-                "PIPELINE_ID": deal_properties['pipeline'],
-                "PROJECT_START_DATE": deal_properties['expected_project_start_date'],
-                "PROJECT_CLOSE_DATE": deal_properties['closedate'],
-                "ENGAGEMENT_TYPE": deal_properties['engagement_type__cloned_'],
-                "DURATION_IN_MONTHS": deal_properties['expected_project_duration_in_months'],
-                "DEAL_COLLABORATORS": json.dumps(deal_collaborators),
-                "DEAL_CREATED_ON": deal_properties['hs_createdate'],
-                "DEAL_UPDATED_ON": deal_properties['hs_lastmodifieddate'],
-                "IS_ARCHIVED": False,
-                "COMPANY_DOMAIN": company_details.get('domain'),
-                "NS_PROJECT_ID": deal_properties['ns_project_id__finance_only_'],
-                "DEAL_AMOUNT_IN_COMPANY_CURRENCY": deal_properties['amount'],
-                "DEAL_TYPE": deal_properties['dealtype'],
-                "SPECIAL_FIELDS_UPDATED_ON": datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
-                "WORK_AHEAD": work_ahead,
-                "LAST_REFRESHED_ON": curr_time,
-                "REVENUE_TYPE": deal_properties['revenue_type'],
-                "CURRENCY": deal_properties.get('deal_currency_code') or 'USD',
-                "BOOK_LEADS_2026": deal_properties.get('n2026_book'),
-                "BOOK_2026_EMAIL": get_2026_book_lead_email(deal_properties.get('n2026_book')),
-                "OFFERING": deal_properties.get('offering'),
-                "DESCRIPTION": deal_properties.get('description'),
-                "TECH_INVOLVED": deal_properties.get('tech_involved')
-            }
-
-            timestamp_fields = [
-                'PROJECT_START_DATE', 'PROJECT_CLOSE_DATE', 'DEAL_CREATED_ON',
-                'DEAL_UPDATED_ON', 'SPECIAL_FIELDS_UPDATED_ON', 'LAST_REFRESHED_ON'
-            ]
-            for field in timestamp_fields:
-                if deal_data_raw.get(field) is not None and str(deal_data_raw.get(field)).strip() == '':
-                    print(f"Field {field} is missing for Deal: {deal_id}, value is {deal_data_raw.get(field)}")
-                    deal_data_raw[field] = None
-
-            # number_fields = ['COMPANY_ID', 'DURATION_IN_MONTHS', 'DEAL_AMOUNT_IN_COMPANY_CURRENCY']
-            number_fields = [
-                "DURATION_IN_MONTHS",
-                "DEAL_AMOUNT_IN_COMPANY_CURRENCY",
-                "DEAL_OWNER_ID",
-                "COMPANY_ID",
-                "PIPELINE_ID",
-                "NS_PROJECT_ID",
-                "DELIVERY_LEAD_ID",
-                "SOLUTION_LEAD_ID"
-                # Add more if you know they are numeric
-            ]
-            for field in number_fields:
-                if deal_data_raw.get(field) is not None and str(deal_data_raw.get(field)).strip() == '':
-                    print(f"Field {field} is missing for Deal: {deal_id}, value is {deal_data_raw.get(field)}")
-                    deal_data_raw[field] = None
-
-            raw_deals.append(deal_data_raw)
-        print("done raw deals")
-        #     create temp table for upsert
-        sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE DEALS_TEMP LIKE {SF_DEALS_TABLE}")
-        # insert this data into temp table
-        print("Inserting data into temp table")
-        sf_cursor.executemany("""INSERT INTO DEALS_TEMP (DEAL_ID, DEAL_NAME, DEAL_OWNER, DEAL_OWNER_ID,
-            DEAL_OWNER_EMAIL, DEAL_OWNER_NAME, DEAL_STAGE_ID, DEAL_STAGE_NAME, COMPANY_ID, COMPANY_NAME,
-            DEAL_TO_COMPANY_ASSOCIATIONS, PIPELINE_ID, PROJECT_START_DATE, PROJECT_CLOSE_DATE, ENGAGEMENT_TYPE,
-            DURATION_IN_MONTHS, DEAL_COLLABORATORS, DEAL_CREATED_ON, DEAL_UPDATED_ON, IS_ARCHIVED, COMPANY_DOMAIN,
-            NS_PROJECT_ID, DEAL_AMOUNT_IN_COMPANY_CURRENCY, DEAL_TYPE, SPECIAL_FIELDS_UPDATED_ON, WORK_AHEAD,
-            LAST_REFRESHED_ON, DELIVERY_LEAD_ID, DELIVERY_LEAD_EMAIL, DELIVERY_LEAD_NAME, SOLUTION_LEAD_ID,
-            SOLUTION_LEAD_EMAIL, SOLUTION_LEAD_NAME, REVENUE_TYPE, CURRENCY, BOOK_LEADS_2026, BOOK_2026_EMAIL, OFFERING,
-            DESCRIPTION, TECH_INVOLVED)
-             VALUES
-            (%(DEAL_ID)s, %(DEAL_NAME)s, %(DEAL_OWNER)s, %(DEAL_OWNER_ID)s, %(DEAL_OWNER_EMAIL)s,
-            %(DEAL_OWNER_NAME)s, %(DEAL_STAGE_ID)s, %(DEAL_STAGE_NAME)s, %(COMPANY_ID)s, %(COMPANY_NAME)s,
-            %(DEAL_TO_COMPANY_ASSOCIATIONS)s, %(PIPELINE_ID)s, %(PROJECT_START_DATE)s, %(PROJECT_CLOSE_DATE)s,
-            %(ENGAGEMENT_TYPE)s, %(DURATION_IN_MONTHS)s, %(DEAL_COLLABORATORS)s, %(DEAL_CREATED_ON)s,
-            %(DEAL_UPDATED_ON)s, %(IS_ARCHIVED)s, %(COMPANY_DOMAIN)s, %(NS_PROJECT_ID)s,
-            %(DEAL_AMOUNT_IN_COMPANY_CURRENCY)s, %(DEAL_TYPE)s, CURRENT_TIMESTAMP(), %(WORK_AHEAD)s,
-            CURRENT_TIMESTAMP(), %(DELIVERY_LEAD_ID)s, %(DELIVERY_LEAD_EMAIL)s, %(DELIVERY_LEAD_NAME)s,
-            %(SOLUTION_LEAD_ID)s, %(SOLUTION_LEAD_EMAIL)s, %(SOLUTION_LEAD_NAME)s, %(REVENUE_TYPE)s,
-            %(CURRENCY)s, %(BOOK_LEADS_2026)s, %(BOOK_2026_EMAIL)s, %(OFFERING)s,
-            %(DESCRIPTION)s, %(TECH_INVOLVED)s)""",
-                              raw_deals)
-        # upsert from temp table to main table
-        print("Upserting data into main table")
-        sf_cursor.execute(f"""
-            MERGE INTO {SF_DEALS_TABLE} AS target
-            USING DEALS_TEMP AS source
-            ON target.DEAL_ID = source.DEAL_ID
-            WHEN MATCHED THEN
-                UPDATE SET target.DEAL_NAME = source.DEAL_NAME,
-                target.DEAL_OWNER = source.DEAL_OWNER,
-                target.DEAL_OWNER_ID = source.DEAL_OWNER_ID,
-                target.DEAL_OWNER_EMAIL = source.DEAL_OWNER_EMAIL,
-                target.DEAL_OWNER_NAME = source.DEAL_OWNER_NAME,
-                target.DEAL_STAGE_ID = source.DEAL_STAGE_ID,
-                target.DEAL_STAGE_NAME = source.DEAL_STAGE_NAME,
-                target.COMPANY_ID = source.COMPANY_ID,
-                target.COMPANY_NAME = source.COMPANY_NAME,
-                target.DEAL_TO_COMPANY_ASSOCIATIONS = source.DEAL_TO_COMPANY_ASSOCIATIONS,
-                target.PIPELINE_ID = source.PIPELINE_ID,
-                target.PROJECT_START_DATE = source.PROJECT_START_DATE,
-                target.PROJECT_CLOSE_DATE = source.PROJECT_CLOSE_DATE,
-                target.ENGAGEMENT_TYPE = source.ENGAGEMENT_TYPE,
-                target.DURATION_IN_MONTHS = source.DURATION_IN_MONTHS,
-                target.DEAL_COLLABORATORS = source.DEAL_COLLABORATORS,
-                target.DEAL_CREATED_ON = source.DEAL_CREATED_ON,
-                target.DEAL_UPDATED_ON = source.DEAL_UPDATED_ON,
-                target.IS_ARCHIVED = source.IS_ARCHIVED,
-                target.COMPANY_DOMAIN = source.COMPANY_DOMAIN,
-                target.NS_PROJECT_ID = source.NS_PROJECT_ID,
-                target.DEAL_AMOUNT_IN_COMPANY_CURRENCY = source.DEAL_AMOUNT_IN_COMPANY_CURRENCY,
-                target.DEAL_TYPE = source.DEAL_TYPE,
-                target.SPECIAL_FIELDS_UPDATED_ON = source.SPECIAL_FIELDS_UPDATED_ON,
-                target.WORK_AHEAD = source.WORK_AHEAD,
-                target.LAST_REFRESHED_ON = source.LAST_REFRESHED_ON,
-                target.DELIVERY_LEAD_ID = source.DELIVERY_LEAD_ID,
-                target.DELIVERY_LEAD_EMAIL = source.DELIVERY_LEAD_EMAIL,
-                target.DELIVERY_LEAD_NAME = source.DELIVERY_LEAD_NAME,
-                target.SOLUTION_LEAD_ID = source.SOLUTION_LEAD_ID,
-                target.SOLUTION_LEAD_EMAIL = source.SOLUTION_LEAD_EMAIL,
-                target.SOLUTION_LEAD_NAME = source.SOLUTION_LEAD_NAME,
-                target.REVENUE_TYPE = source.REVENUE_TYPE,
-                target.CURRENCY = source.CURRENCY,
-                target.BOOK_LEADS_2026 = source.BOOK_LEADS_2026,
-                target.BOOK_2026_EMAIL = source.BOOK_2026_EMAIL,
-                target.OFFERING = source.OFFERING,
-                target.DESCRIPTION = source.DESCRIPTION,
-                target.TECH_INVOLVED = source.TECH_INVOLVED
-            WHEN NOT MATCHED THEN
-                INSERT (DEAL_ID, DEAL_NAME, DEAL_OWNER, DEAL_OWNER_ID, DEAL_OWNER_EMAIL, DEAL_OWNER_NAME,
-                DEAL_STAGE_ID, DEAL_STAGE_NAME, COMPANY_ID, COMPANY_NAME, DEAL_TO_COMPANY_ASSOCIATIONS,
-                PIPELINE_ID, PROJECT_START_DATE, PROJECT_CLOSE_DATE, ENGAGEMENT_TYPE, DURATION_IN_MONTHS,
-                DEAL_COLLABORATORS, DEAL_CREATED_ON, DEAL_UPDATED_ON, IS_ARCHIVED, COMPANY_DOMAIN, NS_PROJECT_ID,
-                DEAL_AMOUNT_IN_COMPANY_CURRENCY, DEAL_TYPE, SPECIAL_FIELDS_UPDATED_ON, WORK_AHEAD, LAST_REFRESHED_ON,
-                DELIVERY_LEAD_ID, DELIVERY_LEAD_EMAIL, DELIVERY_LEAD_NAME, SOLUTION_LEAD_ID, SOLUTION_LEAD_EMAIL,
-                SOLUTION_LEAD_NAME, REVENUE_TYPE, CURRENCY, BOOK_LEADS_2026, BOOK_2026_EMAIL, OFFERING,
-                DESCRIPTION, TECH_INVOLVED)
-                VALUES (source.DEAL_ID, source.DEAL_NAME, source.DEAL_OWNER, source.DEAL_OWNER_ID,
-                source.DEAL_OWNER_EMAIL, source.DEAL_OWNER_NAME, source.DEAL_STAGE_ID, source.DEAL_STAGE_NAME,
-                source.COMPANY_ID, source.COMPANY_NAME, source.DEAL_TO_COMPANY_ASSOCIATIONS, source.PIPELINE_ID,
-                source.PROJECT_START_DATE, source.PROJECT_CLOSE_DATE, source.ENGAGEMENT_TYPE, source.DURATION_IN_MONTHS,
-                source.DEAL_COLLABORATORS, source.DEAL_CREATED_ON, source.DEAL_UPDATED_ON, source.IS_ARCHIVED,
-                source.COMPANY_DOMAIN, source.NS_PROJECT_ID, source.DEAL_AMOUNT_IN_COMPANY_CURRENCY, source.DEAL_TYPE,
-                source.SPECIAL_FIELDS_UPDATED_ON, source.WORK_AHEAD, source.LAST_REFRESHED_ON, source.DELIVERY_LEAD_ID,
-                source.DELIVERY_LEAD_EMAIL, source.DELIVERY_LEAD_NAME, source.SOLUTION_LEAD_ID,
-                source.SOLUTION_LEAD_EMAIL, source.SOLUTION_LEAD_NAME, source.REVENUE_TYPE, source.CURRENCY,
-                source.BOOK_LEADS_2026, source.BOOK_2026_EMAIL, source.OFFERING,
-                source.DESCRIPTION, source.TECH_INVOLVED)
-        """
-                          )
-        print(f"Done - Deals Updated/Created Since: {sync_from}")
-        # #####################################################################
-        sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE LINE_ITEMS_TEMP LIKE {SF_LINE_ITEMS_TABLE}")
-        sf_cursor.executemany("""INSERT INTO LINE_ITEMS_TEMP (LINE_ITEM_ID, NAME, PRICE, QUANTITY, AMOUNT, CREATED_ON, UPDATED_ON, DEAL_ID, CURRENCY)
-            VALUES (%(id)s, %(name)s, %(price)s, %(quantity)s, %(amount)s, %(created_at)s, %(updated_at)s, %(deal_id)s, %(currency)s)""",
-                              line_items)
-        sf_cursor.execute(f"DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE DEAL_ID IN (%(line_items_deals)s)",
-                          {'line_items_deals': line_items_deals})
-
-        sf_cursor.execute(f"""
-            MERGE INTO {SF_LINE_ITEMS_TABLE} AS target
-            USING LINE_ITEMS_TEMP AS source
-            ON target.LINE_ITEM_ID = source.LINE_ITEM_ID
-            WHEN MATCHED THEN
-                UPDATE SET target.NAME = source.NAME,
-                target.PRICE = source.PRICE,
-                target.QUANTITY = source.QUANTITY,
-                target.AMOUNT = source.AMOUNT,
-                target.CREATED_ON = source.CREATED_ON,
-                target.UPDATED_ON = source.UPDATED_ON,
-                target.DEAL_ID = source.DEAL_ID,
-                target.CURRENCY = source.CURRENCY
-            WHEN NOT MATCHED THEN
-                INSERT (LINE_ITEM_ID, NAME, PRICE, QUANTITY, AMOUNT, CREATED_ON, UPDATED_ON, DEAL_ID, CURRENCY)
-                VALUES (source.LINE_ITEM_ID, source.NAME, source.PRICE, source.QUANTITY, source.AMOUNT,
-                source.CREATED_ON, source.UPDATED_ON, source.DEAL_ID, source.CURRENCY)
-        """
-                          )
-        print("done line items insert")
-
-        # #####################################################################
+        async with AsyncHubspotClient() as client:
+            pipeline_stages_task = asyncio.ensure_future(asyncio.to_thread(get_pipeline_stages))
+            transforms = []
+            async for page in client.iter_deal_pages(formatted_datetime, deal_ids=deal_ids,
+                                                     shards=event.get('shards', HUBSPOT_SEARCH_SHARDS)):
+                # a deal seen again in a later page is only transformed again when that copy is newer
+                deals = []
+                for deal in page:
+                    updated_at = deal.get('updatedAt', '')
+                    if deal['id'] in deal_updated_at and updated_at <= deal_updated_at[deal['id']]:
+                        continue
+                    deal_updated_at[deal['id']] = updated_at
+                    deals.append(deal)
+                if deals:
+                    transforms.append(asyncio.ensure_future(transform_page(deals)))
+            await asyncio.gather(*transforms)
+
+        if not deal_updated_at:
+            print(f"No Deals Updated/Created Since: {formatted_datetime}")
+            return
+        deal_columns, line_items, line_items_deals = newest_copies(transformed, deal_updated_at)
+        print(f"Deals Updated/Created Since: {formatted_datetime} - {len(deal_updated_at)}, "
+              f"{len(deal_columns['DEAL_ID'])} changed")
+        load_deals(sf_conn.cursor(), deal_columns, line_items, line_items_deals)
+        sf_conn.commit()
     except Exception as ex:
         print(traceback.format_exc())
         sf_conn.rollback()
@@ -321,5 +399,287 @@ def sync_deals(event):
         raise
 
     finally:
-        sf_conn.commit()
-        close_sf_connection(sf_conn)
+        release_sf_connection(sf_conn)
+
+
+def newest_copies(transformed, deal_updated_at):
+    """
+    Join the pages transformed by sync_deals_async, keeping only the newest copy of every deal.
+    :param transformed: (deals, the deals among them whose row changed, their build_deal_columns, line items
+        by deal id) of every page
+    :param deal_updated_at: deal id -> updatedAt of its newest copy
+    :return: deal columns, line items and the deal ids whose line items they replace
+    """
+    deal_column_parts = []
+    line_items = []
+    line_items_deals = []
+    for deals, changed_deals, deal_columns, deals_with_line_items in transformed:
+        newest = [index for index, deal in enumerate(changed_deals)
+                  if deal.get('updatedAt', '') == deal_updated_at[deal['id']]]
+        deal_column_parts.append({key: [deal_columns[key][index] for index in newest] for key in DEALS_TEMP_KEYS})
+        newest_ids = {deal['id'] for deal in deals if deal.get('updatedAt', '') == deal_updated_at[deal['id']]}
+        for deal_id, line_items_of_deal in deals_with_line_items.items():
+            if deal_id in newest_ids:
+                line_items.extend(clean_line_items(line_items_of_deal))
+                line_items_deals.append(deal_id)
+    return concat_columns(deal_column_parts), line_items, line_items_deals
+
+
+def clean_line_items(line_items):
+    for line_item in line_items:
+        for key in ['price', 'quantity', 'amount']:
+            if line_item[key] is not None and line_item[key].strip() == '':
+                print(f"Field {key} is missing for Line Item: {line_item['id']}, value is {line_item[key]}")
+                line_item[key] = None
+    return line_items
+
+
+# values that are blank strings are loaded as NULL
+TIMESTAMP_DEAL_COLUMNS = ("PROJECT_START_DATE", "PROJECT_CLOSE_DATE", "DEAL_CREATED_ON", "DEAL_UPDATED_ON")
+NUMBER_DEAL_COLUMNS = ("DURATION_IN_MONTHS", "DEAL_AMOUNT_IN_COMPANY_CURRENCY", "DEAL_OWNER_ID", "COMPANY_ID",
+                       "PIPELINE_ID", "NS_PROJECT_ID", "DELIVERY_LEAD_ID", "SOLUTION_LEAD_ID")
+
+
+def json_column(keys, value_of, dumped=None):
+    """
+    dumps_column(value_of(key)) for every key, serialising each distinct key once.
+    :param dumped: key -> JSON already serialised, e.g. by earlier chunks of the same sync
+    """
+    dumped = {} if dumped is None else dumped
+    column = []
+    for key in keys:
+        if key not in dumped:
+            dumped[key] = dumps_column(value_of(key))
+        column.append(dumped[key])
+    return column
+
+
+def blanks_to_none(column, values):
+    cleaned = [None if isinstance(value, str) and not value.strip() else value for value in values]
+    missing = sum(1 for value, clean in zip(values, cleaned) if value is not None and clean is None)
+    if missing:
+        print(f"Field {column} is missing for {missing} Deals")
+    return cleaned
+
+
+def build_deal_columns(deals, deals_with_companies, owner_details, pipeline_stages, json_cache=None):
+    """
+    DEALS_TEMP values of many deals, built one column at a time instead of one dict per deal. Owner,
+    company and collaborator JSON is serialised once per distinct value, and the sync timestamps are
+    left to DEALS_TEMP_EXPRESSIONS.
+    :param json_cache: column -> key -> JSON, pass the same dict for every chunk of a sync
+    :return: DEALS_TEMP key -> list of values, in the order of deals
+    """
+    json_cache = {} if json_cache is None else json_cache
+    properties = [deal['properties'] for deal in deals]
+
+    def prop(name):
+        return [deal_properties.get(name) for deal_properties in properties]
+
+    deal_ids = [deal['id'] for deal in deals]
+    owner_ids, delivery_lead_ids, solution_lead_ids = prop('hubspot_owner_id'), prop('delivery_lead'), prop('solution_lead')
+    owners = [owner_details.get(owner_id, {}) for owner_id in owner_ids]
+    delivery_leads = [owner_details.get(owner_id, {}) for owner_id in delivery_lead_ids]
+    solution_leads = [owner_details.get(owner_id, {}) for owner_id in solution_lead_ids]
+    companies = [deals_with_companies.get(deal_id, {}) for deal_id in deal_ids]
+    companies_by_id = {company.get('id'): company for company in companies}
+    book_leads = prop('n2026_book')
+
+    columns = {
+        "DEAL_ID": deal_ids,
+        "DEAL_NAME": prop('dealname'),
+        "DEAL_OWNER": json_column(owner_ids, lambda owner_id: owner_details.get(owner_id, {}),
+                                  json_cache.setdefault("DEAL_OWNER", {})),
+        "DEAL_OWNER_ID": owner_ids,
+        "DEAL_OWNER_EMAIL": [owner.get('email') for owner in owners],
+        "DEAL_OWNER_NAME": [owner.get('name') for owner in owners],
+        "DELIVERY_LEAD_ID": delivery_lead_ids,
+        "DELIVERY_LEAD_EMAIL": [owner.get('email') for owner in delivery_leads],
+        "DELIVERY_LEAD_NAME": [owner.get('name') for owner in delivery_leads],
+        "SOLUTION_LEAD_ID": solution_lead_ids,
+        "SOLUTION_LEAD_EMAIL": [owner.get('email') for owner in solution_leads],
+        "SOLUTION_LEAD_NAME": [owner.get('name') for owner in solution_leads],
+        "DEAL_STAGE_ID": prop('dealstage'),
+        "DEAL_STAGE_NAME": [pipeline_stages.get(deal_properties['pipeline'], {}).get(deal_properties['dealstage'])
+                            for deal_properties in properties],
+        "COMPANY_ID": [company.get('id') for company in companies],
+        "COMPANY_NAME": [company.get('name') for company in companies],
+        "DEAL_TO_COMPANY_ASSOCIATIONS": json_column([company.get('id') for company in companies],
+                                                    companies_by_id.get,
+                                                    json_cache.setdefault("DEAL_TO_COMPANY_ASSOCIATIONS", {})),
+        "PIPELINE_ID": prop('pipeline'),
+        "PROJECT_START_DATE": prop('expected_project_start_date'),
+        "PROJECT_CLOSE_DATE": prop('closedate'),
+        "ENGAGEMENT_TYPE": prop('engagement_type__cloned_'),
+        "DURATION_IN_MONTHS": prop('expected_project_duration_in_months'),
+        "DEAL_COLLABORATORS": json_column(
+            prop('hs_all_collaborator_owner_ids'),
+            lambda collaborators: [owner_details.get(collaborator_id) for collaborator_id in collaborators.split(";")]
+            if collaborators else [],
+            json_cache.setdefault("DEAL_COLLABORATORS", {})),
+        "DEAL_CREATED_ON": prop('hs_createdate'),
+        "DEAL_UPDATED_ON": prop('hs_lastmodifieddate'),
+        "IS_ARCHIVED": [False] * len(deals),
+        "COMPANY_DOMAIN": [company.get('domain') for company in companies],
+        "NS_PROJECT_ID": prop('ns_project_id__finance_only_'),
+        "DEAL_AMOUNT_IN_COMPANY_CURRENCY": prop('amount'),
+        "DEAL_TYPE": prop('dealtype'),
+        "WORK_AHEAD": ['No' if work_ahead in ('No', 'blank') else work_ahead for work_ahead in prop('work_ahead')],
+        "REVENUE_TYPE": prop('revenue_type'),
+        "CURRENCY": [currency or 'USD' for currency in prop('deal_currency_code')],
+        "BOOK_LEADS_2026": book_leads,
+        "BOOK_2026_EMAIL": [get_2026_book_lead_email(book_lead) for book_lead in book_leads],
+        "OFFERING": prop('offering'),
+        "DESCRIPTION": prop('description'),
+        "TECH_INVOLVED": prop('tech_involved'),
+    }
+    for column in TIMESTAMP_DEAL_COLUMNS + NUMBER_DEAL_COLUMNS:
+        columns[column] = blanks_to_none(column, columns[column])
+    columns["ROW_HASH"] = row_hashes(columns)
+    columns["PROPERTIES_HASH"] = properties_hashes(properties)
+    return columns
+
+
+def concat_columns(parts):
+    """Join the columns of build_deal_columns calls, in order."""
+    return {key: [value for part in parts for value in part[key]] for key in DEALS_TEMP_KEYS}
+
+
+def load_deals(sf_cursor, deal_columns, line_items, line_items_deals):
+    """
+    Upsert deal rows and line items through temp tables, then replace the line items of line_items_deals.
+    """
+    #     create temp table for upsert
+    ensure_hash_columns(sf_cursor)
+    sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE DEALS_TEMP LIKE {SF_DEALS_TABLE}")
+    sf_cursor.execute(f"CREATE OR REPLACE TEMPORARY TABLE LINE_ITEMS_TEMP LIKE {SF_LINE_ITEMS_TABLE}")
+    # insert this data into temp table
+    print("Inserting data into temp table")
+    stage_deals(sf_cursor, "DEALS_TEMP", "LINE_ITEMS_TEMP", deal_columns, line_items)
+    merge_deals_temp(sf_cursor)
+    print(f"Done - Upserted {len(deal_columns['DEAL_ID'])} Deals")
+    merge_line_items_temp(sf_cursor, line_items_deals)
+
+
+def stage_deals(sf_cursor, deals_table, line_items_table, deal_columns, line_items):
+    """Append deal rows and line items to tables shaped like HUBSPOT_DEALS and HUBSPOT_DEAL_LINE_ITEMS."""
+    if use_copy(deal_columns["DEAL_ID"]):
+        copy_columns_into(sf_cursor, deals_table, DEALS_TEMP_COLUMNS, deal_columns, DEALS_TEMP_EXPRESSIONS)
+    elif deal_columns["DEAL_ID"]:
+        sf_cursor.executemany(insert_statement(deals_table, DEALS_TEMP_KEYS, DEALS_TEMP_EXPRESSIONS),
+                              column_rows(deal_columns, DEALS_TEMP_KEYS))
+    if use_copy(line_items):
+        copy_rows_into(sf_cursor, line_items_table, LINE_ITEMS_TEMP_COLUMNS, line_items)
+    elif line_items:
+        sf_cursor.executemany(insert_statement(line_items_table, tuple(column for column, _ in LINE_ITEMS_TEMP_COLUMNS)),
+                              row_values(line_items, [key for _, key in LINE_ITEMS_TEMP_COLUMNS]))
+
+
+def merge_deals_temp(sf_cursor):
+    """Upsert DEALS_TEMP into HUBSPOT_DEALS, rows whose hashes did not change are left alone."""
+    # upsert from temp table to main table
+    print("Upserting data into main table")
+    sf_cursor.execute(f"""
+        MERGE INTO {SF_DEALS_TABLE} AS target
+        USING DEALS_TEMP AS source
+        ON target.DEAL_ID = source.DEAL_ID
+        WHEN MATCHED AND {ROW_CHANGED_CONDITION} THEN
+            UPDATE SET target.DEAL_NAME = source.DEAL_NAME,
+            target.DEAL_OWNER = source.DEAL_OWNER,
+            target.DEAL_OWNER_ID = source.DEAL_OWNER_ID,
+            target.DEAL_OWNER_EMAIL = source.DEAL_OWNER_EMAIL,
+            target.DEAL_OWNER_NAME = source.DEAL_OWNER_NAME,
+            target.DEAL_STAGE_ID = source.DEAL_STAGE_ID,
+            target.DEAL_STAGE_NAME = source.DEAL_STAGE_NAME,
+            target.COMPANY_ID = source.COMPANY_ID,
+            target.COMPANY_NAME = source.COMPANY_NAME,
+            target.DEAL_TO_COMPANY_ASSOCIATIONS = source.DEAL_TO_COMPANY_ASSOCIATIONS,
+            target.PIPELINE_ID = source.PIPELINE_ID,
+            target.PROJECT_START_DATE = source.PROJECT_START_DATE,
+            target.PROJECT_CLOSE_DATE = source.PROJECT_CLOSE_DATE,
+            target.ENGAGEMENT_TYPE = source.ENGAGEMENT_TYPE,
+            target.DURATION_IN_MONTHS = source.DURATION_IN_MONTHS,
+            target.DEAL_COLLABORATORS = source.DEAL_COLLABORATORS,
+            target.DEAL_CREATED_ON = source.DEAL_CREATED_ON,
+            target.DEAL_UPDATED_ON = source.DEAL_UPDATED_ON,
+            target.IS_ARCHIVED = source.IS_ARCHIVED,
+            target.COMPANY_DOMAIN = source.COMPANY_DOMAIN,
+            target.NS_PROJECT_ID = source.NS_PROJECT_ID,
+            target.DEAL_AMOUNT_IN_COMPANY_CURRENCY = source.DEAL_AMOUNT_IN_COMPANY_CURRENCY,
+            target.DEAL_TYPE = source.DEAL_TYPE,
+            target.SPECIAL_FIELDS_UPDATED_ON = source.SPECIAL_FIELDS_UPDATED_ON,
+            target.WORK_AHEAD = source.WORK_AHEAD,
+            target.LAST_REFRESHED_ON = source.LAST_REFRESHED_ON,
+            target.DELIVERY_LEAD_ID = source.DELIVERY_LEAD_ID,
+            target.DELIVERY_LEAD_EMAIL = source.DELIVERY_LEAD_EMAIL,
+            target.DELIVERY_LEAD_NAME = source.DELIVERY_LEAD_NAME,
+            target.SOLUTION_LEAD_ID = source.SOLUTION_LEAD_ID,
+            target.SOLUTION_LEAD_EMAIL = source.SOLUTION_LEAD_EMAIL,
+            target.SOLUTION_LEAD_NAME = source.SOLUTION_LEAD_NAME,
+            target.REVENUE_TYPE = source.REVENUE_TYPE,
+            target.CURRENCY = source.CURRENCY,
+            target.BOOK_LEADS_2026 = source.BOOK_LEADS_2026,
+            target.BOOK_2026_EMAIL = source.BOOK_2026_EMAIL,
+            target.OFFERING = source.OFFERING,
+            target.DESCRIPTION = source.DESCRIPTION,
+            target.TECH_INVOLVED = source.TECH_INVOLVED,
+            target.ROW_HASH = source.ROW_HASH,
+            target.PROPERTIES_HASH = source.PROPERTIES_HASH
+        WHEN NOT MATCHED THEN
+            INSERT (DEAL_ID, DEAL_NAME, DEAL_OWNER, DEAL_OWNER_ID, DEAL_OWNER_EMAIL, DEAL_OWNER_NAME,
+            DEAL_STAGE_ID, DEAL_STAGE_NAME, COMPANY_ID, COMPANY_NAME, DEAL_TO_COMPANY_ASSOCIATIONS,
+            PIPELINE_ID, PROJECT_START_DATE, PROJECT_CLOSE_DATE, ENGAGEMENT_TYPE, DURATION_IN_MONTHS,
+            DEAL_COLLABORATORS, DEAL_CREATED_ON, DEAL_UPDATED_ON, IS_ARCHIVED, COMPANY_DOMAIN, NS_PROJECT_ID,
+            DEAL_AMOUNT_IN_COMPANY_CURRENCY, DEAL_TYPE, SPECIAL_FIELDS_UPDATED_ON, WORK_AHEAD, LAST_REFRESHED_ON,
+            DELIVERY_LEAD_ID, DELIVERY_LEAD_EMAIL, DELIVERY_LEAD_NAME, SOLUTION_LEAD_ID, SOLUTION_LEAD_EMAIL,
+            SOLUTION_LEAD_NAME, REVENUE_TYPE, CURRENCY, BOOK_LEADS_2026, BOOK_2026_EMAIL, OFFERING,
+            DESCRIPTION, TECH_INVOLVED, ROW_HASH, PROPERTIES_HASH)
+            VALUES (source.DEAL_ID, source.DEAL_NAME, source.DEAL_OWNER, source.DEAL_OWNER_ID,
+            source.DEAL_OWNER_EMAIL, source.DEAL_OWNER_NAME, source.DEAL_STAGE_ID, source.DEAL_STAGE_NAME,
+            source.COMPANY_ID, source.COMPANY_NAME, source.DEAL_TO_COMPANY_ASSOCIATIONS, source.PIPELINE_ID,
+            source.PROJECT_START_DATE, source.PROJECT_CLOSE_DATE, source.ENGAGEMENT_TYPE, source.DURATION_IN_MONTHS,
+            source.DEAL_COLLABORATORS, source.DEAL_CREATED_ON, source.DEAL_UPDATED_ON, source.IS_ARCHIVED,
+            source.COMPANY_DOMAIN, source.NS_PROJECT_ID, source.DEAL_AMOUNT_IN_COMPANY_CURRENCY, source.DEAL_TYPE,
+            source.SPECIAL_FIELDS_UPDATED_ON, source.WORK_AHEAD, source.LAST_REFRESHED_ON, source.DELIVERY_LEAD_ID,
+            source.DELIVERY_LEAD_EMAIL, source.DELIVERY_LEAD_NAME, source.SOLUTION_LEAD_ID,
+            source.SOLUTION_LEAD_EMAIL, source.SOLUTION_LEAD_NAME, source.REVENUE_TYPE, source.CURRENCY,
+            source.BOOK_LEADS_2026, source.BOOK_2026_EMAIL, source.OFFERING,
+            source.DESCRIPTION, source.TECH_INVOLVED, source.ROW_HASH, source.PROPERTIES_HASH)
+    """
+                      )
+
+
+def merge_line_items_temp(sf_cursor, line_items_deals=None):
+    """
+    Replace the line items of line_items_deals with LINE_ITEMS_TEMP.
+    :param line_items_deals: deal ids, None for every deal in LINE_ITEMS_TEMP
+    """
+    # #####################################################################
+    if line_items_deals is None:
+        sf_cursor.execute(f"DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE DEAL_ID IN (SELECT DEAL_ID FROM LINE_ITEMS_TEMP)")
+    else:
+        # in chunks, the IN list of a whole async sync can be longer than Snowflake accepts
+        for deal_ids in chunks(line_items_deals, 1000):
+            sf_cursor.execute(f"DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE DEAL_ID IN ({placeholders(len(deal_ids))})",
+                              deal_ids)
+
+    sf_cursor.execute(f"""
+        MERGE INTO {SF_LINE_ITEMS_TABLE} AS target
+        USING LINE_ITEMS_TEMP AS source
+        ON target.LINE_ITEM_ID = source.LINE_ITEM_ID
+        WHEN MATCHED THEN
+            UPDATE SET target.NAME = source.NAME,
+            target.PRICE = source.PRICE,
+            target.QUANTITY = source.QUANTITY,
+            target.AMOUNT = source.AMOUNT,
+            target.CREATED_ON = source.CREATED_ON,
+            target.UPDATED_ON = source.UPDATED_ON,
+            target.DEAL_ID = source.DEAL_ID,
+            target.CURRENCY = source.CURRENCY
+        WHEN NOT MATCHED THEN
+            INSERT (LINE_ITEM_ID, NAME, PRICE, QUANTITY, AMOUNT, CREATED_ON, UPDATED_ON, DEAL_ID, CURRENCY)
+            VALUES (source.LINE_ITEM_ID, source.NAME, source.PRICE, source.QUANTITY, source.AMOUNT,
+            source.CREATED_ON, source.UPDATED_ON, source.DEAL_ID, source.CURRENCY)
+    """
+                      )
+    print("done line items insert")
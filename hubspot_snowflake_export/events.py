@@ -2,34 +2,43 @@ from datetime import datetime, timedelta
 
 import pytz
 
-from .handle_deal import handle_deal, handle_deal_upsert
-from .utils.config import SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE
-from .utils.hubspot_api import fetch_updated_or_created_deals, get_deal
-from .utils.s3 import get_deals_last_sync_info, update_deals_last_sync_time, set_deal_sync_status
-from .utils.snowflake_db import close_sf_connection, create_sf_connection
+from .batch_upsert import upsert_deals_in_batches
+from .handle_deal import handle_deal
+from .utils.config import SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE, SYNC_WATERMARK_LAG_SECONDS
+from .utils.hubspot_api import fetch_updated_or_created_deals, get_deal, get_deals_by_ids_batch
+from .utils.s3 import get_deals_last_sync_info, update_deals_last_sync_time, set_deal_sync_status, \
+    get_watermark, advance_watermark
+from .utils.snowflake_db import release_sf_connection, get_sf_connection
 
 
 def schedule_fetch(event_job):
-    last_sync_info = get_deals_last_sync_info()
-    last_updated_on = (datetime.fromisoformat(last_sync_info['last_updated_on'])
-                       .astimezone(pytz.utc) - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    event_job = event_job.upper()
+    last_updated_on = get_watermark(event_job)
+    if not last_updated_on:
+        # no watermark saved yet, start from the last sync with a minute of overlap
+        last_sync_info = get_deals_last_sync_info()
+        last_updated_on = (datetime.fromisoformat(last_sync_info['last_updated_on'])
+                           .astimezone(pytz.utc) - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    # taken before the search, deals modified while it runs are fetched again by the next one
+    fetch_started_on = (datetime.now(pytz.utc) - timedelta(seconds=SYNC_WATERMARK_LAG_SECONDS)) \
+        .strftime('%Y-%m-%dT%H:%M:%SZ')
     try:
         deals = fetch_updated_or_created_deals(last_updated_on)
 
         if len(deals) > 0:
             print(f"Found {len(deals)} - Created/Updated Deal(s) since {last_updated_on}")
-            sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+            sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
             sf_cursor = sf_conn.cursor()
             try:
-                for deal in deals:
-                    handle_deal_upsert(deal, sf_cursor)
-                close_sf_connection(sf_conn)
-                update_deals_last_sync_time(event_job.upper(), "SUCCESS")
+                upsert_deals_in_batches(deals, sf_cursor)
+                release_sf_connection(sf_conn)
+                update_deals_last_sync_time(event_job, "SUCCESS", watermark=fetch_started_on)
                 print(f"Updated {len(deals)} - Created/Updated Deal(s) since {last_updated_on}")
             except Exception as ex:
-                close_sf_connection(sf_conn)
+                release_sf_connection(sf_conn)
                 raise ex
         else:
+            advance_watermark(event_job, fetch_started_on)
             print("No Created/Updated Deals Found. Exiting.")
         return "success"
 
@@ -56,15 +65,14 @@ def back_fill_deals(event):
     updated_deals_since = fetch_updated_or_created_deals(sync_from)
     if len(updated_deals_since) > 0:
         print(f"Deals Updated/Created Since: {sync_from} - {len(updated_deals_since)}")
-        sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+        sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
         sf_cursor = sf_conn.cursor()
         try:
-            for deal in updated_deals_since:
-                handle_deal_upsert(deal, sf_cursor)
-            close_sf_connection(sf_conn)
+            upsert_deals_in_batches(updated_deals_since, sf_cursor, force=event.get('force', False))
+            release_sf_connection(sf_conn)
             print(f"Done - Deals Updated/Created Since: {sync_from}")
         except Exception as ex:
-            close_sf_connection(sf_conn)
+            release_sf_connection(sf_conn)
             raise ex
     else:
         print(f"No Deals Updated/Created Since: {sync_from}")
@@ -85,15 +93,14 @@ def sync_deals(event):
         updated_deals_since = fetch_updated_or_created_deals(last_updated_on)
         if len(updated_deals_since) > 0:
             print(f"Deals Updated/Created Since: {last_updated_on} - {len(updated_deals_since)}")
-            sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+            sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
             sf_cursor = sf_conn.cursor()
             try:
-                for deal in updated_deals_since:
-                    handle_deal_upsert(deal, sf_cursor)
+                upsert_deals_in_batches(updated_deals_since, sf_cursor)
                 print(f"Done - Deals Updated/Created Since: {sync_from}")
-                close_sf_connection(sf_conn)
+                release_sf_connection(sf_conn)
             except Exception as ex:
-                close_sf_connection(sf_conn)
+                release_sf_connection(sf_conn)
                 raise ex
         else:
             print(f"No Deals Updated/Created Since: {sync_from}")
@@ -112,15 +119,15 @@ def single_deal_fetch(event):
     if not deal_id and len(deal_id.trim()) < 0:
         print("Missing DealId in the request. Exiting.")
         return
-    sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
     sf_cursor = sf_conn.cursor()
     try:
         deal_details = get_deal(deal_id)
-        handle_deal(deal_details, sf_cursor)
-        close_sf_connection(sf_conn)
+        handle_deal(deal_details, sf_cursor, force=event.get('force', False))
+        release_sf_connection(sf_conn)
         return "success"
     except Exception as ex:
-        close_sf_connection(sf_conn)
+        release_sf_connection(sf_conn)
         print(f"Failed Sync - {ex}")
         return "failed"
 
@@ -131,26 +138,15 @@ def bulk_deals_fetch(event):
     if not deal_ids and len(deal_ids) < 1:
         print("Missing DealId(s) in the request. Exiting.")
         return
-    sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
     sf_cursor = sf_conn.cursor()
     try:
-        for deal_id in deal_ids:
-            deal_details = get_deal(deal_id)
-            handle_deal(deal_details, sf_cursor)
-        close_sf_connection(sf_conn)
+        upsert_deals_in_batches(get_deals_by_ids_batch(list(set(deal_ids))), sf_cursor,
+                                force=event.get('force', False))
+        release_sf_connection(sf_conn)
     except Exception as ex:
-        close_sf_connection(sf_conn)
+        release_sf_connection(sf_conn)
         print(f"Failed Sync - {ex}")
         return "failed"
 
     return "success"
-
-
-def handle_sync_status():
-    last_sync_info = get_deals_last_sync_info()
-
-    if last_sync_info['sync_status'] == 'PROCESSING':
-        return 'PROCESSING'
-    else:
-        set_deal_sync_status("PROCESSING", last_sync_info)
-        return last_sync_info['last_updated_on']
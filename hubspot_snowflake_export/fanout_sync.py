@@ -0,0 +1,284 @@
+"""
+Fan-out of a full sync over parallel worker invocations.
+
+FANOUT_SYNC (the coordinator) splits the hs_lastmodifieddate range from sync_from to now, or a list of
+deal ids, into one shard per worker, saves the plan under fanout-jobs/<fanout_id>/ in S3 and invokes
+the function once per shard with SYNC_SHARD. Range shards are balanced by the number of deals HubSpot's
+search counts in them, most deals are modified recently. Every worker syncs its shard into its own
+staging tables and records its shard as done. The worker that finds every shard done claims the merge
+with a conditional S3 write and upserts all staging tables into HUBSPOT_DEALS and
+HUBSPOT_DEAL_LINE_ITEMS in one step, a deal synced by two workers keeps its latest version. A range
+fan-out then catches up on the deals modified since its plan was made, while the workers ran.
+
+Outside Lambda (no context) the workers run in a process pool instead of their own invocations.
+A FANOUT_SYNC with the fanout_id of an earlier run invokes the shards that failed or never started
+again, shards still processing are left to their workers. When every shard is done it merges them,
+unless the merge was claimed already and did not fail.
+"""
+import json
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from .bulk_events_new import load_deal_pages, merge_deals_temp, merge_line_items_temp, to_search_datetime
+from .utils.aws import get_client
+from .utils.concurrency import map_concurrently, chunks
+from .utils.config import SF_DEALS_TABLE, SF_LINE_ITEMS_TABLE, SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE, \
+    HUBSPOT_SEARCH_SHARDS, FANOUT_WORKERS
+from .utils.hubspot_api import fetch_updated_or_created_deals, iter_deals_by_modified_windows, \
+    count_deals_in_windows, split_window, to_epoch_ms
+from .utils.row_hash import ensure_hash_columns
+from .utils.s3 import get_json_object, put_json_object, create_json_object
+from .utils.snowflake_db import get_sf_connection, release_sf_connection
+from .utils.sync_jobs import now_ms, to_iso_ms
+
+FANOUT_KEY_PREFIX = 'fanout-jobs/'
+# returned by start_fanout when the workers run in their own invocations
+FANOUT_STARTED = "started"
+# count windows per worker when balancing range shards, and rounds of splitting the crowded ones
+PROBES_PER_WORKER = 4
+PROBE_ROUNDS = 3
+
+
+def fanout_key(fanout_id, name):
+    return f"{FANOUT_KEY_PREFIX}{fanout_id}/{name}.json"
+
+
+def staging_tables(fanout_id, index):
+    return f"{SF_DEALS_TABLE}_STAGE_{fanout_id}_{index}", f"{SF_LINE_ITEMS_TABLE}_STAGE_{fanout_id}_{index}"
+
+
+def balanced_windows(start_ms, end_ms, workers):
+    """
+    Split [start_ms, end_ms) into at most `workers` windows with about as many deals each.
+    :return: (start, end) windows in epoch ms
+    """
+    windows = split_window(start_ms, end_ms, workers * PROBES_PER_WORKER)
+    counts = count_deals_in_windows(windows)
+    for _ in range(PROBE_ROUNDS):
+        crowded = sum(counts) / workers / 2
+        if not any(count > crowded and hi - lo > 1 for (lo, hi), count in zip(windows, counts)):
+            break
+        refined = []
+        for (lo, hi), count in zip(windows, counts):
+            refined.append([(lo, hi)] if count <= crowded or hi - lo <= 1 else split_window(lo, hi, PROBES_PER_WORKER))
+        recount = [window for parts in refined if len(parts) > 1 for window in parts]
+        recounted = dict(zip(recount, count_deals_in_windows(recount)))
+        windows, counts = zip(*[(window, recounted[window] if len(parts) > 1 else count)
+                                for parts, count in zip(refined, counts) for window in parts])
+    total = sum(counts)
+    if not total:
+        return [(start_ms, end_ms)]
+    shards = []
+    shard_start_ms = start_ms
+    seen = 0
+    for (_, hi), count in zip(windows, counts):
+        seen += count
+        if seen >= total * (len(shards) + 1) / workers and len(shards) < workers - 1 and hi < end_ms:
+            shards.append((shard_start_ms, hi))
+            shard_start_ms = hi
+    shards.append((shard_start_ms, end_ms))
+    return shards
+
+
+def plan_shards(event, workers):
+    deal_ids = event.get('deal_ids', [])
+    if deal_ids:
+        deal_ids = list(dict.fromkeys(str(deal_id) for deal_id in deal_ids))
+        return [{"deal_ids": deal_ids[index::workers]} for index in range(min(workers, len(deal_ids)))]
+    start_ms = to_epoch_ms(to_search_datetime(event['sync_from'])) + 1
+    return [{"start_ms": lo, "end_ms": hi} for lo, hi in balanced_windows(start_ms, now_ms() + 1, workers)]
+
+
+def run_shard(fanout, index):
+    """
+    Sync one shard into its staging tables, created again when the shard is run again.
+    :return: deals synced
+    """
+    shard = fanout["shards"][index]
+    stage = staging_tables(fanout["fanout_id"], index)
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    try:
+        sf_cursor = sf_conn.cursor()
+        ensure_hash_columns(sf_cursor)
+        for table, like in zip(stage, (SF_DEALS_TABLE, SF_LINE_ITEMS_TABLE)):
+            sf_cursor.execute(f"CREATE OR REPLACE TABLE {table} LIKE {like}")
+    finally:
+        release_sf_connection(sf_conn)
+
+    if "deal_ids" in shard:
+        print(f"Shard {index} of {fanout['fanout_id']} - {len(shard['deal_ids'])} deal ids")
+        pages = map_concurrently(
+            lambda deal_ids_batch: fetch_updated_or_created_deals(start_date_time=None, deal_ids=deal_ids_batch),
+            chunks(shard["deal_ids"], 100))
+    else:
+        print(f"Shard {index} of {fanout['fanout_id']} - deals modified from {to_iso_ms(shard['start_ms'])} "
+              f"to {to_iso_ms(shard['end_ms'])}")
+        pages = iter_deals_by_modified_windows(to_iso_ms(shard["start_ms"] - 1), to_iso_ms(shard["end_ms"]),
+                                               shards=fanout["event"].get('shards', HUBSPOT_SEARCH_SHARDS))
+    synced, _ = load_deal_pages(pages, fanout["event"], stage=stage)
+    print(f"Shard {index} of {fanout['fanout_id']} staged {synced} deals")
+    return synced
+
+
+def catch_up(fanout):
+    """
+    Sync the deals modified after the plan's last shard ends, straight into HUBSPOT_DEALS. Runs after the
+    merge so the staged versions of these deals do not overwrite the newer ones.
+    :return: deals synced
+    """
+    since_ms = fanout.get("planned_until_ms")
+    if since_ms is None:
+        return 0
+    until_ms = now_ms()
+    print(f"Catching up {fanout['fanout_id']} on deals modified from {to_iso_ms(since_ms)} to {to_iso_ms(until_ms)}")
+    pages = iter_deals_by_modified_windows(to_iso_ms(since_ms - 1), to_iso_ms(until_ms),
+                                           shards=fanout["event"].get('shards', HUBSPOT_SEARCH_SHARDS))
+    synced, _ = load_deal_pages(pages, fanout["event"])
+    print(f"Caught up {synced} deals of {fanout['fanout_id']}")
+    return synced
+
+
+def merge_shards(fanout):
+    """Upsert every shard's staging tables in one step, then drop them."""
+    tables = [staging_tables(fanout["fanout_id"], index) for index in range(len(fanout["shards"]))]
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    try:
+        sf_cursor = sf_conn.cursor()
+        deals = " UNION ALL ".join(f"SELECT * FROM {deals_table}" for deals_table, _ in tables)
+        sf_cursor.execute(f"""
+            CREATE OR REPLACE TEMPORARY TABLE DEALS_TEMP AS SELECT * FROM ({deals})
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY DEAL_ID ORDER BY DEAL_UPDATED_ON DESC NULLS LAST) = 1
+        """)
+        merge_deals_temp(sf_cursor)
+        line_items = " UNION ALL ".join(f"SELECT * FROM {line_items_table}" for _, line_items_table in tables)
+        sf_cursor.execute(f"""
+            CREATE OR REPLACE TEMPORARY TABLE LINE_ITEMS_TEMP AS SELECT * FROM ({line_items})
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY LINE_ITEM_ID ORDER BY UPDATED_ON DESC NULLS LAST) = 1
+        """)
+        merge_line_items_temp(sf_cursor)
+        sf_conn.commit()
+        for table in [table for pair in tables for table in pair]:
+            sf_cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    except Exception:
+        sf_conn.rollback()
+        raise
+    finally:
+        release_sf_connection(sf_conn)
+    print(f"Merged {len(tables)} shards of {fanout['fanout_id']}")
+
+
+def merge_fanout(fanout, merge_key):
+    """merge_shards and catch_up, recording the outcome in the merge claim object."""
+    try:
+        merge_shards(fanout)
+        synced = catch_up(fanout)
+    except Exception:
+        put_json_object(merge_key, {"status": "FAILED", "error": traceback.format_exc()})
+        raise
+    put_json_object(merge_key, {"status": "DONE", "caught_up": synced})
+    return synced
+
+
+def shard_statuses(fanout):
+    return [get_json_object(fanout_key(fanout["fanout_id"], f"shard-{index}")) or {}
+            for index in range(len(fanout["shards"]))]
+
+
+def invoke_shards(fanout, indexes, context):
+    for index in indexes:
+        get_client('lambda').invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps({'event': 'SYNC_SHARD', 'fanout_id': fanout["fanout_id"], 'shard': index})
+        )
+    print(f"Invoked {len(indexes)} workers for {fanout['fanout_id']}")
+
+
+def start_fanout(event, context=None):
+    """
+    Coordinator of FANOUT_SYNC, event has sync_from or deal_ids and optionally workers.
+    :return: FANOUT_STARTED when the workers run in their own invocations or are still running,
+        otherwise deals synced
+    """
+    if event.get('fanout_id'):
+        fanout = get_json_object(fanout_key(event['fanout_id'], "fanout"))
+        if fanout is None:
+            raise ValueError(f"Fan-out {event['fanout_id']} not found")
+        statuses = shard_statuses(fanout)
+        # shards still PROCESSING have a running worker, which merges them when it is the last to finish
+        indexes = [index for index, status in enumerate(statuses) if status.get("status") in (None, "FAILED")]
+        pending = sum(status.get("status") != "DONE" for status in statuses)
+        print(f"Resuming fan-out {fanout['fanout_id']}, {pending} of {len(statuses)} shards not done, "
+              f"{len(indexes)} to run again")
+        synced = sum(status.get("synced", 0) for status in statuses)
+        if not pending:
+            # every shard was staged, merge them unless a worker claimed the merge and did not fail
+            merge_key = fanout_key(fanout["fanout_id"], "merge")
+            merge = get_json_object(merge_key)
+            if merge is not None and merge.get("status") != "FAILED":
+                print(f"Fan-out {fanout['fanout_id']} merge is {merge.get('status', 'claimed')}, not merging again")
+                return synced
+            if merge is None:
+                # a worker that has just finished may be claiming it at the same time
+                if not create_json_object(merge_key, {"status": "MERGING"}):
+                    return synced
+            else:
+                put_json_object(merge_key, {"status": "MERGING"})
+            return synced + merge_fanout(fanout, merge_key)
+        if not indexes:
+            return FANOUT_STARTED
+    else:
+        workers = int(event.get('workers', FANOUT_WORKERS))
+        sync_event = {key: event[key] for key in ('sync_from', 'deal_ids', 'force', 'chunk_size', 'shards')
+                      if key in event}
+        fanout = {"fanout_id": uuid.uuid4().hex, "event": sync_event, "shards": plan_shards(event, workers)}
+        if not fanout["shards"]:
+            print("Missing sync_from / deal_ids in the request. Exiting.")
+            return 0
+        if "end_ms" in fanout["shards"][-1]:
+            # deals modified after this are synced by catch_up once the shards are merged
+            fanout["planned_until_ms"] = fanout["shards"][-1]["end_ms"]
+        put_json_object(fanout_key(fanout["fanout_id"], "fanout"), fanout)
+        indexes = list(range(len(fanout["shards"])))
+        print(f"Fan-out {fanout['fanout_id']} over {len(indexes)} shards")
+
+    if context is not None:
+        invoke_shards(fanout, indexes, context)
+        return FANOUT_STARTED
+
+    # local stand-in for the worker invocations, the last one to finish merges
+    shard_events = [{'fanout_id': fanout["fanout_id"], 'shard': index} for index in indexes]
+    with ProcessPoolExecutor(max_workers=max(len(indexes), 1)) as executor:
+        list(executor.map(run_shard_event, shard_events))
+    merge = get_json_object(fanout_key(fanout["fanout_id"], "merge")) or {}
+    return sum(status.get("synced", 0) for status in shard_statuses(fanout)) + merge.get("caught_up", 0)
+
+
+def run_shard_event(event):
+    """
+    Worker of SYNC_SHARD. Merges every shard when this is the last one to finish.
+    :return: True when this worker merged the fan-out
+    """
+    fanout_id = event['fanout_id']
+    index = int(event['shard'])
+    fanout = get_json_object(fanout_key(fanout_id, "fanout"))
+    if fanout is None:
+        raise ValueError(f"Fan-out {fanout_id} not found")
+    shard_key = fanout_key(fanout_id, f"shard-{index}")
+    put_json_object(shard_key, {"status": "PROCESSING"})
+    try:
+        synced = run_shard(fanout, index)
+    except Exception:
+        put_json_object(shard_key, {"status": "FAILED", "error": traceback.format_exc()})
+        raise
+    put_json_object(shard_key, {"status": "DONE", "synced": synced})
+
+    # every worker writes its own status before reading the others, so the last one to finish sees all done
+    if any(status.get("status") != "DONE" for status in shard_statuses(fanout)):
+        return False
+    merge_key = fanout_key(fanout_id, "merge")
+    if not create_json_object(merge_key, {"status": "MERGING", "shard": index}):
+        return False
+    merge_fanout(fanout, merge_key)
+    return True
@@ -1,4 +1,3 @@
-import json
 import traceback
 from datetime import datetime, timezone
 
@@ -7,42 +6,61 @@ import pytz
 from .bulk_events import get_2026_book_lead_email
 from .utils.config import SF_COMPANIES_TABLE, SF_DEAL_OWNERS_TABLE, SF_DEAL_COLLABORATORS_TABLE, SF_DEALS_TABLE, \
     SF_LINE_ITEMS_TABLE
-from .utils.hubspot_api import get_deal, get_company_details, get_deal_to_company_association, get_owner_details, \
-    get_deal_pipeline_stages, get_line_items_by_ids
-
-
-def handle_company_details(deal_id, sf_cursor):
-    deal_company_assc = get_deal_to_company_association(deal_id)
+from .utils.jsonlib import dumps_column
+from .utils.hubspot_api import get_deal, get_deal_to_company_association, \
+    get_stage_label, get_line_items_by_ids
+from .utils.company_cache import company_cache
+from .utils.owner_directory import owner_directory
+from .utils.row_hash import row_hash, properties_hash, filter_changed_deals, ROW_CHANGED_CONDITION
+from .utils.sql import merge_statement, placeholders
+
+COMPANY_COLUMNS = ("COMPANY_ID", "NAME", "DOMAIN")
+OWNER_COLUMNS = ("OWNER_ID", "NAME", "EMAIL", "IS_ARCHIVED")
+COLLABORATOR_COLUMNS = ("DEAL_ID", "LAST_UPDATED", "OWNER_ID")
+DEAL_COLUMNS = ("DEAL_ID", "DEAL_NAME", "DEAL_OWNER", "DEAL_OWNER_ID", "DEAL_OWNER_EMAIL", "DEAL_OWNER_NAME",
+                "DEAL_STAGE_ID", "DEAL_STAGE_NAME", "COMPANY_ID", "COMPANY_NAME", "DEAL_TO_COMPANY_ASSOCIATIONS",
+                "PIPELINE_ID", "PROJECT_START_DATE", "PROJECT_CLOSE_DATE", "ENGAGEMENT_TYPE", "DURATION_IN_MONTHS",
+                "DEAL_COLLABORATORS", "DEAL_CREATED_ON", "DEAL_UPDATED_ON", "IS_ARCHIVED", "COMPANY_DOMAIN",
+                "NS_PROJECT_ID", "DEAL_AMOUNT_IN_COMPANY_CURRENCY", "DEAL_TYPE", "SPECIAL_FIELDS_UPDATED_ON",
+                "WORK_AHEAD", "LAST_REFRESHED_ON", "DELIVERY_LEAD_ID", "DELIVERY_LEAD_EMAIL", "DELIVERY_LEAD_NAME",
+                "SOLUTION_LEAD_ID", "SOLUTION_LEAD_EMAIL", "SOLUTION_LEAD_NAME", "REVENUE_TYPE", "CURRENCY",
+                "BOOK_LEADS_2026", "BOOK_2026_EMAIL", "OFFERING", "DESCRIPTION", "TECH_INVOLVED", "ROW_HASH",
+                "PROPERTIES_HASH")
+LINE_ITEM_COLUMNS = ("LINE_ITEM_ID", "NAME", "PRICE", "QUANTITY", "AMOUNT", "CREATED_ON", "UPDATED_ON", "DEAL_ID",
+                     "CURRENCY")
+# Columns selected from Snowflake to diff against, and the position of each in a LINE_ITEM_COLUMNS row
+EXISTING_LINE_ITEM_COLUMNS = ("LINE_ITEM_ID", "NAME", "PRICE", "QUANTITY", "AMOUNT", "UPDATED_ON", "DEAL_ID",
+                             "CURRENCY")
+EXISTING_LINE_ITEM_POSITIONS = tuple(LINE_ITEM_COLUMNS.index(column) for column in EXISTING_LINE_ITEM_COLUMNS)
+NUMERIC_LINE_ITEM_COLUMNS = ("PRICE", "QUANTITY", "AMOUNT")
+TIMESTAMP_LINE_ITEM_COLUMNS = ("UPDATED_ON",)
+DEAL_ID_INDEX = LINE_ITEM_COLUMNS.index("DEAL_ID")
+EXISTING_DEAL_ID_INDEX = EXISTING_LINE_ITEM_COLUMNS.index("DEAL_ID")
+
+
+def handle_company_details(deal_id, sf_cursor, deal_company_assc=None):
+    if deal_company_assc is None:
+        deal_company_assc = get_deal_to_company_association(deal_id)
     if len(deal_company_assc) > 0:
         company_id = deal_company_assc[0]['toObjectId']
-        company_details = get_company_details(company_id)
-        if not company_details['properties']:
+        company_details = company_cache.get_company(company_id)
+        if not company_details or not company_details['properties']:
             return {}
-        company_name = company_details['properties'].get('name', "")
-        company_name = company_name.replace("'", "''") if company_name else ""
+        company_name = company_details['properties'].get('name', "") or ""
         company_domain = company_details['properties'].get('domain', "")
 
-        merge_sql = f"""
-               MERGE INTO {SF_COMPANIES_TABLE} AS target
-               USING (SELECT '{company_id}' AS COMPANY_ID, '{company_name}' AS NAME, '{company_domain}' AS DOMAIN) AS source
-               ON target.company_id = source.company_id
-               WHEN MATCHED THEN
-                   UPDATE SET target.name = source.name, target.domain = source.domain
-               WHEN NOT MATCHED THEN
-                   INSERT (company_id, name, domain) 
-                   VALUES (source.company_id, source.name, source.domain);
-               """
-
-        sf_cursor.execute(merge_sql)
-        print(f"Upserted company {company_id} - {company_name}")
+        company_row = (company_id, company_name, company_domain)
+        if company_cache.rows_to_write([company_row]):
+            sf_cursor.execute(merge_statement(SF_COMPANIES_TABLE, COMPANY_COLUMNS, ("COMPANY_ID",)), company_row)
+            company_cache.mark_written([company_row])
+            print(f"Upserted company {company_id} - {company_name}")
         return {"associations": deal_company_assc,
                 "company_details": {"id": company_id, "name": company_name, "domain": company_domain}}
     return {}
 
 
 def get_deleted_line_item_ids(updated_line_item_ids, existing_line_items):
-    existing_line_item_ids = [str(item[0]) for item in existing_line_items]
-    return list(set(existing_line_item_ids) - set(updated_line_item_ids))
+    return list({str(item[0]) for item in existing_line_items} - {str(item_id) for item_id in updated_line_item_ids})
 
 
 def to_float(value: str) -> float:
@@ -54,77 +72,118 @@ def to_float(value: str) -> float:
         return float(0)
 
 
+def to_utc_timestamp(value):
+    """
+    A stored TIMESTAMP_NTZ (UTC wall time) or a HubSpot ISO timestamp as a naive UTC datetime,
+    the text itself when it is not a timestamp.
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return value
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def line_item_changed(existing_line_item, line_item_row):
+    """
+    :param existing_line_item: row of EXISTING_LINE_ITEM_COLUMNS from Snowflake
+    :param line_item_row: row of LINE_ITEM_COLUMNS about to be written
+    """
+    for column, existing_value, position in zip(EXISTING_LINE_ITEM_COLUMNS, existing_line_item,
+                                                EXISTING_LINE_ITEM_POSITIONS):
+        value = line_item_row[position]
+        if column in NUMERIC_LINE_ITEM_COLUMNS:
+            if (existing_value is None) != (value is None) or to_float(str(existing_value)) != to_float(str(value)):
+                return True
+        elif column in TIMESTAMP_LINE_ITEM_COLUMNS:
+            if to_utc_timestamp(existing_value or None) != to_utc_timestamp(value or None):
+                return True
+        elif str(existing_value or '') != str(value or ''):
+            return True
+    return False
+
+
+def diff_line_items(existing_line_items, line_item_rows, line_item_ids=None):
+    """
+    Compare the line items stored in Snowflake with the ones about to be written, in one pass over each.
+    A line item that moved to another deal is deleted and inserted again, the MERGE is keyed by deal.
+    :param existing_line_items: rows of EXISTING_LINE_ITEM_COLUMNS
+    :param line_item_rows: rows of LINE_ITEM_COLUMNS
+    :param line_item_ids: ids still associated with the deals, stored line items among them are never deleted
+        even when they are missing from line_item_rows
+    :return: rows to insert, rows to update, ids of line items to delete
+    """
+    existing_by_id = {str(row[0]): row for row in existing_line_items}
+    inserts, updates, deletes = [], [], set()
+    for row in line_item_rows:
+        existing = existing_by_id.pop(str(row[0]), None)
+        if existing is None:
+            inserts.append(row)
+        elif str(existing[EXISTING_DEAL_ID_INDEX]) != str(row[DEAL_ID_INDEX]):
+            deletes.add(str(row[0]))
+            inserts.append(row)
+        elif line_item_changed(existing, row):
+            updates.append(row)
+    deletes.update(existing_by_id.keys() - {str(line_item_id) for line_item_id in line_item_ids or ()})
+    return inserts, updates, deletes
+
+
+def select_existing_line_items(sf_cursor, deal_ids):
+    sf_cursor.execute(f"SELECT {', '.join(EXISTING_LINE_ITEM_COLUMNS)} FROM {SF_LINE_ITEMS_TABLE} "
+                      f"WHERE DEAL_ID IN ({placeholders(len(deal_ids))})", list(deal_ids))
+    return sf_cursor.fetchall()
+
+
+def write_line_item_diff(sf_cursor, existing_line_items, line_item_rows, line_item_ids=None):
+    """
+    Apply diff_line_items with at most one DELETE and one MERGE, unchanged line items are not written.
+    :return: True when line items were deleted
+    """
+    inserts, updates, deletes = diff_line_items(existing_line_items, line_item_rows, line_item_ids)
+    if deletes:
+        print(f"DELETING Line Items ({', '.join(sorted(deletes))})")
+        sf_cursor.execute(f"DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE LINE_ITEM_ID IN ({placeholders(len(deletes))})",
+                          sorted(deletes))
+    changed_rows = inserts + updates
+    if changed_rows:
+        sf_cursor.execute(merge_statement(SF_LINE_ITEMS_TABLE, LINE_ITEM_COLUMNS, ("LINE_ITEM_ID", "DEAL_ID"),
+                                          len(changed_rows)), [value for row in changed_rows for value in row])
+        print(f"Upserted line items - {len(inserts)} new, {len(updates)} changed, "
+              f"{len(line_item_rows) - len(changed_rows)} unchanged")
+    return bool(deletes)
+
+
 def check_line_items_updation(existing_line_items, updated_line_items):
     try:
+        existing_by_id = {str(item[0]): item for item in existing_line_items}
         for item in updated_line_items:
-            exst_item = next((d for d in existing_line_items if str(d[0]) == item['id']), None)
-            if exst_item:
-                if exst_item[1] != item['properties']['name'] or to_float(str(exst_item[2])) != to_float(
-                        str(item['properties'].get('amount', 0))):
-                    return True
-            else:
+            exst_item = existing_by_id.get(str(item['id']))
+            if not exst_item or exst_item[1] != item['properties']['name'] or to_float(str(exst_item[2])) != to_float(
+                    str(item['properties'].get('amount', 0))):
                 return True
         return False
     except Exception:
         return False
 
 
-def none_to_null_(value):
-    return "NULL" if value is None or value == '' else value
+def to_number(value):
+    return None if value is None or str(value).strip() == '' else value
 
 
 def handle_line_items(deal, sf_cursor):
     try:
         line_item_ids = [item["id"] for item in deal.get("associations", {}).get("line items", {}).get("results", [])]
-
-        sf_cursor.execute(
-            f""" SELECT LINE_ITEM_ID, NAME, AMOUNT FROM {SF_LINE_ITEMS_TABLE} WHERE DEAL_ID='{deal['id']}' """)
-        existing_line_items = sf_cursor.fetchall()
-
-        if line_item_ids and len(line_item_ids) > 0:
-            line_items_data = get_line_items_by_ids(line_item_ids)
-            values_str = ", ".join([
-                f"('{none_to_null_(item['id'])}', '{none_to_null_(item['properties']['name'])}', {none_to_null_(item['properties'].get('price', 0))}, {none_to_null_(item['properties'].get('quantity', 0))}, {none_to_null_(item['properties'].get('amount', 0))}, '{none_to_null_(item['createdAt'])}', '{none_to_null_(item['updatedAt'])}', '{none_to_null_(deal['id'])}', '{none_to_null_(item['properties'].get('hs_line_item_currency_code', 'USD'))}')"
-                for item in line_items_data])
-            upsert_query = f"""
-            MERGE INTO {SF_LINE_ITEMS_TABLE} AS target
-            USING (
-                SELECT * FROM VALUES
-                {values_str}
-            ) AS source(LINE_ITEM_ID, NAME, PRICE, QUANTITY, AMOUNT, CREATED_ON, UPDATED_ON, DEAL_ID, CURRENCY)
-            ON target.LINE_ITEM_ID = source.LINE_ITEM_ID and target.DEAL_ID = source.DEAL_ID
-            WHEN MATCHED THEN
-                UPDATE SET
-                    target.NAME = source.NAME,
-                    target.PRICE = source.PRICE,
-                    target.QUANTITY = source.QUANTITY,
-                    target.AMOUNT = source.AMOUNT,
-                    target.CREATED_ON = source.CREATED_ON,
-                    target.UPDATED_ON = source.UPDATED_ON,
-                    target.CURRENCY = source.CURRENCY
-            WHEN NOT MATCHED THEN
-                INSERT (LINE_ITEM_ID, NAME, PRICE, QUANTITY, AMOUNT, CREATED_ON, UPDATED_ON, DEAL_ID, CURRENCY)
-                VALUES (source.LINE_ITEM_ID, source.NAME, source.PRICE, source.QUANTITY, source.AMOUNT, source.CREATED_ON, source.UPDATED_ON, source.DEAL_ID, source.CURRENCY);
-            """
-            sf_cursor.execute(upsert_query)
-            print(f"Upserted line items")
-
-            deleted_line_item_ids = get_deleted_line_item_ids(line_item_ids, existing_line_items)
-
-            if deleted_line_item_ids and len(deleted_line_item_ids) > 0:
-                id_str = ', '.join(map(str, deleted_line_item_ids))
-                print(f"""DELETING Line Items ({id_str})""")
-                sf_cursor.execute(f"""DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE LINE_ITEM_ID IN ({id_str})""")
-                return True
-
-            return
-        else:
-            if len(existing_line_items) > 0:
-                id_str = ', '.join(map(str, [item[0] for item in existing_line_items]))
-                print(f"""DELETING Line Items ({id_str})""")
-                sf_cursor.execute(f"""DELETE FROM {SF_LINE_ITEMS_TABLE} WHERE LINE_ITEM_ID IN ({id_str})""")
-                return True
-            return False
+        existing_line_items = select_existing_line_items(sf_cursor, [deal['id']])
+        line_items_data = get_line_items_by_ids(line_item_ids) if line_item_ids else []
+        line_item_rows = [(
+            item['id'], item['properties']['name'], to_number(item['properties'].get('price', 0)),
+            to_number(item['properties'].get('quantity', 0)), to_number(item['properties'].get('amount', 0)),
+            item['createdAt'], item['updatedAt'], deal['id'],
+            item['properties'].get('hs_line_item_currency_code') or 'USD') for item in line_items_data]
+        return write_line_item_diff(sf_cursor, existing_line_items, line_item_rows, line_item_ids)
     except Exception as ex:
         traceback.print_exc()
         print(f"Failed to upsert line items for the deal - {deal['id']}")
@@ -133,25 +192,16 @@ def handle_line_items(deal, sf_cursor):
 
 def handle_deal_owner_details(deal_owner, sf_cursor):
     if deal_owner:
-        owner_details = get_owner_details(deal_owner)
-        owner_details = parse_owner_details(owner_details)
+        owner_details = parse_owner_details(owner_directory.get_owner(deal_owner))
+        if not owner_details:
+            return None
         owner_email = owner_details['email']
         owner_name = owner_details['name']
         owner_id = owner_details['id']
         is_archived = owner_details['is_archived']
 
-        merge_sql = f"""
-               MERGE INTO {SF_DEAL_OWNERS_TABLE} AS target
-               USING (SELECT '{owner_id}' AS OWNER_ID, '{owner_name}' AS NAME, '{owner_email}' AS EMAIL, '{is_archived}' AS IS_ARCHIVED) AS source
-               ON target.owner_id = source.owner_id
-               WHEN MATCHED THEN
-                   UPDATE SET target.name = source.name, target.email = source.email, target.is_archived = source.is_archived
-               WHEN NOT MATCHED THEN
-                   INSERT (owner_id, name, email, is_archived) 
-                   VALUES (source.owner_id, source.name, source.email, source.is_archived);
-               """
-
-        sf_cursor.execute(merge_sql)
+        sf_cursor.execute(merge_statement(SF_DEAL_OWNERS_TABLE, OWNER_COLUMNS, ("OWNER_ID",)),
+                          (owner_id, owner_name, owner_email, is_archived))
         print(f"Upserted owner {owner_id} - {owner_name}")
         return owner_details
     return None
@@ -159,9 +209,7 @@ def handle_deal_owner_details(deal_owner, sf_cursor):
 
 def handle_deal_lead_details(deal_owner):
     if deal_owner:
-        owner_details = get_owner_details(deal_owner)
-        owner_details = parse_owner_details(owner_details)
-        return owner_details
+        return parse_owner_details(owner_directory.get_owner(deal_owner))
     return {}
 
 
@@ -175,7 +223,7 @@ def parse_owner_details(owner_details):
             owner_name = ' '.join(owner_email.split('@')[0].split('.')).title()
         owner_id = owner_details['id']
         is_archived = owner_details['userId'] is None
-        return {"id": owner_id, "name": owner_name.replace("'", "''"), "email": owner_email, "is_archived": is_archived}
+        return {"id": owner_id, "name": owner_name, "email": owner_email, "is_archived": is_archived}
     return {}
 
 
@@ -183,18 +231,15 @@ def handle_deal_collaborators(deal_collaborators_str):
     if not deal_collaborators_str:
         return []
     collaborator_ids = deal_collaborators_str.split(";")
-    collaborators = []
-    for collaborator_id in collaborator_ids:
-        collaborator_details = parse_owner_details(get_owner_details(collaborator_id))
-        if collaborator_details:
-            collaborators.append(collaborator_details)
-    return collaborators
+    owners = owner_directory.get_owners(collaborator_ids)
+    return [parse_owner_details(owners[collaborator_id]) for collaborator_id in collaborator_ids
+            if collaborator_id in owners]
 
 
 def create_deal_update_request(owner_details, collaborators_details, company_associations):
-    owner_json = json.dumps(owner_details)
-    collaborators_details_json = json.dumps(collaborators_details) if collaborators_details else ""
-    deal_to_company_associations_json = json.dumps(company_associations) if company_associations else ""
+    owner_json = dumps_column(owner_details)
+    collaborators_details_json = dumps_column(collaborators_details) if collaborators_details else ""
+    deal_to_company_associations_json = dumps_column(company_associations) if company_associations else ""
     return {"owner_json": owner_json, 'collaborators_details_json': collaborators_details_json,
             'deal_to_company_associations_json': deal_to_company_associations_json}
 
@@ -203,63 +248,43 @@ def upsert_deal_collaborators(deal_id, collaborators_details, sf_cursor):
     curr_time = datetime.now(timezone.utc)
     formatted_datetime = curr_time.strftime('%Y-%m-%dT%H:%M:%SZ')
     if collaborators_details and len(collaborators_details) > 0:
-        values = ', '.join(
-            f"('{col['email']}', {col['id']}, '{col['name']}', {col['is_archived']})" for col in collaborators_details
-        )
-        sql = f"""
-            MERGE INTO {SF_DEAL_OWNERS_TABLE} AS target
-            USING (SELECT column1.email, column1.owner_id, column1.name, column1.is_archived
-               FROM VALUES {values} AS column1(email, owner_id, name, is_archived)) AS source
-            ON target.owner_id = source.owner_id
-            WHEN MATCHED THEN
-            UPDATE SET
-                target.name = source.name,
-                target.email = source.email,
-                target.is_archived = source.is_archived
-            WHEN NOT MATCHED THEN
-                INSERT (email, owner_id, name, is_archived)
-                VALUES (source.email, source.owner_id, source.name, source.is_archived);
-            """
-        sf_cursor.execute(sql)
-
-        values_clause = ', '.join(
-            [f"('{deal_id}', '{formatted_datetime}', '{rec['id']}')" for rec in collaborators_details]
-        )
-
-        merge_sql = f"""
-        MERGE INTO {SF_DEAL_COLLABORATORS_TABLE} AS target
-        USING (SELECT * FROM VALUES {values_clause}) AS source (deal_id, last_updated, owner_id)
-            ON target.deal_id = source.deal_id AND target.owner_id = source.owner_id
-            WHEN MATCHED THEN
-                UPDATE SET target.last_updated = source.last_updated
-            WHEN NOT MATCHED THEN
-                INSERT (deal_id, last_updated, owner_id)
-                VALUES (source.deal_id, source.last_updated, source.owner_id);
-        """
-        sf_cursor.execute(merge_sql)
-        print(f"Upserted Deal Collaborators")
+        sf_cursor.execute(
+            merge_statement(SF_DEAL_OWNERS_TABLE, OWNER_COLUMNS, ("OWNER_ID",), len(collaborators_details)),
+            [value for col in collaborators_details
+             for value in (col['id'], col['name'], col['email'], col['is_archived'])])
 
+        sf_cursor.execute(
+            merge_statement(SF_DEAL_COLLABORATORS_TABLE, COLLABORATOR_COLUMNS, ("DEAL_ID", "OWNER_ID"),
+                            len(collaborators_details)),
+            [value for rec in collaborators_details for value in (deal_id, formatted_datetime, rec['id'])])
+        print(f"Upserted Deal Collaborators")
 
-def none_to_null(value):
-    return "NULL" if value is None or value == '' else f"'{value}'"
 
+def get_company_name(company_details):
+    if not company_details:
+        return None
+    if company_details['name']:
+        return company_details['name']
+    return " ".join(company_details['domain'].split(".")[:-1]).title() if company_details['domain'] else None
 
-def upsert_deal(sf_cursor, deal_id, deals_request, deal_properties, owner_details, company_details, stage_details,
-                delivery_lead_details, solution_lead_details):
-    company_name = None if not company_details else company_details['name'] if company_details['name'] else " ".join(
-        company_details['domain'].split(".")[:-1]).title() if company_details['domain'] else None
-    stage_name = next((stage['label'] for stage in stage_details if stage['id'] == deal_properties['dealstage']), None)
 
-    curr_time = datetime.now(pytz.timezone('America/New_York'))
+def build_deal_data(deal_id, deals_request, deal_properties, owner_details, company_details, stage_name,
+                    delivery_lead_details, solution_lead_details):
+    """
+    Column values of a HUBSPOT_DEALS row, shared by the per-deal and the batched upsert.
+    """
+    # bound as the text the inlined statements used, HUBSPOT_DEALS keeps New York wall time, a bound aware
+    # datetime would be stored in UTC
+    curr_time = str(datetime.now(pytz.timezone('America/New_York')))
 
     if deal_properties['work_ahead'] in ['No', 'blank']:
         work_ahead = 'No'
     else:
         work_ahead = deal_properties['work_ahead']
 
-    deal_data_raw = {
+    deal_data = {
         "DEAL_ID": deal_id,
-        "DEAL_NAME": deal_properties['dealname'].replace("'", "''"),
+        "DEAL_NAME": deal_properties['dealname'],
         "DEAL_OWNER": deals_request['owner_json'],
         "DEAL_OWNER_ID": deal_properties['hubspot_owner_id'],
         "DEAL_OWNER_EMAIL": owner_details['email'] if owner_details is not None else None,
@@ -267,7 +292,7 @@ def upsert_deal(sf_cursor, deal_id, deals_request, deal_properties, owner_detail
         "DEAL_STAGE_ID": deal_properties['dealstage'],
         "DEAL_STAGE_NAME": stage_name,
         "COMPANY_ID": company_details['id'] if company_details is not None else None,
-        "COMPANY_NAME": company_name,
+        "COMPANY_NAME": get_company_name(company_details),
         "DEAL_TO_COMPANY_ASSOCIATIONS": deals_request['deal_to_company_associations_json'],
         "PIPELINE_ID": deal_properties['pipeline'],
         "PROJECT_START_DATE": deal_properties['expected_project_start_date'],
@@ -293,106 +318,24 @@ def upsert_deal(sf_cursor, deal_id, deals_request, deal_properties, owner_detail
         "SOLUTION_LEAD_NAME": solution_lead_details.get('name'),
         "REVENUE_TYPE": deal_properties['revenue_type'],
         "CURRENCY": deal_properties.get('deal_currency_code') or 'USD',
-        "BOOK_LEADS_2026": deal_properties.get('n2026_book').replace("'", "''") if deal_properties.get('n2026_book') else None,
+        "BOOK_LEADS_2026": deal_properties.get('n2026_book') or None,
         "BOOK_2026_EMAIL": get_2026_book_lead_email(deal_properties.get('n2026_book')),
-        "OFFERING": deal_properties.get('offering').replace("'", "''") if deal_properties.get('offering') else None,
-        "DESCRIPTION": deal_properties.get('description', '').replace("'", "''") if deal_properties.get('description') else None,
-        "TECH_INVOLVED": deal_properties.get('tech_involved', '').replace("'", "''") if deal_properties.get('tech_involved') else None
+        "OFFERING": deal_properties.get('offering') or None,
+        "DESCRIPTION": deal_properties.get('description') or None,
+        "TECH_INVOLVED": deal_properties.get('tech_involved') or None
     }
-    deal_data = {key: none_to_null(value) for key, value in deal_data_raw.items()}
-
-    merge_sql = f"""
-            MERGE INTO {SF_DEALS_TABLE} AS target
-            USING (SELECT
-                        {deal_data['DEAL_ID']} AS DEAL_ID,
-                        {deal_data['DEAL_NAME']} AS DEAL_NAME,
-                        {deal_data['DEAL_OWNER']} AS DEAL_OWNER,
-                        {deal_data['DEAL_OWNER_ID']} AS DEAL_OWNER_ID,
-                        {deal_data['DEAL_OWNER_EMAIL']} AS DEAL_OWNER_EMAIL,
-                        {deal_data['DEAL_OWNER_NAME']} AS DEAL_OWNER_NAME,
-                        {deal_data['DEAL_STAGE_ID']} AS DEAL_STAGE_ID,
-                        {deal_data['DEAL_STAGE_NAME']} AS DEAL_STAGE_NAME,
-                        {deal_data['COMPANY_ID']} AS COMPANY_ID,
-                        {deal_data['COMPANY_NAME']} AS COMPANY_NAME,
-                        {deal_data['DEAL_TO_COMPANY_ASSOCIATIONS']} AS DEAL_TO_COMPANY_ASSOCIATIONS,
-                        {deal_data['PIPELINE_ID']} AS PIPELINE_ID,
-                        {deal_data['PROJECT_START_DATE']} AS PROJECT_START_DATE,
-                        {deal_data['PROJECT_CLOSE_DATE']} AS PROJECT_CLOSE_DATE,
-                        {deal_data['ENGAGEMENT_TYPE']} AS ENGAGEMENT_TYPE,
-                        {deal_data['DURATION_IN_MONTHS']} AS DURATION_IN_MONTHS,
-                        {deal_data['DEAL_COLLABORATORS']} AS DEAL_COLLABORATORS,
-                        {deal_data['DEAL_CREATED_ON']} AS DEAL_CREATED_ON,
-                        {deal_data['DEAL_UPDATED_ON']} AS DEAL_UPDATED_ON,
-                        {deal_data['IS_ARCHIVED']} AS IS_ARCHIVED,
-                        {deal_data['COMPANY_DOMAIN']} AS COMPANY_DOMAIN,
-                        {deal_data['NS_PROJECT_ID']} AS NS_PROJECT_ID,
-                        {deal_data['DEAL_AMOUNT_IN_COMPANY_CURRENCY']} AS DEAL_AMOUNT_IN_COMPANY_CURRENCY,
-                        {deal_data['DEAL_TYPE']} AS DEAL_TYPE,
-                        {deal_data['SPECIAL_FIELDS_UPDATED_ON']} AS SPECIAL_FIELDS_UPDATED_ON,
-                        {deal_data['WORK_AHEAD']} AS WORK_AHEAD,
-                        {deal_data['LAST_REFRESHED_ON']} as LAST_REFRESHED_ON,
-                        {deal_data['DELIVERY_LEAD_ID']} as DELIVERY_LEAD_ID,
-                        {deal_data['DELIVERY_LEAD_EMAIL']} as DELIVERY_LEAD_EMAIL,
-                        {deal_data['DELIVERY_LEAD_NAME']} as DELIVERY_LEAD_NAME,
-                        {deal_data['SOLUTION_LEAD_ID']} as SOLUTION_LEAD_ID,
-                        {deal_data['SOLUTION_LEAD_EMAIL']} as SOLUTION_LEAD_EMAIL,
-                        {deal_data['SOLUTION_LEAD_NAME']} as SOLUTION_LEAD_NAME,
-                        {deal_data['REVENUE_TYPE']} as REVENUE_TYPE,
-                        {deal_data['CURRENCY']} as CURRENCY,
-                        {deal_data['BOOK_LEADS_2026']} as BOOK_LEADS_2026,
-                        {deal_data['BOOK_2026_EMAIL']} as BOOK_2026_EMAIL,
-                        {deal_data['OFFERING']} as OFFERING,
-                        {deal_data['DESCRIPTION']} as DESCRIPTION,
-                        {deal_data['TECH_INVOLVED']} as TECH_INVOLVED
-                    ) AS source
-            ON (target.DEAL_ID = source.DEAL_ID)
-            WHEN MATCHED THEN
-                UPDATE SET
-                    target.DEAL_NAME = source.DEAL_NAME,
-                    target.DEAL_OWNER = source.DEAL_OWNER,
-                    target.DEAL_OWNER_ID = source.DEAL_OWNER_ID,
-                    target.DEAL_OWNER_EMAIL = source.DEAL_OWNER_EMAIL,
-                    target.DEAL_OWNER_NAME = source.DEAL_OWNER_NAME,
-                    target.DEAL_STAGE_ID = source.DEAL_STAGE_ID,
-                    target.DEAL_STAGE_NAME = source.DEAL_STAGE_NAME,
-                    target.COMPANY_ID = source.COMPANY_ID,
-                    target.COMPANY_NAME = source.COMPANY_NAME,
-                    target.DEAL_TO_COMPANY_ASSOCIATIONS = source.DEAL_TO_COMPANY_ASSOCIATIONS,
-                    target.PIPELINE_ID = source.PIPELINE_ID,
-                    target.PROJECT_START_DATE = source.PROJECT_START_DATE,
-                    target.PROJECT_CLOSE_DATE = source.PROJECT_CLOSE_DATE,
-                    target.ENGAGEMENT_TYPE = source.ENGAGEMENT_TYPE,
-                    target.DURATION_IN_MONTHS = source.DURATION_IN_MONTHS,
-                    target.DEAL_COLLABORATORS = source.DEAL_COLLABORATORS,
-                    target.DEAL_CREATED_ON = source.DEAL_CREATED_ON,
-                    target.DEAL_UPDATED_ON = source.DEAL_UPDATED_ON,
-                    target.IS_ARCHIVED = source.IS_ARCHIVED,
-                    target.COMPANY_DOMAIN = source.COMPANY_DOMAIN,
-                    target.NS_PROJECT_ID = source.NS_PROJECT_ID,
-                    target.DEAL_AMOUNT_IN_COMPANY_CURRENCY = source.DEAL_AMOUNT_IN_COMPANY_CURRENCY,
-                    target.DEAL_TYPE = source.DEAL_TYPE,
-                    target.SPECIAL_FIELDS_UPDATED_ON = source.SPECIAL_FIELDS_UPDATED_ON,
-                    target.WORK_AHEAD = source.WORK_AHEAD,
-                    target.LAST_REFRESHED_ON = source.LAST_REFRESHED_ON,
-                    target.DELIVERY_LEAD_ID = source.DELIVERY_LEAD_ID,
-                    target.DELIVERY_LEAD_EMAIL = source.DELIVERY_LEAD_EMAIL,
-                    target.DELIVERY_LEAD_NAME = source.DELIVERY_LEAD_NAME,
-                    target.SOLUTION_LEAD_ID = source.SOLUTION_LEAD_ID,
-                    target.SOLUTION_LEAD_EMAIL = source.SOLUTION_LEAD_EMAIL,
-                    target.SOLUTION_LEAD_NAME = source.SOLUTION_LEAD_NAME,
-                    target.REVENUE_TYPE = source.REVENUE_TYPE,
-                    target.CURRENCY = source.CURRENCY,
-                    target.BOOK_LEADS_2026 = source.BOOK_LEADS_2026,
-                    target.BOOK_2026_EMAIL = source.BOOK_2026_EMAIL,
-                    target.OFFERING = source.OFFERING,
-                    target.DESCRIPTION = source.DESCRIPTION,
-                    target.TECH_INVOLVED = source.TECH_INVOLVED
-            WHEN NOT MATCHED THEN
-                INSERT (DEAL_ID, DEAL_NAME, DEAL_OWNER, DEAL_OWNER_ID, DEAL_OWNER_EMAIL, DEAL_OWNER_NAME, DEAL_STAGE_ID, DEAL_STAGE_NAME, COMPANY_ID, COMPANY_NAME, DEAL_TO_COMPANY_ASSOCIATIONS, PIPELINE_ID, PROJECT_START_DATE, PROJECT_CLOSE_DATE, ENGAGEMENT_TYPE, DURATION_IN_MONTHS, DEAL_COLLABORATORS, DEAL_CREATED_ON, DEAL_UPDATED_ON, IS_ARCHIVED, COMPANY_DOMAIN, NS_PROJECT_ID, DEAL_AMOUNT_IN_COMPANY_CURRENCY, DEAL_TYPE, SPECIAL_FIELDS_UPDATED_ON, WORK_AHEAD, LAST_REFRESHED_ON, DELIVERY_LEAD_ID, DELIVERY_LEAD_EMAIL, DELIVERY_LEAD_NAME, SOLUTION_LEAD_ID, SOLUTION_LEAD_EMAIL, SOLUTION_LEAD_NAME, REVENUE_TYPE, CURRENCY, BOOK_LEADS_2026, BOOK_2026_EMAIL, OFFERING, DESCRIPTION, TECH_INVOLVED)
-                VALUES (source.DEAL_ID, source.DEAL_NAME, source.DEAL_OWNER, source.DEAL_OWNER_ID, source.DEAL_OWNER_EMAIL, source.DEAL_OWNER_NAME, source.DEAL_STAGE_ID, source.DEAL_STAGE_NAME, source.COMPANY_ID, source.COMPANY_NAME, source.DEAL_TO_COMPANY_ASSOCIATIONS, source.PIPELINE_ID, source.PROJECT_START_DATE, source.PROJECT_CLOSE_DATE, source.ENGAGEMENT_TYPE, source.DURATION_IN_MONTHS, source.DEAL_COLLABORATORS, source.DEAL_CREATED_ON, source.DEAL_UPDATED_ON, source.IS_ARCHIVED, source.COMPANY_DOMAIN, source.NS_PROJECT_ID, source.DEAL_AMOUNT_IN_COMPANY_CURRENCY, source.DEAL_TYPE, source.SPECIAL_FIELDS_UPDATED_ON, source.WORK_AHEAD, source.LAST_REFRESHED_ON, source.DELIVERY_LEAD_ID, source.DELIVERY_LEAD_EMAIL, source.DELIVERY_LEAD_NAME, source.SOLUTION_LEAD_ID, source.SOLUTION_LEAD_EMAIL, source.SOLUTION_LEAD_NAME, source.REVENUE_TYPE, source.CURRENCY, source.BOOK_LEADS_2026, source.BOOK_2026_EMAIL, source.OFFERING, source.DESCRIPTION, source.TECH_INVOLVED);
-        """
-
-    sf_cursor.execute(merge_sql)
+    deal_data["ROW_HASH"] = row_hash(deal_data)
+    deal_data["PROPERTIES_HASH"] = properties_hash(deal_properties)
+    return deal_data
+
+
+def upsert_deal(sf_cursor, deal_id, deals_request, deal_properties, owner_details, company_details, stage_name,
+                delivery_lead_details, solution_lead_details):
+    deal_data = build_deal_data(deal_id, deals_request, deal_properties, owner_details, company_details,
+                                stage_name, delivery_lead_details, solution_lead_details)
+
+    sf_cursor.execute(merge_statement(SF_DEALS_TABLE, DEAL_COLUMNS, ("DEAL_ID",), update_when=ROW_CHANGED_CONDITION),
+                      [None if deal_data[column] == '' else deal_data[column] for column in DEAL_COLUMNS])
     print(f"Upserted Deal {deal_id} - {deal_data['DEAL_NAME']}")
 
 
@@ -434,9 +377,9 @@ def handle_special_fields(deal_id, updated_deal_properties, does_line_items_upda
     FROM
         {SF_DEALS_TABLE}
     WHERE
-        DEAL_ID = '{deal_id}';
+        DEAL_ID = ?;
     """
-    sf_cursor.execute(sql_query)
+    sf_cursor.execute(sql_query, (deal_id,))
     results = sf_cursor.fetchall()
     if len(results) < 1:
         return updated_deal_properties['updatedAt']
@@ -460,10 +403,16 @@ def handle_special_fields(deal_id, updated_deal_properties, does_line_items_upda
     return updated_deal_properties['updatedAt']
 
 
-def handle_deal(deal, sf_cursor):
+def handle_deal(deal, sf_cursor, force=False):
     try:
         deal_properties = deal['properties']
         deal_id = deal['id']
+        deal_company_assc = get_deal_to_company_association(deal_id)
+        company_id = deal_company_assc[0]['toObjectId'] if deal_company_assc else None
+        if not filter_changed_deals(sf_cursor, [deal], force, {deal_id: company_id}):
+            print(f"Deal {deal_id} unchanged, syncing its line items only")
+            handle_line_items(deal, sf_cursor)
+            return
 
         deal_owner = deal_properties['hubspot_owner_id']
         deal_collaborators = deal_properties['hs_all_collaborator_owner_ids']
@@ -472,21 +421,21 @@ def handle_deal(deal, sf_cursor):
 
         print(f"Upserting Deal {deal_id} - {deal_properties['dealname']}")
 
-        company_associations = handle_company_details(deal_id, sf_cursor)
+        company_associations = handle_company_details(deal_id, sf_cursor, deal_company_assc)
         owner_details = handle_deal_owner_details(deal_owner, sf_cursor)
         delivery_lead_details = handle_deal_lead_details(deal_properties['delivery_lead'])
         solution_lead_details = handle_deal_lead_details(deal_properties['solution_lead'])
         collaborators_details = handle_deal_collaborators(deal_collaborators)
         upsert_deal_collaborators(deal_id, collaborators_details, sf_cursor)
 
-        stage_details = get_deal_pipeline_stages(pipeline_id)
+        stage_name = get_stage_label(pipeline_id, deal_properties['dealstage'])
         deals_request = create_deal_update_request(owner_details, collaborators_details,
                                                    company_associations.get('associations', None))
 
         # special_fields_updated_on = handle_special_fields(deal_id, deal_properties, does_line_items_updated, sf_cursor)
         upsert_deal(sf_cursor, deal_id, deals_request, deal_properties, owner_details,
                     company_associations.get('company_details', None),
-                    stage_details, delivery_lead_details, solution_lead_details)
+                    stage_name, delivery_lead_details, solution_lead_details)
         handle_line_items(deal, sf_cursor)
 
     except Exception as ex:
@@ -1,21 +1,20 @@
+"""
+Entry point of the API and event Lambda.
+
+Only light modules are imported here. Each route imports what it needs when it runs, so the webhook
+route (SQS only) does not load the Snowflake connector, the HubSpot client or the sync modules on a
+cold start, and AWS clients are created on first use (utils/aws.py).
+"""
 import json
+import sys
 import traceback
 
-import boto3
-
-from .bulk_events_new import sync_deals as sync_deals_new
-from .bulk_events import sync_deals as sync_deals_old
-from .events import single_deal_fetch, bulk_deals_fetch, back_fill_deals, schedule_fetch, handle_sync_status
-from .handle_deal import handle_deal
 from .hubspot_events import handle_webhook_from_hubspot
+from .utils.aws import get_client
 from .utils.config import SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE, API_AUTH_KEY, \
     AWS_ACCOUNT_ID, ENV_
-from .utils.hubspot_api import get_deal
-from .utils.s3 import update_deals_last_sync_time
+from .utils.s3 import update_deals_last_sync_time, handle_sync_status
 from .utils.send_mail import send_email
-from .utils.snowflake_db import create_sf_connection, close_sf_connection
-
-sqs = boto3.client('sqs')
 
 
 def handle_api_request(event):
@@ -31,7 +30,11 @@ def handle_api_request(event):
 
     path_params = event.get('pathParameters')
     if path_params and 'dealId' in path_params:
-        sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+        from .handle_deal import handle_deal
+        from .utils.hubspot_api import get_deal
+        from .utils.snowflake_db import get_sf_connection, release_sf_connection
+
+        sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
         sf_cursor = sf_conn.cursor()
         try:
             deal_id = path_params['dealId']
@@ -39,13 +42,13 @@ def handle_api_request(event):
             deal_details = get_deal(deal_id)
             handle_deal(deal_details, sf_cursor)
 
-            close_sf_connection(sf_conn)
+            release_sf_connection(sf_conn)
             return {
                 "statusCode": 201,
                 "body": json.dumps({"message": f"Completed Sync for Deal: {deal_id}"})
             }
         except Exception as e:
-            close_sf_connection(sf_conn)
+            release_sf_connection(sf_conn)
             error_log = traceback.format_exc()
             print(error_log)
             html_content = f'''
@@ -65,7 +68,7 @@ def handle_api_request(event):
                 "body": json.dumps({"message": "Failed to Sync Deal"})
             }
     elif event['path'] and '/hubspot/deals/sync' in event['path']:
-        return handle_webhook_from_hubspot(event, sqs)
+        return handle_webhook_from_hubspot(event, get_client('sqs'))
     else:
         print("[API] Invoking Async Function - To Sync Deals")
         last_status = handle_sync_status()
@@ -77,39 +80,71 @@ def handle_api_request(event):
             }
 
         event_body = event.get('body', None)
-        sync_from_ = json.loads(event_body).get('sync_from', None)
+        request_body = json.loads(event_body) if event_body else {}
+        sync_from_ = request_body.get('sync_from', None)
         if not sync_from_:
             sync_from_ = "2024-01-01T00:00:00+00:00"
-
-        lambda_client = boto3.client('lambda')
-        lambda_client.invoke(
+        sync_event = {'event': 'MANUAL_SYNC', 'sync_from': sync_from_}
+        # resumes a failed sync job from its last finished window
+        if request_body.get('job_id'):
+            sync_event['job_id'] = request_body['job_id']
+        # splits the sync over parallel worker invocations
+        if request_body.get('workers'):
+            sync_event = {'event': 'FANOUT_SYNC', 'sync_from': sync_from_, 'workers': int(request_body['workers'])}
+
+        get_client('lambda').invoke(
             FunctionName=f"arn:aws:lambda:us-east-1:{AWS_ACCOUNT_ID}:function:hubspot-snowflake-export",
             InvocationType="Event",
-            Payload=json.dumps(
-                {'event': 'MANUAL_SYNC', 'sync_from': sync_from_})
+            Payload=json.dumps(sync_event)
         )
 
-        print("Invoked Lambda with Event", {'event': 'MANUAL_SYNC', 'sync_from': sync_from_})
+        print("Invoked Lambda with Event", sync_event)
         return {
             "statusCode": 202,
             "body": json.dumps({"message": f"Accepted - Sync for all Deal"})
         }
 
 
-def handle_event(event):
+def handle_event(event, context=None):
     event_job = event['event']
     print(f"Received Event: {event_job}")
 
     try:
         if event_job == 'SCHEDULE_FETCH':
+            from .events import schedule_fetch
             schedule_fetch(event_job)
 
         elif event_job == 'SINGLE_DEAL_UPDATE':
+            from .events import single_deal_fetch
             single_deal_fetch(event)
 
         elif event_job == 'MANUAL_SYNC':
             try:
-                sync_deals_new(event)
+                from .bulk_events_new import sync_deals as sync_deals_new, JOB_CONTINUED
+                if sync_deals_new(event, context) == JOB_CONTINUED:
+                    # the invocation the job continues in updates the sync status when it finishes
+                    return "continued"
+            except Exception as e:
+                error_log = traceback.format_exc()
+                print(error_log)
+                html_content = f'''
+                <h1>Hubspot Sync Failed for Deals</h1><br>
+                <b>Event {event}</b><br>
+                <h2>Error:</h2><br>
+                <b>{str(e)}</b><br>
+                <pre>{error_log}</pre>
+                '''
+                send_email(["Ramakrishna.Pinni@blend360.com", "oveek.chatterjee@blend360.com",
+                            "Krishna.Undamatla@blend360.com"],
+                           subject=f"[{ENV_.upper()}] Hubspot Sync Failed error logs",
+                           content=html_content, content_type="html",
+                           email_cc_list=[], importance=True)
+
+        elif event_job == 'MANUAL_SYNC_ASYNC':
+            try:
+                import asyncio
+                from .bulk_events_new import sync_deals_async
+                asyncio.run(sync_deals_async(event))
             except Exception as e:
                 error_log = traceback.format_exc()
                 print(error_log)
@@ -128,6 +163,7 @@ def handle_event(event):
 
         elif event_job == 'MANUAL_SYNC_OLD':
             try:
+                from .bulk_events import sync_deals as sync_deals_old
                 sync_deals_old(event)
             except Exception as e:
                 error_log = traceback.format_exc()
@@ -144,10 +180,23 @@ def handle_event(event):
                            subject=f"[{ENV_.upper()}] Hubspot Sync Failed error logs",
                            content=html_content, content_type="html",
                            email_cc_list=[], importance=True)
+        elif event_job == 'FANOUT_SYNC':
+            from .fanout_sync import start_fanout, FANOUT_STARTED
+            if start_fanout(event, context) == FANOUT_STARTED:
+                # the worker that merges the shards updates the sync status
+                return "started"
+
+        elif event_job == 'SYNC_SHARD':
+            from .fanout_sync import run_shard_event
+            if not run_shard_event(event):
+                return "staged"
+
         elif event_job == 'BACK_FILL_FETCH':
+            from .events import back_fill_deals
             back_fill_deals(event)
 
         elif event_job == 'BULK_DEALS_UPDATE':
+            from .events import bulk_deals_fetch
             bulk_deals_fetch(event)
 
         else:
@@ -163,8 +212,18 @@ def handle_event(event):
         return "failed"
 
 
+def report_caches():
+    """Report the company cache of this invocation, when the route loaded it."""
+    company_cache_module = sys.modules.get(f"{__package__}.utils.company_cache")
+    if company_cache_module is not None:
+        company_cache_module.company_cache.report()
+
+
 def lambda_handler(event, context):
-    if 'httpMethod' in event:
-        return handle_api_request(event)
-    else:
-        return handle_event(event)
+    try:
+        if 'httpMethod' in event:
+            return handle_api_request(event)
+        else:
+            return handle_event(event, context)
+    finally:
+        report_caches()
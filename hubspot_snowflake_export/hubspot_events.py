@@ -1,37 +1,108 @@
+import base64
 import json
 
 from hubspot_snowflake_export.utils.config import HUBSPOT_SYNC_QUEUE
 
+# send_message_batch takes at most 10 entries
+SQS_BATCH_SIZE = 10
 
-def handle_webhook_from_hubspot(event, sqs):
-    print("======== Start: Received Webhook from HubSpot ========")
-    event_body = event.get('body', None)
 
-    queue_url = HUBSPOT_SYNC_QUEUE
+def response(status_code, message, **extra):
+    return {
+        "statusCode": status_code,
+        "body": json.dumps({"message": message, **extra})
+    }
 
-    if not event_body:
-        return {
-            "statusCode": 400,
-            "body": json.dumps({"message": f"Bad Request"})
-        }
 
+def parse_webhook_events(event):
+    """
+    :return: the webhook body as a list of events, None when it is missing or not JSON.
+        HubSpot webhook subscriptions post a list of events, workflow webhooks post one deal object.
+    """
+    event_body = event.get('body', None)
+    if not event_body:
+        return None
+    if event.get('isBase64Encoded'):
+        event_body = base64.b64decode(event_body)
     try:
+        payload = json.loads(event_body)
+    except ValueError:
+        return None
+    if isinstance(payload, dict):
+        return [payload]
+    if isinstance(payload, list):
+        return [item for item in payload if isinstance(item, dict)]
+    return None
+
 
-        response = sqs.send_message(
-            QueueUrl=queue_url,
-            MessageBody=event_body
-        )
+def deal_messages(webhook_events):
+    """
+    One message per deal, the body sqs_handler reads ({"hs_object_id": ...}) plus the time of the
+    latest event for the deal. Events of other objects (contacts, line items, ...) are ignored.
+    :return: deal id -> message body
+    """
+    messages = {}
+    for webhook_event in webhook_events:
+        subscription_type = webhook_event.get('subscriptionType') or 'deal.'
+        deal_id = webhook_event.get('hs_object_id') or webhook_event.get('objectId')
+        if not deal_id or not subscription_type.startswith('deal.'):
+            continue
+        deal_id = str(deal_id)
+        occurred_at = webhook_event.get('occurredAt')
+        message = messages.get(deal_id)
+        if message is None:
+            messages[deal_id] = {"hs_object_id": deal_id, "occurred_at": occurred_at}
+        elif occurred_at and (message['occurred_at'] or 0) < occurred_at:
+            message['occurred_at'] = occurred_at
+    return messages
+
+
+def send_deal_messages(sqs, messages, queue_url=HUBSPOT_SYNC_QUEUE):
+    """
+    Send the messages with send_message_batch, entries SQS failed on its side are sent once more.
+    :param messages: deal id -> message body
+    :return: deal ids that could not be enqueued
+    """
+    entries = [{"Id": str(index), "MessageBody": json.dumps(message)}
+               for index, message in enumerate(messages.values())]
+    deal_ids = list(messages)
+    failed = []
+    for attempt in range(2):
+        retry = []
+        for start in range(0, len(entries), SQS_BATCH_SIZE):
+            batch = entries[start:start + SQS_BATCH_SIZE]
+            try:
+                result = sqs.send_message_batch(QueueUrl=queue_url, Entries=batch)
+            except Exception as e:
+                print(f"Error sending messages to SQS: {str(e)}")
+                retry.extend(batch)
+                continue
+            for failure in result.get('Failed', []):
+                print(f"SQS rejected message for deal {deal_ids[int(failure['Id'])]}: {failure.get('Message')}")
+                entry = next(entry for entry in batch if entry['Id'] == failure['Id'])
+                (failed if failure.get('SenderFault') else retry).append(entry)
+        entries = retry
+        if not entries:
+            break
+    failed.extend(entries)
+    return [deal_ids[int(entry['Id'])] for entry in failed]
+
+
+def handle_webhook_from_hubspot(event, sqs):
+    print("======== Start: Received Webhook from HubSpot ========")
+    webhook_events = parse_webhook_events(event)
+    if webhook_events is None:
+        return response(400, "Bad Request")
 
-        print("Message Sent! Message ID:", response['MessageId'])
+    messages = deal_messages(webhook_events)
+    if not messages:
+        print(f"No deal events in {len(webhook_events)} webhook events")
+        return response(200, "Ignored")
 
-        return {
-            'statusCode': 201,
-            'body': json.dumps({"message": "Accepted"})
-        }
+    failed_deal_ids = send_deal_messages(sqs, messages)
+    if failed_deal_ids:
+        # HubSpot retries the whole webhook on a 5xx, sqs_handler dedups the deals already enqueued
+        return response(500, "Internal Error", failed=len(failed_deal_ids))
 
-    except Exception as e:
-        print(f"Error sending message to SQS: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({"message": f"Internal Error"})
-        }
+    print(f"Enqueued {len(messages)} deals from {len(webhook_events)} webhook events")
+    return response(201, "Accepted")
@@ -1,64 +1,177 @@
-import json
+import re
+import time
 import traceback
 
+import requests
+from snowflake.connector.errors import OperationalError, InterfaceError
+
 from hubspot_snowflake_export.bulk_events import sync_deals
 from hubspot_snowflake_export.handle_deal import handle_deal
-from hubspot_snowflake_export.utils.config import SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE, ENV_
+from hubspot_snowflake_export.hubspot_events import send_deal_messages
+from hubspot_snowflake_export.utils.aws import get_client
+from hubspot_snowflake_export.utils.batch_planner import batch_planner
+from hubspot_snowflake_export.utils.config import SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE, ENV_, \
+    SQS_MIN_REMAINING_MS
+from hubspot_snowflake_export.utils.deal_sync_window import deal_sync_window, latest_changes, now_ms
+from hubspot_snowflake_export.utils.company_cache import company_cache
 from hubspot_snowflake_export.utils.hubspot_api import get_deal
+from hubspot_snowflake_export.utils.metrics import put_metric
 from hubspot_snowflake_export.utils.s3 import update_deals_last_sync_time
 from hubspot_snowflake_export.utils.send_mail import send_email
-from hubspot_snowflake_export.utils.snowflake_db import create_sf_connection, close_sf_connection
+from hubspot_snowflake_export.utils.snowflake_db import get_sf_connection, release_sf_connection
 
 
-def lambda_handler(event, context):
-    print("Received SQS Batch Size of", len(event['Records']))
+def seconds_left(context):
+    return None if context is None else context.get_remaining_time_in_millis() / 1000
+
+
+def out_of_time(context):
+    return context is not None and context.get_remaining_time_in_millis() < SQS_MIN_REMAINING_MS
+
+
+def sync_single_deal(deal_id):
+    sf_conn = get_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
+    try:
+        deal_details = get_deal(deal_id)
+        handle_deal(deal_details, sf_conn.cursor())
+    finally:
+        release_sf_connection(sf_conn)
 
-    deal_ids = []
-    for record in event['Records']:
-        message_body = record['body']
-        deal_to_update = json.loads(message_body).get('hs_object_id', None)
-        if deal_to_update:
-            deal_ids.append(deal_to_update)
-
-    print(f"DEBUG: DEALS BEFORE SET: {len(deal_ids)}")
-    deal_ids = list(set(deal_ids))
-    print(f"DEBUG: DEALS AFTER SET: {len(deal_ids)}")
-
-    if deal_ids and len(deal_ids) == 1:
-        sf_conn = create_sf_connection(SF_WAREHOUSE, SF_DATABASE, SF_SCHEMA, SF_ROLE)
-        sf_cursor = sf_conn.cursor()
-        for deal_id in deal_ids:
-            try:
-                deal_details = get_deal(deal_id)
-                handle_deal(deal_details, sf_cursor)
-            except Exception as e:
-                error_log = traceback.format_exc()
-                html_content = f'''
-                <h1>Hubspot Sync Failed for Deal - {deal_id}</h1><br>
-                <h2>Error:</h2><br>
-                <b>{str(e)}</b><br>
-                <pre>{error_log}</pre>
-                '''
-                send_email(["Ramakrishna.Pinni@blend360.com", "oveek.chatterjee@blend360.com", "Krishna.Undamatla@blend360.com"], subject=f"[{ENV_.upper()}] Hubspot Sync Failed error logs",
-                           content=html_content, content_type="html",
-                           email_cc_list=[], importance=True)
-                print(f"[Webhook] Deal sync failed for - {deal_id}")
-        close_sf_connection(sf_conn)
-    else:
+
+def is_systemic_error(ex):
+    """
+    True for errors that are not about the deals being synced, which a smaller sync would hit again:
+    network errors, Snowflake connection errors and HubSpot auth, rate limit and server errors.
+    """
+    if isinstance(ex, (requests.ConnectionError, requests.Timeout, OperationalError, InterfaceError)):
+        return True
+    # call_api raises "Error fetching data: <status> - <body>" once its retries are used up
+    status = re.match(r"Error fetching data: (\d{3}) ", str(ex))
+    return status is not None and (status.group(1) in ("401", "403", "429") or status.group(1).startswith("5"))
+
+
+def fail_deals(deal_ids, error_log, errors):
+    for deal_id in deal_ids:
+        errors[deal_id] = error_log
+    return []
+
+
+def sync_isolating_failures(deal_ids, context, errors):
+    """
+    Sync deal_ids, one deal with handle_deal and several with the bulk sync. When the bulk sync fails
+    because of one of the deals, the deals are synced again one at a time with handle_deal, so a deal
+    that cannot be synced only fails itself. Systemic errors fail every deal without retrying them.
+    :param errors: deal id -> error of its failed sync, filled in for the deals that failed or were not
+        attempted before the invocation ran out of time
+    :return: deal ids synced
+    """
+    if out_of_time(context):
+        return fail_deals(deal_ids, "Not attempted, the invocation ran out of time", errors)
+    if len(deal_ids) > 1:
+        sync_started_at = now_ms()
         try:
             sync_deals({"deal_ids": deal_ids})
-        except Exception as e:
+            deal_sync_window.mark_synced(deal_ids, sync_started_at)
+            return deal_ids
+        except Exception as ex:
+            error_log = traceback.format_exc()
+            print(error_log)
+            if is_systemic_error(ex):
+                print(f"[Webhook] Sync failed for {len(deal_ids)} deals with an error not specific to a deal")
+                return fail_deals(deal_ids, error_log, errors)
+        print(f"[Webhook] Sync failed for {len(deal_ids)} deals, retrying them one at a time")
+
+    synced = []
+    for index, deal_id in enumerate(deal_ids):
+        if out_of_time(context):
+            return synced + fail_deals(deal_ids[index:], "Not attempted, the invocation ran out of time", errors)
+        sync_started_at = now_ms()
+        try:
+            sync_single_deal(deal_id)
+        except Exception as ex:
             error_log = traceback.format_exc()
-            html_content = f'''
-            <h1>Hubspot Sync Failed for Deals</h1><br>
-            <b>Deals: {deal_ids}</b><br>
-            <h2>Error:</h2><br>
-            <b>{str(e)}</b><br>
-            <pre>{error_log}</pre>
-            '''
-            send_email(["Ramakrishna.Pinni@blend360.com", "oveek.chatterjee@blend360.com", "Krishna.Undamatla@blend360.com"], subject=f"[{ENV_.upper()}] Hubspot Sync Failed error logs",
-                       content=html_content, content_type="html",
-                       email_cc_list=[], importance=True)
-
-    update_deals_last_sync_time("HUBSPOT_WEBHOOK", 'SUCCESS')
-    return "Success"
+            print(error_log)
+            print(f"[Webhook] Deal sync failed for - {deal_id}")
+            errors[deal_id] = error_log
+            if is_systemic_error(ex):
+                return synced + fail_deals(deal_ids[index + 1:], error_log, errors)
+            continue
+        deal_sync_window.mark_synced([deal_id], sync_started_at)
+        synced.append(deal_id)
+    return synced
+
+
+def sync_planned(deal_ids, context, errors):
+    """
+    Sync deal_ids in chunks sized by batch_planner, measuring each chunk that synced without failures.
+    :return: deal ids left when the next chunk would not end before the timeout
+    """
+    pending = list(deal_ids)
+    while pending:
+        mode, count = batch_planner.plan(len(pending), seconds_left(context))
+        if not count:
+            break
+        chunk, pending = pending[:count], pending[count:]
+        print(f"Syncing {len(chunk)} deals ({mode}), {len(pending)} left")
+        started = time.monotonic()
+        synced = sync_isolating_failures(chunk, context, errors)
+        if len(synced) == len(chunk):
+            batch_planner.observe(mode, len(chunk), time.monotonic() - started)
+    batch_planner.report()
+    return pending
+
+
+def requeue_deals(deal_ids, changes, errors):
+    """
+    Send the deals the invocation has no time for back to the queue as new messages, so their messages
+    in this batch are acknowledged instead of counting towards the dead-letter queue.
+    """
+    messages = {deal_id: {"hs_object_id": deal_id, "occurred_at": changes[deal_id]} for deal_id in deal_ids}
+    failed_deal_ids = send_deal_messages(get_client('sqs'), messages)
+    for deal_id in failed_deal_ids:
+        errors[deal_id] = "Not attempted, the invocation ran out of time and the deal could not be requeued"
+    print(f"Requeued {len(deal_ids) - len(failed_deal_ids)} deals the invocation had no time for")
+    put_metric("WebhookDealsRequeued", len(deal_ids) - len(failed_deal_ids))
+
+
+def report_failures(errors):
+    error_logs = ''.join(f'''
+        <h2>Deal {deal_id}:</h2><br>
+        <pre>{error_log}</pre>
+        ''' for deal_id, error_log in errors.items())
+    html_content = f'''
+    <h1>Hubspot Sync Failed for Deals</h1><br>
+    <b>Deals: {list(errors)}</b><br>
+    <b>Their messages go back to the queue and are retried on their own.</b><br>
+    {error_logs}
+    '''
+    send_email(["Ramakrishna.Pinni@blend360.com", "oveek.chatterjee@blend360.com", "Krishna.Undamatla@blend360.com"], subject=f"[{ENV_.upper()}] Hubspot Sync Failed error logs",
+               content=html_content, content_type="html",
+               email_cc_list=[], importance=True)
+
+
+def lambda_handler(event, context):
+    """
+    Sync the deals of an SQS batch. The function reports partial batch failures (ReportBatchItemFailures
+    in template.yaml), only the messages of deals that failed are returned to the queue. Deals there is
+    no time left for are sent to the queue again.
+    """
+    print("Received SQS Batch Size of", len(event['Records']))
+
+    changes, message_ids = latest_changes(event['Records'])
+    print(f"DEBUG: DEALS BEFORE SET: {len(event['Records'])}")
+    print(f"DEBUG: DEALS AFTER SET: {len(changes)}")
+    deal_ids = deal_sync_window.deals_to_sync(changes)
+
+    errors = {}
+    pending = sync_planned(deal_ids, context, errors) if deal_ids else []
+    if pending:
+        requeue_deals(pending, changes, errors)
+    if errors:
+        report_failures(errors)
+    put_metric("WebhookDealSyncFailures", len(errors))
+
+    company_cache.report()
+    update_deals_last_sync_time("HUBSPOT_WEBHOOK", 'FAILED' if errors else 'SUCCESS')
+    return {"batchItemFailures": [{"itemIdentifier": message_id}
+                                  for deal_id in errors for message_id in message_ids[deal_id]]}
@@ -0,0 +1,19 @@
+import threading
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service):
+    """
+    boto3 client for service, created on first use and kept for warm invocations of the container.
+    boto3 is imported here rather than at module level, routes that never call AWS skip loading it.
+    """
+    client = _clients.get(service)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service)
+            if client is None:
+                import boto3
+                client = _clients[service] = boto3.client(service)
+    return client
@@ -0,0 +1,104 @@
+"""
+Chunking of the SQS consumer's deals by measured sync cost and the invocation's remaining time.
+
+A bulk sync (bulk_events.sync_deals) pays a large fixed cost, it pages every company and line item
+from HubSpot, plus a cost per deal for the deal fetch, the enrichment and the Snowflake MERGEs. A
+single-deal sync (handle_deal) has no fixed cost but is slower per deal. Both are measured on every
+sync and kept for warm invocations of the container, starting from the SQS_*_SECONDS defaults:
+bulk syncs as a least squares fit of seconds = overhead + per deal * deals that forgets old syncs,
+single-deal syncs as a moving average.
+
+For the deals left, the planner picks whichever path is cheaper and the largest chunk that still ends
+SQS_MIN_REMAINING_MS before the timeout. When nothing fits, sqs_handler sends the deals left back to
+the queue instead of running into the timeout.
+"""
+import math
+import threading
+
+from hubspot_snowflake_export.utils.config import SQS_BULK_SYNC_OVERHEAD_SECONDS, SQS_BULK_SYNC_DEAL_SECONDS, \
+    SQS_SINGLE_SYNC_SECONDS, SQS_MAX_CHUNK_DEALS, SQS_MIN_REMAINING_MS
+
+SINGLE = "single"
+BULK = "bulk"
+
+
+class LinearCost:
+    """seconds = intercept + slope * deals, fitted over observations weighted down by `decay` per observation."""
+
+    def __init__(self, intercept, slope, decay=0.8):
+        self.default = (intercept, slope)
+        self.decay = decay
+        # weight, sum x, sum x^2, sum y, sum x*y
+        self.sums = [0.0] * 5
+
+    def observe(self, deals, seconds):
+        self.sums = [total * self.decay for total in self.sums]
+        for index, value in enumerate((1.0, deals, deals * deals, seconds, deals * seconds)):
+            self.sums[index] += value
+
+    def estimate(self):
+        weight, sum_x, sum_xx, sum_y, sum_xy = self.sums
+        if not weight:
+            return self.default
+        variance = weight * sum_xx - sum_x * sum_x
+        if variance <= 1e-6 * weight * sum_xx:
+            # every sync had the same number of deals, keep the slope and fit the overhead
+            slope = self.default[1]
+        else:
+            slope = max((weight * sum_xy - sum_x * sum_y) / variance, 0.0)
+        return max((sum_y - slope * sum_x) / weight, 0.0), slope
+
+
+class MovingAverage:
+
+    def __init__(self, value, alpha=0.3):
+        self.value = value
+        self.alpha = alpha
+
+    def observe(self, value):
+        self.value += self.alpha * (value - self.value)
+
+
+class BatchPlanner:
+
+    def __init__(self):
+        self.bulk = LinearCost(SQS_BULK_SYNC_OVERHEAD_SECONDS, SQS_BULK_SYNC_DEAL_SECONDS)
+        self.single = MovingAverage(SQS_SINGLE_SYNC_SECONDS)
+        self._lock = threading.Lock()
+
+    def plan(self, deal_count, seconds_left=None):
+        """
+        :param seconds_left: time left in the invocation, None when it is not bounded (local runs)
+        :return: (SINGLE or BULK, number of deals to sync next), 0 deals when none fits in the time left.
+            SINGLE syncs one deal, the next deals are planned again with its cost measured.
+        """
+        with self._lock:
+            intercept, slope = self.bulk.estimate()
+            single_seconds = self.single.value
+        budget = math.inf if seconds_left is None else seconds_left - SQS_MIN_REMAINING_MS / 1000
+        bulk_count = min(deal_count, SQS_MAX_CHUNK_DEALS)
+        single_count = min(deal_count, 1)
+        if budget != math.inf:
+            bulk_count = min(bulk_count, int((budget - intercept) / slope) if slope else
+                             (bulk_count if budget >= intercept else 0))
+            single_count = min(single_count, int(budget / single_seconds) if single_seconds else 1)
+        bulk_count = max(bulk_count, 0)
+        single_count = max(single_count, 0)
+        # a bulk sync of one deal is never cheaper than handle_deal
+        if bulk_count < 2 or single_seconds * bulk_count <= intercept + slope * bulk_count:
+            return SINGLE, single_count
+        return BULK, bulk_count
+
+    def observe(self, mode, deals, seconds):
+        with self._lock:
+            if mode == SINGLE:
+                self.single.observe(seconds / deals)
+            else:
+                self.bulk.observe(deals, seconds)
+
+    def report(self):
+        intercept, slope = self.bulk.estimate()
+        print(f"Sync cost - bulk {intercept:.1f}s + {slope:.2f}s per deal, single {self.single.value:.1f}s per deal")
+
+
+batch_planner = BatchPlanner()
@@ -0,0 +1,48 @@
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Process-wide cache of one value loaded by `loader`, kept for `ttl` seconds. Module-level
+    instances survive across warm Lambda invocations. Concurrent callers on a miss wait for a
+    single load instead of each calling the loader.
+    """
+
+    def __init__(self, name, loader, ttl):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.value = None
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def is_fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    def age(self):
+        return None if self.loaded_at is None else time.monotonic() - self.loaded_at
+
+    def get(self):
+        if self.is_fresh():
+            self.hits += 1
+            return self.value
+        with self._lock:
+            if self.is_fresh():
+                self.hits += 1
+                return self.value
+            self.misses += 1
+            value = self.loader()
+            self.set(value)
+            print(f"Loaded {self.name} cache")
+            return value
+
+    def set(self, value):
+        self.value = value
+        self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self.loaded_at = None
+        print(f"Invalidated {self.name} cache")
@@ -0,0 +1,94 @@
+"""
+Companies by id, shared across deals and warm invocations of a container.
+
+A company fetched within COMPANY_CACHE_TTL is served from memory instead of HubSpot. Every row
+MERGEd into HUBSPOT_COMPANIES is remembered by a hash of its content, and the same row is not
+written again within the TTL, so accounts with many deals are written once instead of once per deal.
+"""
+import hashlib
+import json
+import threading
+import time
+
+from hubspot_snowflake_export.utils.config import COMPANY_CACHE_TTL
+from hubspot_snowflake_export.utils.hubspot_api import get_company_objects_by_ids_batch
+from hubspot_snowflake_export.utils.metrics import put_metric
+
+
+def content_hash(row):
+    return hashlib.sha1(json.dumps(row, default=str).encode('utf-8')).hexdigest()
+
+
+class CompanyCache:
+
+    def __init__(self, ttl=COMPANY_CACHE_TTL):
+        self.ttl = ttl
+        self.companies = {}
+        self.written = {}
+        self.stats = {"lookups": 0, "hits": 0, "writes": 0, "skipped": 0}
+        self._lock = threading.Lock()
+
+    def is_fresh(self, cached_at):
+        return time.monotonic() - cached_at < self.ttl
+
+    def get_companies(self, company_ids):
+        """
+        :return: company id -> company as returned by HubSpot, companies HubSpot does not return are left out
+        """
+        company_ids = {str(company_id) for company_id in company_ids if company_id}
+        with self._lock:
+            cached = {company_id: self.companies[company_id][0] for company_id in company_ids
+                      if company_id in self.companies and self.is_fresh(self.companies[company_id][1])}
+            self.stats["lookups"] += len(company_ids)
+            self.stats["hits"] += len(cached)
+        missing_company_ids = [company_id for company_id in company_ids if company_id not in cached]
+        if missing_company_ids:
+            fetched = get_company_objects_by_ids_batch(missing_company_ids)
+            now = time.monotonic()
+            with self._lock:
+                for company_id, company in fetched.items():
+                    self.companies[company_id] = (company, now)
+            cached.update(fetched)
+        return cached
+
+    def get_company(self, company_id):
+        return self.get_companies([company_id]).get(str(company_id))
+
+    def rows_to_write(self, rows):
+        """
+        Rows whose content differs from what was written for the same company within the TTL.
+        :param rows: tuples in HUBSPOT_COMPANIES column order, company id first
+        """
+        with self._lock:
+            changed = []
+            for row in rows:
+                written = self.written.get(str(row[0]))
+                if written and written[0] == content_hash(row) and self.is_fresh(written[1]):
+                    self.stats["skipped"] += 1
+                else:
+                    changed.append(row)
+            return changed
+
+    def mark_written(self, rows):
+        now = time.monotonic()
+        with self._lock:
+            for row in rows:
+                self.written[str(row[0])] = (content_hash(row), now)
+            self.stats["writes"] += len(rows)
+
+    def report(self):
+        """Print and emit this run's hit and skip rates, then start counting the next run."""
+        with self._lock:
+            stats, self.stats = self.stats, {"lookups": 0, "hits": 0, "writes": 0, "skipped": 0}
+        if not stats["lookups"] and not stats["writes"] and not stats["skipped"]:
+            return
+        hit_rate = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        considered = stats["writes"] + stats["skipped"]
+        skip_rate = stats["skipped"] / considered if considered else 0.0
+        print(f"Company cache - {stats['hits']}/{stats['lookups']} lookups from memory ({hit_rate:.0%}), "
+              f"{stats['skipped']}/{considered} unchanged writes skipped ({skip_rate:.0%})")
+        put_metric("CompanyCacheHitRate", hit_rate * 100, "Percent")
+        put_metric("CompanyWriteSkipRate", skip_rate * 100, "Percent")
+
+
+company_cache = CompanyCache()
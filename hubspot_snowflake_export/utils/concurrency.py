@@ -0,0 +1,57 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from hubspot_snowflake_export.utils.config import HUBSPOT_MAX_WORKERS
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def map_concurrently(fn, items, max_workers=HUBSPOT_MAX_WORKERS):
+    """
+    Apply fn to every item on a bounded thread pool.
+    :return: results in the same order as items
+    """
+    if len(items) <= 1 or max_workers <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+
+def run_task_graph(tasks, max_workers=HUBSPOT_MAX_WORKERS):
+    """
+    Run tasks as soon as the tasks they depend on have finished, independent tasks concurrently.
+    Prints one line per graph with its wall-clock time and slowest task.
+    :param tasks: dict of name -> (fn, [dependency names]); fn gets each dependency's result as a keyword argument
+    :return: dict of name -> result
+    """
+    started = time.perf_counter()
+    results = {}
+    elapsed = {}
+    remaining = dict(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while remaining or running:
+            for name, (fn, dependencies) in list(remaining.items()):
+                if all(dependency in results for dependency in dependencies):
+                    kwargs = {dependency: results[dependency] for dependency in dependencies}
+                    running[executor.submit(_timed, fn, kwargs)] = name
+                    del remaining[name]
+            if not running:
+                raise ValueError(f"Unresolvable task dependencies: {list(remaining)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], elapsed[name] = future.result()
+    slowest = max(elapsed, key=elapsed.get, default=None)
+    if slowest is not None:
+        print(f"done {len(elapsed)} tasks in {time.perf_counter() - started:.2f}s, "
+              f"slowest {slowest} in {elapsed[slowest]:.2f}s")
+    return results
+
+
+def _timed(fn, kwargs):
+    started = time.perf_counter()
+    result = fn(**kwargs)
+    return result, time.perf_counter() - started
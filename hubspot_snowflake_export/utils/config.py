@@ -26,4 +26,57 @@ S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 HUBSPOT_SYNC_QUEUE = os.getenv("HUBSPOT_SYNC_QUEUE")
 LOCAL_CACHE = os.getenv("LOCAL_CACHE")
 
+HUBSPOT_POOL_SIZE = int(os.getenv("HUBSPOT_POOL_SIZE", "10"))
+HUBSPOT_KEEP_ALIVE = os.getenv("HUBSPOT_KEEP_ALIVE", "True")
+HUBSPOT_MAX_RETRIES = int(os.getenv("HUBSPOT_MAX_RETRIES", "3"))
+HUBSPOT_RETRY_BASE_DELAY = float(os.getenv("HUBSPOT_RETRY_BASE_DELAY", "0.5"))
+HUBSPOT_RETRY_MAX_DELAY = float(os.getenv("HUBSPOT_RETRY_MAX_DELAY", "30"))
+HUBSPOT_RATE_LIMIT_PER_SECOND = float(os.getenv("HUBSPOT_RATE_LIMIT_PER_SECOND", "10"))
+HUBSPOT_RATE_LIMIT_BURST = int(os.getenv("HUBSPOT_RATE_LIMIT_BURST", "100"))
+HUBSPOT_SEARCH_RATE_LIMIT_PER_SECOND = float(os.getenv("HUBSPOT_SEARCH_RATE_LIMIT_PER_SECOND", "4"))
+HUBSPOT_MAX_WORKERS = int(os.getenv("HUBSPOT_MAX_WORKERS", "4"))
+HUBSPOT_SEARCH_SHARDS = int(os.getenv("HUBSPOT_SEARCH_SHARDS", "8"))
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", "1000"))
+# MANUAL_SYNC jobs, see utils/sync_jobs.py. Windows start this long and are halved when one does not
+# fit in an invocation, a new window or chunk is not started with less than SYNC_JOB_MIN_REMAINING_MS left
+SYNC_JOB_WINDOW_HOURS = float(os.getenv("SYNC_JOB_WINDOW_HOURS", "720"))
+SYNC_JOB_MIN_REMAINING_MS = int(os.getenv("SYNC_JOB_MIN_REMAINING_MS", "180000"))
+SYNC_JOB_MAX_INVOCATIONS = int(os.getenv("SYNC_JOB_MAX_INVOCATIONS", "100"))
+# a PROCESSING sync status older than this no longer blocks a new sync, the sync is taken to have died
+SYNC_PROCESSING_TIMEOUT_HOURS = float(os.getenv("SYNC_PROCESSING_TIMEOUT_HOURS", "24"))
+# scheduled fetches move their watermark to this long before the fetch started, HubSpot's search index lags
+SYNC_WATERMARK_LAG_SECONDS = float(os.getenv("SYNC_WATERMARK_LAG_SECONDS", "10"))
+# worker invocations of a FANOUT_SYNC that does not set workers, see fanout_sync.py
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "4"))
+BATCH_UPSERT_SIZE = int(os.getenv("BATCH_UPSERT_SIZE", "200"))
+# COPY loads temp tables through a stage, INSERT uses executemany
+SF_LOAD_METHOD = os.getenv("SF_LOAD_METHOD", "COPY")
+SF_COPY_MIN_ROWS = int(os.getenv("SF_COPY_MIN_ROWS", "500"))
+# file format of columnar COPY loads, CSV or PARQUET. pyarrow is not in requirements.txt, PARQUET needs it
+# installed (e.g. from a layer) and falls back to CSV without it
+SF_COPY_FORMAT = os.getenv("SF_COPY_FORMAT", "CSV")
+# orjson is used for HubSpot payloads and the JSON columns when installed, set to "json" to use the stdlib
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson")
+# keep the Snowflake connection open across warm invocations of a Lambda container
+SF_CONNECTION_REUSE = os.getenv("SF_CONNECTION_REUSE", "True")
+# a reused connection idle for longer than this is checked with SELECT 1 before it is handed out
+SF_CONNECTION_VALIDATE_AFTER = float(os.getenv("SF_CONNECTION_VALIDATE_AFTER", "60"))
+# reconnect before Snowflake's 4 hour session timeout instead of failing on the first query after it
+SF_CONNECTION_MAX_AGE = float(os.getenv("SF_CONNECTION_MAX_AGE", "12600"))
+PIPELINE_STAGES_TTL = float(os.getenv("PIPELINE_STAGES_TTL", "3600"))
+# the owner directory lists active owners again after this many seconds, see utils/owner_directory.py
+OWNER_DIRECTORY_TTL = float(os.getenv("OWNER_DIRECTORY_TTL", "900"))
+# companies fetched or written within this many seconds are not fetched or MERGEd again when unchanged
+COMPANY_CACHE_TTL = float(os.getenv("COMPANY_CACHE_TTL", "3600"))
+# webhook messages for deal changes made before the deal's last sync started are dropped, sync
+# start times are kept this many seconds, see utils/deal_sync_window.py
+DEAL_SYNC_WINDOW = float(os.getenv("DEAL_SYNC_WINDOW", "300"))
+# the SQS consumer stops starting syncs with less time left, their messages go back to the queue
+SQS_MIN_REMAINING_MS = int(os.getenv("SQS_MIN_REMAINING_MS", "120000"))
+# starting estimates of the SQS consumer's sync cost, replaced by measured syncs, see utils/batch_planner.py
+SQS_BULK_SYNC_OVERHEAD_SECONDS = float(os.getenv("SQS_BULK_SYNC_OVERHEAD_SECONDS", "60"))
+SQS_BULK_SYNC_DEAL_SECONDS = float(os.getenv("SQS_BULK_SYNC_DEAL_SECONDS", "0.2"))
+SQS_SINGLE_SYNC_SECONDS = float(os.getenv("SQS_SINGLE_SYNC_SECONDS", "3"))
+SQS_MAX_CHUNK_DEALS = int(os.getenv("SQS_MAX_CHUNK_DEALS", "500"))
+
 ENV_ = os.getenv("ENV_")
\ No newline at end of file
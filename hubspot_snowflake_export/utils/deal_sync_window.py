@@ -0,0 +1,88 @@
+"""
+Coalescing of webhook messages per deal, shared across warm invocations of the SQS consumer.
+
+Every sync of a deal reads its state from HubSpot after the sync started, so a message for a change
+made before the last successful sync started has nothing left to sync. Deals are remembered for
+DEAL_SYNC_WINDOW seconds with the time their last successful sync started, and messages for changes
+older than that are dropped instead of syncing the deal again. A deal edited 20 times within a batch
+window and the following minutes is synced once per burst, with the state after its latest change.
+
+The time of a change is the webhook's occurredAt (see hubspot_events.deal_messages), or the time SQS
+received the message when the body has none, which is never earlier than the change.
+"""
+import json
+import threading
+import time
+
+from hubspot_snowflake_export.utils.config import DEAL_SYNC_WINDOW
+from hubspot_snowflake_export.utils.metrics import put_metric
+
+# changes up to this long before a sync started still sync the deal again, HubSpot's clock and reads
+# may lag ours by a little
+SYNC_START_MARGIN_MS = 5000
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def latest_changes(records):
+    """
+    :param records: SQS records
+    :return: deal id -> time in ms of its latest change, in the order the deals first appear, and
+        deal id -> ids of its messages. Records without a deal id or a JSON body are left out.
+    """
+    changes = {}
+    message_ids = {}
+    for record in records:
+        try:
+            message = json.loads(record['body'])
+        except ValueError:
+            print(f"Dropping message {record.get('messageId')}, body is not JSON: {record['body'][:200]}")
+            continue
+        deal_id = message.get('hs_object_id', None) if isinstance(message, dict) else None
+        if not deal_id:
+            continue
+        deal_id = str(deal_id)
+        changed_at = message.get('occurred_at') or int(record.get('attributes', {}).get('SentTimestamp', 0)) or None
+        if deal_id not in changes or (changed_at and (changes[deal_id] or 0) < changed_at):
+            changes[deal_id] = changed_at
+        message_ids.setdefault(deal_id, []).append(record.get('messageId'))
+    return changes, message_ids
+
+
+class DealSyncWindow:
+
+    def __init__(self, window=DEAL_SYNC_WINDOW):
+        self.window = window
+        self.synced = {}
+        self._lock = threading.Lock()
+
+    def expire(self, now):
+        expired = [deal_id for deal_id, started_at in self.synced.items() if now - started_at >= self.window * 1000]
+        for deal_id in expired:
+            del self.synced[deal_id]
+
+    def deals_to_sync(self, changes):
+        """
+        :param changes: deal id -> time in ms of its latest change, None when it is not known
+        :return: deal ids with a change made after their last sync in the window started
+        """
+        with self._lock:
+            self.expire(now_ms())
+            deal_ids = [deal_id for deal_id, changed_at in changes.items()
+                        if deal_id not in self.synced or not changed_at
+                        or changed_at >= self.synced[deal_id] - SYNC_START_MARGIN_MS]
+        if len(deal_ids) < len(changes):
+            print(f"Coalesced {len(changes) - len(deal_ids)} of {len(changes)} deals, synced after their last change")
+        put_metric("WebhookDealsCoalesced", len(changes) - len(deal_ids))
+        return deal_ids
+
+    def mark_synced(self, deal_ids, started_at):
+        """:param started_at: time in ms the sync started, before anything was read from HubSpot"""
+        with self._lock:
+            for deal_id in deal_ids:
+                self.synced[str(deal_id)] = max(started_at, self.synced.get(str(deal_id), 0))
+
+
+deal_sync_window = DealSyncWindow()
@@ -1,16 +1,28 @@
 import os
+import queue
+import threading
+import time
 
 import json
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import requests
-
-from hubspot_snowflake_export.utils.config import SYNC_ALERT_TO_EMAILS, SYNC_ALERT_CC_EMAILS, ENV_, LOCAL_CACHE
+from requests.adapters import HTTPAdapter
+
+from hubspot_snowflake_export.utils.config import SYNC_ALERT_TO_EMAILS, SYNC_ALERT_CC_EMAILS, ENV_, LOCAL_CACHE, \
+    HUBSPOT_POOL_SIZE, HUBSPOT_KEEP_ALIVE, HUBSPOT_MAX_RETRIES, HUBSPOT_MAX_WORKERS, HUBSPOT_SEARCH_SHARDS, \
+    PIPELINE_STAGES_TTL
+from hubspot_snowflake_export.utils.cache import TTLCache
+from hubspot_snowflake_export.utils.concurrency import map_concurrently, chunks
+from hubspot_snowflake_export.utils.jsonlib import dumps_bytes, response_json
+from hubspot_snowflake_export.utils.rate_limiter import hubspot_rate_limiter, hubspot_search_rate_limiter, \
+    is_retryable, retry_delay, backoff_delay
 from hubspot_snowflake_export.utils.send_mail import send_email
 
 # HubSpot API base URL
-BASE_URL = "https://api.hubapi.com"
+BASE_URL = os.getenv("HUBSPOT_BASE_URL", "https://api.hubapi.com")
 
 # HubSpot API Key
 API_KEY = os.getenv("HUBSPOT_API_KEY")
@@ -20,6 +32,73 @@ auth_headers = {
     'Content-Type': 'application/json'
 }
 
+
+class HubspotClient:
+    """
+    Owns the pooled requests.Session used by every HubSpot call in this module.
+    The session is created lazily and kept at module scope, so TCP/TLS connections
+    to api.hubapi.com are reused across calls and across warm Lambda invocations.
+    :param pool_size: max connections kept open to the HubSpot host
+    :param keep_alive: when False every request sends `Connection: close` (one connection per call)
+    :param rate_limiter: token bucket for the account-wide limit, shared with the async client
+    :param search_rate_limiter: token bucket for the CRM search endpoints
+    """
+
+    def __init__(self, pool_size=HUBSPOT_POOL_SIZE, keep_alive=HUBSPOT_KEEP_ALIVE == "True",
+                 rate_limiter=hubspot_rate_limiter, search_rate_limiter=hubspot_search_rate_limiter):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.rate_limiter = rate_limiter
+        self.search_rate_limiter = search_rate_limiter
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        # pool_block keeps concurrent callers waiting for a pooled connection instead of
+        # opening throw-away connections once the pool is exhausted
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def limiter_for(self, url):
+        return self.search_rate_limiter if url.split('?')[0].endswith('/search') else self.rate_limiter
+
+    def request(self, method, url, **kwargs):
+        limiter = self.limiter_for(url)
+        limiter.acquire()
+        response = self.session.request(method, url, **kwargs)
+        self.rate_limiter.update_from_headers(response.headers)
+        if response.status_code == 429:
+            limiter.pause(retry_delay(response, 0))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+hubspot_client = HubspotClient()
+
 deal_properties = [
     "expected_project_duration_in_months",
     "expected_project_start_date",
@@ -47,18 +126,12 @@ deal_properties = [
     "tech_involved"
 ]
 
-def fetch_updated_or_created_deals(start_date_time, sync_older=False, created_after="2024-01-01T00:00:00Z", use_backup=False,
-                                   deal_ids=None):
-    if deal_ids is None:
-        deal_ids = []
-    if use_backup:
-        with open("deals.json", "r") as f:
-            return json.load(f)
-    url = f"{BASE_URL}/crm/v3/objects/deals/search"
+# the CRM search API refuses to page past this many results for a single query
+SEARCH_RESULT_LIMIT = 10000
 
-    deals = []
-    has_more = True
-    after = "0"
+
+def get_deal_search_filters(start_date_time=None, sync_older=False, created_after="2024-01-01T00:00:00Z",
+                            deal_ids=None):
     filters = [
         {
             "propertyName": "pipeline",
@@ -66,7 +139,7 @@ def fetch_updated_or_created_deals(start_date_time, sync_older=False, created_af
             "values": ["74948272", "35923868", "663516528", "45724251"]
         }
     ]
-    if len(deal_ids) > 0:
+    if deal_ids:
         filters.append(
             {
                 "propertyName": "hs_object_id",
@@ -90,35 +163,209 @@ def fetch_updated_or_created_deals(start_date_time, sync_older=False, created_af
                 "value": created_after
             }
         )
-    while has_more:
-        payload = json.dumps({
-            "after": after,
-            "limit": 200,
-            "properties": deal_properties,
-            "filterGroups": [
-                {
-                    "filters": filters
-                }
-            ]
-        })
+    return filters
 
-        headers = {
-            'authorization': f'Bearer {API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        # response = requests.request("POST", url, headers=headers, data=payload, timeout=120)
-        # if response.status_code == 200:
-        #     data = response.json()
-        data = call_api("POST", url, headers=headers, payload=payload)
-        deals.extend(data['results'])
-        has_more = 'paging' in data and 'next' in data['paging']
-        after = data['paging']['next']['after'] if has_more else None
+
+def search_deals_page(filters, after="0"):
+    url = f"{BASE_URL}/crm/v3/objects/deals/search"
+    payload = dumps_bytes({
+        "after": after,
+        "limit": 200,
+        "properties": deal_properties,
+        "filterGroups": [
+            {
+                "filters": filters
+            }
+        ]
+    })
+    headers = {
+        'authorization': f'Bearer {API_KEY}',
+        'Content-Type': 'application/json'
+    }
+    return call_api("POST", url, headers=headers, payload=payload)
+
+
+def fetch_updated_or_created_deals(start_date_time, sync_older=False, created_after="2024-01-01T00:00:00Z", use_backup=False,
+                                   deal_ids=None, shards=1, max_workers=HUBSPOT_MAX_WORKERS):
+    """
+    Search deals in the exported pipelines.
+    :param shards: > 1 splits the hs_lastmodifieddate range into that many windows fetched concurrently
+    :param max_workers: max windows paged at the same time when sharding
+    """
+    if use_backup:
+        with open("deals.json", "r") as f:
+            return json.load(f)
+
+    deals_by_id = {}
+    for page in iter_updated_or_created_deals(start_date_time, sync_older=sync_older, created_after=created_after,
+                                              deal_ids=deal_ids, shards=shards, max_workers=max_workers):
+        for deal in page:
+            existing = deals_by_id.get(deal['id'])
+            if not existing or deal.get('updatedAt', '') >= existing.get('updatedAt', ''):
+                deals_by_id[deal['id']] = deal
+    deals = list(deals_by_id.values())
     if LOCAL_CACHE == "True":
         with open("deals.json", "w") as f:
             f.write(json.dumps(deals, indent=4))
     return deals
 
 
+def iter_updated_or_created_deals(start_date_time, sync_older=False, created_after="2024-01-01T00:00:00Z",
+                                  deal_ids=None, shards=1, max_workers=HUBSPOT_MAX_WORKERS):
+    """
+    Yield pages of deals in the exported pipelines as they are fetched, instead of collecting every deal first.
+    A deal can appear in more than one page when it is modified while the windows are being paged.
+    """
+    if deal_ids is None:
+        deal_ids = []
+
+    if shards > 1 and len(deal_ids) == 0:
+        yield from iter_deals_by_modified_windows(start_date_time, sync_older=sync_older, created_after=created_after,
+                                                  shards=shards, max_workers=max_workers)
+        return
+    filters = get_deal_search_filters(start_date_time, sync_older, created_after, deal_ids)
+    after = "0"
+    while after:
+        data = search_deals_page(filters, after)
+        if after == "0" and data.get('total', 0) > SEARCH_RESULT_LIMIT and len(deal_ids) == 0:
+            print(f"Search matched {data['total']} deals, above the {SEARCH_RESULT_LIMIT} search limit. "
+                  f"Fetching by hs_lastmodifieddate windows instead.")
+            yield from iter_deals_by_modified_windows(start_date_time, sync_older=sync_older,
+                                                      created_after=created_after, shards=max(shards, 2),
+                                                      max_workers=max_workers)
+            return
+        yield data['results']
+        after = data.get('paging', {}).get('next', {}).get('after')
+
+
+def to_epoch_ms(date_time_str):
+    return int(datetime.fromisoformat(date_time_str.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def split_window(window_start_ms, window_end_ms, parts):
+    step = max(1, -(-(window_end_ms - window_start_ms) // parts))
+    return [(lo, min(lo + step, window_end_ms)) for lo in range(window_start_ms, window_end_ms, step)]
+
+
+def modified_window_filters(base_filters, window_start_ms, window_end_ms):
+    return base_filters + [
+        {"propertyName": "hs_lastmodifieddate", "operator": "GTE", "value": str(window_start_ms)},
+        {"propertyName": "hs_lastmodifieddate", "operator": "LT", "value": str(window_end_ms)},
+    ]
+
+
+def count_deals_in_windows(windows, sync_older=False, created_after="2024-01-01T00:00:00Z",
+                           max_workers=HUBSPOT_MAX_WORKERS):
+    """
+    :param windows: (start, end) hs_lastmodifieddate windows in epoch ms, end exclusive
+    :return: number of deals the search matches in each window, one search call per window
+    """
+    base_filters = get_deal_search_filters(None, sync_older, created_after)
+    return map_concurrently(
+        lambda window: search_deals_page(modified_window_filters(base_filters, *window)).get('total', 0),
+        list(windows), max_workers=max_workers)
+
+
+def fetch_deals_by_modified_windows(start_date_time, end_date_time=None, sync_older=False,
+                                    created_after="2024-01-01T00:00:00Z", shards=HUBSPOT_SEARCH_SHARDS,
+                                    max_workers=HUBSPOT_MAX_WORKERS):
+    """
+    Page every hs_lastmodifieddate window and de-duplicate by deal id, keeping the latest version.
+    """
+    deals_by_id = {}
+    for page in iter_deals_by_modified_windows(start_date_time, end_date_time, sync_older, created_after, shards,
+                                               max_workers):
+        for deal in page:
+            existing = deals_by_id.get(deal['id'])
+            if not existing or deal.get('updatedAt', '') >= existing.get('updatedAt', ''):
+                deals_by_id[deal['id']] = deal
+    return list(deals_by_id.values())
+
+
+def iter_deals_by_modified_windows(start_date_time, end_date_time=None, sync_older=False,
+                                   created_after="2024-01-01T00:00:00Z", shards=HUBSPOT_SEARCH_SHARDS,
+                                   max_workers=HUBSPOT_MAX_WORKERS):
+    """
+    Split the hs_lastmodifieddate range into disjoint windows, page them concurrently and yield
+    each page as soon as it arrives. Windows above the 10k search limit are split again until every
+    window can be paged completely. At most `max_workers * 2` pages are buffered; workers wait for
+    the consumer beyond that, so memory stays bounded however far behind the consumer is.
+    """
+    base_filters = get_deal_search_filters(None, sync_older, created_after)
+    if start_date_time:
+        window_start_ms = to_epoch_ms(start_date_time) + 1
+    else:
+        window_start_ms = 0 if sync_older else to_epoch_ms(created_after)
+    window_end_ms = to_epoch_ms(end_date_time) if end_date_time else int(time.time() * 1000) + 1
+
+    pages = queue.Queue(maxsize=max_workers * 2)
+    stopped = threading.Event()
+    lock = threading.Lock()
+    state = {"outstanding": 0, "windows": 0}
+    all_windows_done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def submit(lo, hi):
+        with lock:
+            state["outstanding"] += 1
+        executor.submit(page_window, lo, hi)
+
+    def page_window(lo, hi):
+        try:
+            filters = modified_window_filters(base_filters, lo, hi)
+            after = "0"
+            while after and not stopped.is_set():
+                data = search_deals_page(filters, after)
+                if after == "0" and data.get('total', 0) > SEARCH_RESULT_LIMIT and hi - lo > 1:
+                    for sub_lo, sub_hi in split_window(lo, hi, -(-data['total'] // SEARCH_RESULT_LIMIT) + 1):
+                        submit(sub_lo, sub_hi)
+                    return
+                if not put(data['results']):
+                    return
+                after = data.get('paging', {}).get('next', {}).get('after')
+            with lock:
+                state["windows"] += 1
+        except Exception as ex:
+            put(ex)
+        finally:
+            release()
+
+    def release():
+        with lock:
+            state["outstanding"] -= 1
+            last = state["outstanding"] == 0
+        if last:
+            put(all_windows_done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # held while seeding, so windows finishing before the last one is submitted do not end the sync
+        with lock:
+            state["outstanding"] += 1
+        for lo, hi in split_window(window_start_ms, window_end_ms, shards):
+            submit(lo, hi)
+        release()
+        while True:
+            page = pages.get()
+            if page is all_windows_done:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+        print(f"Fetched {state['windows']} hs_lastmodifieddate windows")
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def get_updated_or_new_deals():
     start_date = datetime.now() - timedelta(minutes=5)
     start_date_str = start_date.isoformat()
@@ -136,10 +383,10 @@ def get_updated_or_new_deals():
     deals = []
 
     while True:
-        response = requests.get(url, params=params)
+        response = hubspot_client.get(url, params=params)
 
         if response.status_code == 200:
-            data = response.json()
+            data = response_json(response)
             deals.extend(data.get('results', []))
 
             if 'paging' in data and 'next' in data['paging']:
@@ -157,9 +404,9 @@ def get_updated_or_new_deals():
 
 def get_deal_to_company_association(deal_id):
     url = f"{BASE_URL}/crm/v4/objects/deals/{deal_id}/associations/company"
-    response = requests.get(url, headers=auth_headers)
+    response = hubspot_client.get(url, headers=auth_headers)
     if response.status_code == 200:
-        company_associations = response.json().get('results', [])
+        company_associations = response_json(response).get('results', [])
         print(f"Found {len(company_associations)} companies associated with deal {deal_id}.")
         return company_associations
     else:
@@ -172,9 +419,9 @@ def get_company_details(company_id):
     params = {
         'properties': 'domain,name',
     }
-    response = requests.get(url, params=params, headers=auth_headers)
+    response = hubspot_client.get(url, params=params, headers=auth_headers)
     if response.status_code == 200:
-        company_details = response.json()
+        company_details = response_json(response)
         return company_details
     else:
         print(f"Error fetching company details for company {company_id}: {response.status_code} - {response.text}")
@@ -190,10 +437,10 @@ def get_owner_details(owner_id, search_in_archive=True):
 
 def call_owner_api(owner_id, archive):
     url = f"{BASE_URL}/crm/v3/owners/{owner_id}?archived={archive}".lower()
-    response = requests.get(url, headers=auth_headers)
+    response = hubspot_client.get(url, headers=auth_headers)
 
     if response.status_code == 200:
-        owner_details = response.json()
+        owner_details = response_json(response)
         return owner_details
     else:
         print(
@@ -205,9 +452,9 @@ def get_deal_pipeline_stages(pipeline_id):
     if not pipeline_id:
         return None
     url = f"{BASE_URL}/crm/v3/pipelines/deals/{pipeline_id}/stages"
-    response = requests.get(url, headers=auth_headers)
+    response = hubspot_client.get(url, headers=auth_headers)
     if response.status_code == 200:
-        stage_details = response.json()
+        stage_details = response_json(response)
         return stage_details['results']
     else:
         print(f"Error fetching deal pipeline stages {pipeline_id}: {response.status_code} - {response.text}")
@@ -223,9 +470,9 @@ def get_deal(deal_id):
         'properties': ','.join(deal_properties),
         'associations': 'company,line_item'
     }
-    response = requests.get(url, params=params, headers=auth_headers)
+    response = hubspot_client.get(url, params=params, headers=auth_headers)
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
         print(f"Error fetching deal details for id {deal_id}: {response.status_code} - {response.text}")
         return None
@@ -237,7 +484,7 @@ def get_line_items_by_ids(line_item_ids):
     url = f"{BASE_URL}/crm/v3/objects/line_items/batch/read"
 
     inputs = [{"id": id} for id in line_item_ids]
-    payload = json.dumps({
+    payload = dumps_bytes({
         "inputs": inputs,
         "limit": 100,
         "properties": [
@@ -252,41 +499,47 @@ def get_line_items_by_ids(line_item_ids):
         'authorization': f'Bearer {API_KEY}',
         'Content-Type': 'application/json'
     }
-    response = requests.post(url, headers=headers, data=payload)
+    response = hubspot_client.post(url, headers=headers, data=payload)
     if response.status_code in range(200, 300):
-        line_items = response.json()
+        line_items = response_json(response)
         return line_items['results']
     else:
         print(f"Error fetching line items: {response.status_code} - {response.text}")
         return None
 
 
-max_all_retry = 3
-
-
 # function to call api and retry if fail return json response or raise exception
-def call_api(method, url, headers=None, payload=None, timeout=120):
+def call_api(method, url, headers=None, payload=None, timeout=120, max_retries=HUBSPOT_MAX_RETRIES):
+    """
+    Retries 429/5xx responses and connection errors with exponential backoff and jitter,
+    honouring `Retry-After`. The retry budget is per call, so one failing endpoint cannot
+    exhaust retries for the rest of a warm Lambda container.
+    """
     if payload is None:
         payload = {}
     if headers is None:
         headers = auth_headers
     print(url)
     url_name = url.split('/')[-1].split('?')[0]
-    max_retry = 1
-    global max_all_retry
-    first_attempt = True
-    while min(max_retry, max_all_retry) > 0 or first_attempt:
-        first_attempt = False
-        response = requests.request(method, url, headers=headers, data=payload, timeout=timeout)
-        if response.status_code in (207, 200):
-            return response.json()
+    attempt = 0
+    while True:
+        try:
+            response = hubspot_client.request(method, url, headers=headers, data=payload, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            print(f"Error fetching data({url_name}): {ex}")
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
         else:
-            max_all_retry -= 1
-            max_retry -= 1
+            if response.status_code in (207, 200):
+                return response_json(response)
             print(f"Error fetching data({url_name}): {response.status_code} - {response.text}")
-            if max_retry < 0 or max_all_retry < 0:
+            if attempt >= max_retries or not is_retryable(response):
                 raise Exception(f"Error fetching data: {response.status_code} - {response.text}")
-            print(f"Retrying... {min(max_all_retry, max_retry)} attempts left")
+            delay = retry_delay(response, attempt)
+        attempt += 1
+        print(f"Retrying in {delay:.2f}s... {max_retries - attempt + 1} attempts left")
+        time.sleep(delay)
 
 
 def get_all_companies(use_backup=False):
@@ -413,6 +666,19 @@ def get_all_owners(use_backup=False, archived_types=["false", "true"]):
 # print(get_all_owners())
 
 
+def list_owners(archived=False):
+    """
+    Raw records of the owners API (id, email, firstName, lastName, userId, archived, updatedAt).
+    """
+    url = f"{BASE_URL}/crm/v3/owners?limit=100&archived={str(archived).lower()}"
+    owners = []
+    while url:
+        data = call_api("GET", url)
+        owners.extend(data["results"])
+        url = data.get("paging", {}).get("next", {}).get("link")
+    return owners
+
+
 def get_all_stages():
     url = f"{BASE_URL}/crm/v3/pipelines/deals"
 
@@ -435,6 +701,36 @@ def get_all_stages():
 
 # print(json.dumps(get_all_stages()))
 
+# every path reads stages through this cache, the pipelines API is called at most once per TTL
+pipeline_stages_cache = TTLCache("pipeline stages", lambda: dict(get_all_stages()), PIPELINE_STAGES_TTL)
+
+# an unknown stage reloads the cache, unless it was loaded less than this many seconds ago
+STAGE_MISS_RELOAD_AFTER = 60
+
+
+def get_pipeline_stages():
+    """
+    :return: pipeline id -> stage id -> label, shared by every caller, do not modify it
+    """
+    return pipeline_stages_cache.get()
+
+
+def get_stage_label(pipeline_id, stage_id):
+    """
+    Label of a deal stage from the cached pipelines. A stage added in HubSpot after the cache
+    was loaded invalidates it, so new stages show up without waiting for the TTL.
+    """
+    if not pipeline_id or not stage_id:
+        return None
+    label = get_pipeline_stages().get(pipeline_id, {}).get(stage_id)
+    # age is None when another thread invalidated the cache since the read above
+    age = pipeline_stages_cache.age()
+    if label is None and (age is None or age > STAGE_MISS_RELOAD_AFTER):
+        print(f"Stage {stage_id} of pipeline {pipeline_id} is not cached, reloading pipeline stages")
+        pipeline_stages_cache.invalidate()
+        label = get_pipeline_stages().get(pipeline_id, {}).get(stage_id)
+    return label
+
 def get_additional_association_deals_of_company(url):
     # payload = {}
     # headers = {
@@ -508,26 +804,71 @@ def get_associated_companies_of_deals(deal_ids):
     }
     """
     url = f"{BASE_URL}/crm/v3/associations/deal/company/batch/read"
-    deals_as_batch_of_1000 = [deal_ids[i:i + 1000] for i in range(0, len(deal_ids), 1000)]
-    deals_to_associated_company_ids = {}
-    for deal_ids_ in deals_as_batch_of_1000:
+
+    def fetch_batch(deal_ids_):
         payload = {"inputs": [{"id": deal_id} for deal_id in deal_ids_]}
-        data = call_api("POST", url, headers=auth_headers, payload=json.dumps(payload))
+        data = call_api("POST", url, headers=auth_headers, payload=dumps_bytes(payload))
         # print("get_associated_companies_of_deals", "data", data)
-        deals_to_associated_company_ids.update({association["from"]["id"]: association["to"][0]["id"] if association["to"] else None for association in data["results"]})
+        return {association["from"]["id"]: association["to"][0]["id"] if association["to"] else None for association in data["results"]}
+
+    deals_to_associated_company_ids = {}
+    for batch_result in map_concurrently(fetch_batch, chunks(deal_ids, 1000)):
+        deals_to_associated_company_ids.update(batch_result)
     return deals_to_associated_company_ids
 
 def get_associated_line_items_of_deals(deal_ids):
     url = f"{BASE_URL}/crm/v3/associations/deal/line_item/batch/read"
-    deals_as_batch_of_1000 = [deal_ids[i:i + 1000] for i in range(0, len(deal_ids), 1000)]
-    deals_to_associated_line_item_ids = {}
-    for deal_ids_ in deals_as_batch_of_1000:
+
+    def fetch_batch(deal_ids_):
         payload = {"inputs": [{"id": deal_id} for deal_id in deal_ids_]}
-        data = call_api("POST", url, headers=auth_headers, payload=json.dumps(payload))
-        deals_to_associated_line_item_ids.update({association["from"]["id"]: [i["id"] for i in  association["to"]] for association in data["results"]})
+        data = call_api("POST", url, headers=auth_headers, payload=dumps_bytes(payload))
+        return {association["from"]["id"]: [i["id"] for i in  association["to"]] for association in data["results"]}
+
+    deals_to_associated_line_item_ids = {}
+    for batch_result in map_concurrently(fetch_batch, chunks(deal_ids, 1000)):
+        deals_to_associated_line_item_ids.update(batch_result)
     return deals_to_associated_line_item_ids
 
 
+def get_company_associations_of_deals(deal_ids):
+    """
+    Get deal to company associations in the v4 format returned by get_deal_to_company_association
+    :param deal_ids: The maximum allowed batch size is 1000
+    :return: dict of deal_id to list of associations ({"toObjectId": ..., "associationTypes": [...]})
+    """
+    url = f"{BASE_URL}/crm/v4/associations/deal/company/batch/read"
+
+    def fetch_batch(deal_ids_):
+        payload = {"inputs": [{"id": deal_id} for deal_id in deal_ids_]}
+        data = call_api("POST", url, headers=auth_headers, payload=dumps_bytes(payload))
+        return {str(association["from"]["id"]): association["to"] for association in data["results"]}
+
+    deals_to_company_associations = {}
+    for batch_result in map_concurrently(fetch_batch, chunks(deal_ids, 1000)):
+        deals_to_company_associations.update(batch_result)
+    return deals_to_company_associations
+
+
+def get_deals_by_ids_batch(deal_ids):
+    """
+    Batch counterpart of get_deal, without the embedded associations
+    :return: list of deals, ids that do not exist are left out
+    """
+    url = f"{BASE_URL}/crm/v3/objects/deals/batch/read"
+
+    def fetch_batch(deal_ids_):
+        payload = dumps_bytes({
+            "inputs": [{"id": deal_id} for deal_id in deal_ids_],
+            "properties": deal_properties
+        })
+        return call_api("POST", url, payload=payload)["results"]
+
+    deals = []
+    for batch_result in map_concurrently(fetch_batch, chunks(deal_ids, 100)):
+        deals.extend(batch_result)
+    return deals
+
+
 
 def get_companies_by_ids_search(company_ids):
     """
@@ -577,7 +918,7 @@ def get_companies_by_ids_search(company_ids):
     company_details = {}
     company_ids_batch_of_100 = [company_ids[i:i + 100] for i in range(0, len(company_ids), 100)]
     for company_ids_ in company_ids_batch_of_100:
-        payload = json.dumps({
+        payload = dumps_bytes({
             "limit": 100,
             # "properties": [ "name", "domain", "hs_object_id", "hs_lastmodifieddate", "createdate"],
             "filterGroups": [
@@ -609,7 +950,7 @@ def get_line_items_by_ids_search(line_item_ids):
     line_item_details = {}
     line_item_ids_batch_of_100 = [line_item_ids[i:i + 100] for i in range(0, len(line_item_ids), 100)]
     for line_item_ids_ in line_item_ids_batch_of_100:
-        payload = json.dumps({
+        payload = dumps_bytes({
             "limit": 100,
             "properties": [
                 "name",
@@ -641,12 +982,14 @@ def get_line_items_by_ids_search(line_item_ids):
                                                   }
     return line_item_details
 
-def get_companies_by_ids_batch(company_ids):
+def get_company_objects_by_ids_batch(company_ids):
+    """
+    :return: company id -> company as returned by HubSpot (id, properties.name, properties.domain)
+    """
     url = f"{BASE_URL}/crm/v3/objects/company/batch/read"
-    company_details = {}
-    company_ids_batch_of_100 = [company_ids[i:i + 100] for i in range(0, len(company_ids), 100)]
-    for company_ids_ in company_ids_batch_of_100:
-        payload = json.dumps({
+
+    def fetch_batch(company_ids_):
+        payload = dumps_bytes({
             "inputs": [{"id": company_id} for company_id in company_ids_],
             "limit": 100,
             "properties": [
@@ -655,23 +998,25 @@ def get_companies_by_ids_batch(company_ids):
             ]
         })
         data = call_api("POST", url, payload=payload)
-        for company in data["results"]:
-            name = company["properties"]["name"]
-            if not name:
-                name = ' '.join(company["properties"]["domain"].split('.')[:-1]).title() if company["properties"][
-                    "domain"] else None
-            company_details[company["id"]] = {"id": company["id"],
-                                             "name": name,
-                                             "domain": company["properties"]["domain"]}
-    return company_details
+        return {company["id"]: company for company in data["results"]}
+
+    companies = {}
+    for batch_result in map_concurrently(fetch_batch, chunks(company_ids, 100)):
+        companies.update(batch_result)
+    return companies
+
+
+def get_companies_by_ids_batch(company_ids):
+    return {company_id: parse_company(company)
+            for company_id, company in get_company_objects_by_ids_batch(company_ids).items()}
 
 
 def get_line_items_by_ids_batch(line_item_ids):
     url = f"{BASE_URL}/crm/v3/objects/line_items/batch/read"
-    line_item_details = {}
-    line_item_ids_batch_of_100 = [line_item_ids[i:i + 100] for i in range(0, len(line_item_ids), 100)]
-    for line_item_ids_ in line_item_ids_batch_of_100:
-        payload = json.dumps({
+
+    def fetch_batch(line_item_ids_):
+        line_item_details_ = {}
+        payload = dumps_bytes({
             "inputs": [{"id": line_item_id} for line_item_id in line_item_ids_],
             "limit": 100,
             "properties": [
@@ -684,25 +1029,22 @@ def get_line_items_by_ids_batch(line_item_ids):
         })
         data = call_api("POST", url, payload=payload)
         for line_item in data["results"]:
-            line_item_details[line_item["id"]] = {"id": line_item["id"],
-                                                       "name": line_item["properties"]["name"],
-                                                       "amount": line_item["properties"]["amount"],
-                                                       "quantity": line_item["properties"]["quantity"],
-                                                       "price": line_item["properties"]["price"],
-                                                       "updated_at": line_item["updatedAt"],
-                                                       "created_at": line_item["createdAt"],
-                                                       "currency": line_item["properties"].get("hs_line_item_currency_code", "USD")
-                                                  }
+            line_item_details_[line_item["id"]] = parse_line_item(line_item)
+        return line_item_details_
+
+    line_item_details = {}
+    for batch_result in map_concurrently(fetch_batch, chunks(line_item_ids, 100)):
+        line_item_details.update(batch_result)
     return line_item_details
 
 
 def get_owners_by_ids_users_search(owner_ids):
     print("get_owners_by_ids_users_search", owner_ids)
     url = f"{BASE_URL}/crm/v3/objects/users/search"
-    owner_details = {}
-    owner_ids_batch_of_100 = [owner_ids[i:i + 100] for i in range(0, len(owner_ids), 100)]
-    for owner_ids_ in owner_ids_batch_of_100:
-        payload = json.dumps({
+
+    def fetch_batch(owner_ids_):
+        owner_details_ = {}
+        payload = dumps_bytes({
             "limit": 100,
             "properties": [
                 "hubspot_owner_id",
@@ -725,41 +1067,29 @@ def get_owners_by_ids_users_search(owner_ids):
         })
         data = call_api("POST", url, payload=payload)
         for owner in data["results"]:
-            name = ""
-            if owner["properties"]["hs_given_name"] and owner["properties"]["hs_family_name"]:
-                name = owner["properties"]["hs_given_name"] + " " + owner["properties"]["hs_family_name"]
-            elif owner["properties"]["hs_given_name"]:
-                name = owner["properties"]["hs_given_name"]
-            elif owner["properties"]["hs_family_name"]:
-                name = owner["properties"]["hs_family_name"]
-            if not name:
-                name = ' '.join(owner["properties"]["hs_email"].split('@')[0].split('.')).title() if owner["properties"][
-                    "hs_email"] else None
-            owner_details[owner["properties"]["hubspot_owner_id"]] = {"id": owner["properties"]["hubspot_owner_id"],
-                                          "name": name,
-                                          "email": owner["properties"]["hs_email"],
-                                          "archived": False}
+            owner_details_[owner["properties"]["hubspot_owner_id"]] = parse_user_owner(owner)
+        return owner_details_
+
+    owner_details = {}
+    for batch_result in map_concurrently(fetch_batch, chunks(owner_ids, 100)):
+        owner_details.update(batch_result)
 
+    add_missed_owners(owner_ids, owner_details)
+    return owner_details
+
+
+def add_missed_owners(owner_ids, owner_details):
+    """
+    Owners missing from the users search are usually archived, look them up in the owners API.
+    Mutates and returns owner_details.
+    """
     missed_owner_ids = set(owner_ids) - set(owner_details.keys())
     if len(missed_owner_ids) == 1:
         print("missed_owner_ids", missed_owner_ids)
         missed_owner_id = list(missed_owner_ids)[0]
         missed_owner_details = call_owner_api(missed_owner_id, True)
         if missed_owner_details:
-            name = ""
-            if missed_owner_details["firstName"] and missed_owner_details["lastName"]:
-                name = missed_owner_details["firstName"] + " " + missed_owner_details["lastName"]
-            elif missed_owner_details["firstName"]:
-                name = missed_owner_details["firstName"]
-            elif missed_owner_details["lastName"]:
-                name = missed_owner_details["lastName"]
-            if not name:
-                name = ' '.join(missed_owner_details["email"].split('@')[0].split('.')).title() if missed_owner_details[
-                    "email"] else None
-            owner_details[missed_owner_id] = {"id": missed_owner_id,
-                                              "name": name,
-                                              "email": missed_owner_details["email"],
-                                              "archived": True}
+            owner_details[missed_owner_id] = parse_archived_owner(missed_owner_id, missed_owner_details)
         else:
             print(f"Owner not found in archived owners also: {missed_owner_id}")
     if len(missed_owner_ids) > 1:
@@ -775,3 +1105,57 @@ def get_owners_by_ids_users_search(owner_ids):
                 print(f"Owner not found in archived owners also: {missed_owner_id}")
     return owner_details
 
+
+def parse_company(company):
+    name = company["properties"]["name"]
+    if not name:
+        name = ' '.join(company["properties"]["domain"].split('.')[:-1]).title() if company["properties"][
+            "domain"] else None
+    return {"id": company["id"],
+            "name": name,
+            "domain": company["properties"]["domain"]}
+
+
+def parse_line_item(line_item):
+    return {"id": line_item["id"],
+            "name": line_item["properties"]["name"],
+            "amount": line_item["properties"]["amount"],
+            "quantity": line_item["properties"]["quantity"],
+            "price": line_item["properties"]["price"],
+            "updated_at": line_item["updatedAt"],
+            "created_at": line_item["createdAt"],
+            "currency": line_item["properties"].get("hs_line_item_currency_code", "USD")
+            }
+
+
+def parse_user_owner(owner):
+    name = ""
+    if owner["properties"]["hs_given_name"] and owner["properties"]["hs_family_name"]:
+        name = owner["properties"]["hs_given_name"] + " " + owner["properties"]["hs_family_name"]
+    elif owner["properties"]["hs_given_name"]:
+        name = owner["properties"]["hs_given_name"]
+    elif owner["properties"]["hs_family_name"]:
+        name = owner["properties"]["hs_family_name"]
+    if not name:
+        name = ' '.join(owner["properties"]["hs_email"].split('@')[0].split('.')).title() if owner["properties"][
+            "hs_email"] else None
+    return {"id": owner["properties"]["hubspot_owner_id"],
+            "name": name,
+            "email": owner["properties"]["hs_email"],
+            "archived": False}
+
+
+def parse_archived_owner(owner_id, owner):
+    name = ""
+    if owner["firstName"] and owner["lastName"]:
+        name = owner["firstName"] + " " + owner["lastName"]
+    elif owner["firstName"]:
+        name = owner["firstName"]
+    elif owner["lastName"]:
+        name = owner["lastName"]
+    if not name:
+        name = ' '.join(owner["email"].split('@')[0].split('.')).title() if owner["email"] else None
+    return {"id": owner_id,
+            "name": name,
+            "email": owner["email"],
+            "archived": True}
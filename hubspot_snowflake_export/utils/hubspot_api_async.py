@@ -0,0 +1,261 @@
+"""
+asyncio transport for the HubSpot calls used by the bulk sync.
+Mirrors the public functions of hubspot_api.py with bounded concurrency and the same
+token buckets, so sync and async callers in one container share HubSpot's rate limit.
+"""
+import asyncio
+import time
+
+from hubspot_snowflake_export.utils.config import HUBSPOT_POOL_SIZE, HUBSPOT_MAX_RETRIES, HUBSPOT_MAX_WORKERS, \
+    HUBSPOT_SEARCH_SHARDS
+from hubspot_snowflake_export.utils.concurrency import chunks
+from hubspot_snowflake_export.utils.jsonlib import dumps_bytes, response_json
+from hubspot_snowflake_export.utils.hubspot_api import BASE_URL, auth_headers, deal_properties, SEARCH_RESULT_LIMIT, \
+    get_deal_search_filters, to_epoch_ms, split_window, parse_company, parse_line_item, parse_user_owner, \
+    add_missed_owners
+from hubspot_snowflake_export.utils.rate_limiter import hubspot_rate_limiter, hubspot_search_rate_limiter, \
+    is_retryable, retry_delay, backoff_delay
+
+try:
+    import httpx
+except ImportError:  # optional, only the async transport needs it
+    httpx = None
+
+
+class AsyncHubspotClient:
+    """
+    :param max_concurrency: max requests in flight at once
+    :param pool_size: max pooled connections to the HubSpot host
+    """
+
+    def __init__(self, max_concurrency=HUBSPOT_MAX_WORKERS * 2, pool_size=HUBSPOT_POOL_SIZE,
+                 rate_limiter=hubspot_rate_limiter, search_rate_limiter=hubspot_search_rate_limiter):
+        if httpx is None:
+            raise ImportError("httpx is required for the async HubSpot client, install it with `pip install httpx`")
+        self.rate_limiter = rate_limiter
+        self.search_rate_limiter = search_rate_limiter
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = httpx.AsyncClient(
+            headers=auth_headers,
+            timeout=120,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self._client.aclose()
+
+    def limiter_for(self, url):
+        return self.search_rate_limiter if url.split('?')[0].endswith('/search') else self.rate_limiter
+
+    async def call_api(self, method, url, payload=None, max_retries=HUBSPOT_MAX_RETRIES):
+        url_name = url.split('/')[-1].split('?')[0]
+        limiter = self.limiter_for(url)
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                wait = limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    response = await self._client.request(method, url, content=payload)
+                except httpx.TransportError as ex:
+                    response = None
+                    error = ex
+            if response is None:
+                print(f"Error fetching data({url_name}): {error}")
+                if attempt >= max_retries:
+                    raise error
+                delay = backoff_delay(attempt)
+            else:
+                self.rate_limiter.update_from_headers(response.headers)
+                if response.status_code in (207, 200):
+                    return response_json(response)
+                print(f"Error fetching data({url_name}): {response.status_code} - {response.text}")
+                if attempt >= max_retries or not is_retryable(response):
+                    raise Exception(f"Error fetching data: {response.status_code} - {response.text}")
+                delay = retry_delay(response, attempt)
+                if response.status_code == 429:
+                    limiter.pause(delay)
+            attempt += 1
+            print(f"Retrying in {delay:.2f}s... {max_retries - attempt + 1} attempts left")
+            await asyncio.sleep(delay)
+
+    async def gather_batches(self, fetch_batch, ids, size):
+        results = {}
+        for batch_result in await asyncio.gather(*(fetch_batch(ids_) for ids_ in chunks(ids, size))):
+            results.update(batch_result)
+        return results
+
+    # ---- deals search ----
+
+    async def search_deals_page(self, filters, after="0"):
+        payload = dumps_bytes({
+            "after": after,
+            "limit": 200,
+            "properties": deal_properties,
+            "filterGroups": [{"filters": filters}]
+        })
+        return await self.call_api("POST", f"{BASE_URL}/crm/v3/objects/deals/search", payload)
+
+    async def iter_deal_pages(self, start_date_time, sync_older=False, created_after="2024-01-01T00:00:00Z",
+                              deal_ids=None, shards=HUBSPOT_SEARCH_SHARDS):
+        """
+        Yield pages of deals as soon as they arrive. hs_lastmodifieddate windows (or 100-id chunks
+        when deal_ids are given) are paged concurrently; a deal may be yielded more than once when it
+        is modified while the windows are being paged.
+        """
+        queue = asyncio.Queue()
+        tasks = set()
+
+        async def page_filters(filters):
+            after = "0"
+            while after:
+                data = await self.search_deals_page(filters, after)
+                await queue.put(data['results'])
+                after = data.get('paging', {}).get('next', {}).get('after')
+
+        async def page_window(window_start_ms, window_end_ms):
+            filters = base_filters + [
+                {"propertyName": "hs_lastmodifieddate", "operator": "GTE", "value": str(window_start_ms)},
+                {"propertyName": "hs_lastmodifieddate", "operator": "LT", "value": str(window_end_ms)},
+            ]
+            data = await self.search_deals_page(filters)
+            if data.get('total', 0) > SEARCH_RESULT_LIMIT and window_end_ms - window_start_ms > 1:
+                parts = -(-data['total'] // SEARCH_RESULT_LIMIT) + 1
+                for lo, hi in split_window(window_start_ms, window_end_ms, parts):
+                    start_task(page_window(lo, hi))
+                return
+            await queue.put(data['results'])
+            after = data.get('paging', {}).get('next', {}).get('after')
+            while after:
+                data = await self.search_deals_page(filters, after)
+                await queue.put(data['results'])
+                after = data.get('paging', {}).get('next', {}).get('after')
+
+        def start_task(coroutine):
+            task = asyncio.ensure_future(coroutine)
+            tasks.add(task)
+            task.add_done_callback(lambda _: queue.put_nowait(None))
+
+        if deal_ids:
+            for deal_ids_ in chunks(deal_ids, 100):
+                start_task(page_filters(get_deal_search_filters(start_date_time, sync_older, created_after, deal_ids_)))
+        else:
+            base_filters = get_deal_search_filters(None, sync_older, created_after)
+            if start_date_time:
+                window_start_ms = to_epoch_ms(start_date_time) + 1
+            else:
+                window_start_ms = 0 if sync_older else to_epoch_ms(created_after)
+            window_end_ms = int(time.time() * 1000) + 1
+            for lo, hi in split_window(window_start_ms, window_end_ms, shards):
+                start_task(page_window(lo, hi))
+
+        try:
+            while tasks:
+                page = await queue.get()
+                if page is None:
+                    for task in [task for task in tasks if task.done()]:
+                        tasks.discard(task)
+                        task.result()
+                    continue
+                yield page
+            while not queue.empty():
+                page = queue.get_nowait()
+                if page:
+                    yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fetch_updated_or_created_deals(self, start_date_time, sync_older=False,
+                                             created_after="2024-01-01T00:00:00Z", deal_ids=None,
+                                             shards=HUBSPOT_SEARCH_SHARDS):
+        deals_by_id = {}
+        async for page in self.iter_deal_pages(start_date_time, sync_older, created_after, deal_ids, shards):
+            for deal in page:
+                deals_by_id[deal['id']] = deal
+        return list(deals_by_id.values())
+
+    # ---- associations batch read ----
+
+    async def get_associated_companies_of_deals(self, deal_ids):
+        url = f"{BASE_URL}/crm/v3/associations/deal/company/batch/read"
+
+        async def fetch_batch(deal_ids_):
+            payload = dumps_bytes({"inputs": [{"id": deal_id} for deal_id in deal_ids_]})
+            data = await self.call_api("POST", url, payload)
+            return {association["from"]["id"]: association["to"][0]["id"] if association["to"] else None
+                    for association in data["results"]}
+
+        return await self.gather_batches(fetch_batch, deal_ids, 1000)
+
+    async def get_associated_line_items_of_deals(self, deal_ids):
+        url = f"{BASE_URL}/crm/v3/associations/deal/line_item/batch/read"
+
+        async def fetch_batch(deal_ids_):
+            payload = dumps_bytes({"inputs": [{"id": deal_id} for deal_id in deal_ids_]})
+            data = await self.call_api("POST", url, payload)
+            return {association["from"]["id"]: [i["id"] for i in association["to"]] for association in data["results"]}
+
+        return await self.gather_batches(fetch_batch, deal_ids, 1000)
+
+    # ---- objects batch read ----
+
+    async def get_companies_by_ids_batch(self, company_ids):
+        url = f"{BASE_URL}/crm/v3/objects/company/batch/read"
+
+        async def fetch_batch(company_ids_):
+            payload = dumps_bytes({
+                "inputs": [{"id": company_id} for company_id in company_ids_],
+                "limit": 100,
+                "properties": ["name", "domain"]
+            })
+            data = await self.call_api("POST", url, payload)
+            return {company["id"]: parse_company(company) for company in data["results"]}
+
+        return await self.gather_batches(fetch_batch, company_ids, 100)
+
+    async def get_line_items_by_ids_batch(self, line_item_ids):
+        url = f"{BASE_URL}/crm/v3/objects/line_items/batch/read"
+
+        async def fetch_batch(line_item_ids_):
+            payload = dumps_bytes({
+                "inputs": [{"id": line_item_id} for line_item_id in line_item_ids_],
+                "limit": 100,
+                "properties": ["name", "amount", "quantity", "price", "hs_line_item_currency_code"]
+            })
+            data = await self.call_api("POST", url, payload)
+            return {line_item["id"]: parse_line_item(line_item) for line_item in data["results"]}
+
+        return await self.gather_batches(fetch_batch, line_item_ids, 100)
+
+    # ---- owners & pipelines ----
+
+    async def get_owners_by_ids_users_search(self, owner_ids):
+        url = f"{BASE_URL}/crm/v3/objects/users/search"
+
+        async def fetch_batch(owner_ids_):
+            payload = dumps_bytes({
+                "limit": 100,
+                "properties": ["hubspot_owner_id", "hs_email", "hs_given_name", "hs_family_name"],
+                "filterGroups": [{"filters": [
+                    {"propertyName": "hubspot_owner_id", "operator": "IN", "values": owner_ids_}
+                ]}]
+            })
+            data = await self.call_api("POST", url, payload)
+            return {owner["properties"]["hubspot_owner_id"]: parse_user_owner(owner) for owner in data["results"]}
+
+        owner_details = await self.gather_batches(fetch_batch, owner_ids, 100)
+        # archived owners are rare, fall back to the sync owners API for them
+        return await asyncio.to_thread(add_missed_owners, owner_ids, owner_details)
+
+    async def get_all_stages(self):
+        data = await self.call_api("GET", f"{BASE_URL}/crm/v3/pipelines/deals")
+        return {pipeline["id"]: {stage["id"]: stage["label"] for stage in pipeline["stages"]}
+                for pipeline in data["results"]}
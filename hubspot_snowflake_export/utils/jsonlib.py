@@ -0,0 +1,59 @@
+"""
+JSON encoding and decoding for HubSpot payloads, S3 objects and the JSON columns of HUBSPOT_DEALS.
+
+orjson is used when it is installed, the stdlib json module otherwise. The JSON columns are part of
+ROW_HASH, so they are written by dumps_column with the stdlib only and fixed options: the text, and
+the stored hashes, do not depend on which backend a container has or on a later orjson release.
+"""
+import json
+
+from hubspot_snowflake_export.utils.config import JSON_BACKEND
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json module is used without it
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None and JSON_BACKEND == "orjson" else "json"
+
+
+def loads(data):
+    """:param data: str or bytes"""
+    if BACKEND == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_bytes(value):
+    if BACKEND == "orjson":
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            # values orjson does not take, e.g. dicts with int keys or ints over 64 bits
+            pass
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def dumps(value):
+    return dumps_bytes(value).decode('utf-8')
+
+
+def dumps_column(value):
+    """
+    JSON text of a HUBSPOT_DEALS JSON column: compact, non-ASCII as-is, keys in insertion order.
+    Do not change these options, every deal's ROW_HASH would change with the column text.
+    """
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def response_json(response):
+    """Body of a requests or httpx response, decoded from the raw bytes."""
+    return loads(response.content)
+
+
+def dumps_once(cache, key, value):
+    """dumps_column(value), reusing cache[key] when a value with the same key was serialised before."""
+    dumped = cache.get(key)
+    if dumped is None:
+        dumped = cache[key] = dumps_column(value)
+    return dumped
@@ -0,0 +1,26 @@
+import json
+import time
+
+from hubspot_snowflake_export.utils.config import ENV_
+
+METRICS_NAMESPACE = "HubspotSnowflakeExport"
+
+
+def put_metric(name, value, unit="Count", **dimensions):
+    """
+    Print one metric in CloudWatch Embedded Metric Format. Lambda ships stdout to CloudWatch Logs,
+    which extracts the metric without any API call from the function.
+    """
+    dimensions = {"Environment": ENV_ or "local", **dimensions}
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{"Name": name, "Unit": unit}]
+            }]
+        },
+        name: value,
+        **dimensions
+    }))
@@ -0,0 +1,136 @@
+"""
+In-memory directory of HubSpot owners shared by the single-deal, batch and bulk paths.
+
+Loaded once per container from an S3 snapshot (or one listing of the owners API when there is
+none), then refreshed incrementally: every OWNER_DIRECTORY_TTL the active owners are listed again
+and only records with a newer updatedAt replace the cached ones. Owners that are not in the
+listing (archived owners, owners created since the refresh) are looked up one by one on first
+use and kept. The snapshot is written back to S3 when the directory changed, so cold containers
+start warm.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+from hubspot_snowflake_export.utils.concurrency import map_concurrently
+from hubspot_snowflake_export.utils.config import OWNER_DIRECTORY_TTL
+from hubspot_snowflake_export.utils.hubspot_api import list_owners, get_owner_details
+from hubspot_snowflake_export.utils.s3 import get_json_object, put_json_object
+
+OWNER_DIRECTORY_KEY = "owner-directory.json"
+OWNER_FIELDS = ("id", "email", "firstName", "lastName", "userId", "archived", "updatedAt")
+
+
+def to_owner_record(owner):
+    return {field: owner.get(field) for field in OWNER_FIELDS}
+
+
+def to_owner_summary(owner):
+    """Owner in the shape the bulk sync stores: id, name, email and archived."""
+    name = f"{owner['firstName'] or ''} {owner['lastName'] or ''}".strip()
+    if not name:
+        name = ' '.join(owner["email"].split('@')[0].split('.')).title() if owner["email"] else ""
+    return {"id": owner["id"], "name": name, "email": owner["email"], "archived": bool(owner["archived"])}
+
+
+class OwnerDirectory:
+
+    def __init__(self, ttl=OWNER_DIRECTORY_TTL, snapshot_key=OWNER_DIRECTORY_KEY):
+        self.ttl = ttl
+        self.snapshot_key = snapshot_key
+        self.owners = {}
+        self.not_found = set()
+        self.refreshed_at = None
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def is_fresh(self):
+        return self.refreshed_at is not None and time.time() - self.refreshed_at < self.ttl
+
+    def load_snapshot(self):
+        snapshot = get_json_object(self.snapshot_key)
+        if not snapshot:
+            return False
+        self.owners = snapshot.get("owners", {})
+        self.refreshed_at = datetime.fromisoformat(snapshot["refreshed_at"]).timestamp()
+        print(f"Loaded {len(self.owners)} owners from the S3 snapshot")
+        return True
+
+    def save_snapshot(self):
+        if not self.dirty:
+            return
+        put_json_object(self.snapshot_key, {
+            "refreshed_at": datetime.fromtimestamp(self.refreshed_at, timezone.utc).isoformat(),
+            "owners": self.owners
+        })
+        self.dirty = False
+        print(f"Saved {len(self.owners)} owners to the S3 snapshot")
+
+    def refresh(self):
+        """
+        List the active owners and replace the records whose updatedAt changed. Cached active owners
+        missing from the listing were archived or deleted, they are dropped and looked up again on use.
+        """
+        active_owners = {owner["id"]: owner for owner in list_owners(archived=False)}
+        changed = 0
+        for owner_id, owner in active_owners.items():
+            cached = self.owners.get(owner_id)
+            if cached is None or cached.get("updatedAt") != owner.get("updatedAt"):
+                self.owners[owner_id] = to_owner_record(owner)
+                changed += 1
+        gone = [owner_id for owner_id, owner in self.owners.items()
+                if not owner["archived"] and owner_id not in active_owners]
+        for owner_id in gone:
+            del self.owners[owner_id]
+        self.not_found.clear()
+        self.refreshed_at = time.time()
+        self.dirty = self.dirty or bool(changed or gone)
+        print(f"Refreshed owner directory - {changed} changed, {len(gone)} no longer active, {len(self.owners)} total")
+
+    def ensure_fresh(self):
+        if self.is_fresh():
+            return
+        with self._lock:
+            if self.is_fresh():
+                return
+            if self.refreshed_at is None and self.load_snapshot() and self.is_fresh():
+                return
+            self.refresh()
+            self.save_snapshot()
+
+    def get_owners(self, owner_ids):
+        """
+        :return: owner id -> raw owner record, owners HubSpot does not know are left out
+        """
+        self.ensure_fresh()
+        owner_ids = {str(owner_id) for owner_id in owner_ids if owner_id}
+        # self.owners is only read and changed under the lock, refresh iterates it
+        with self._lock:
+            missing_owner_ids = [owner_id for owner_id in owner_ids
+                                 if owner_id not in self.owners and owner_id not in self.not_found]
+            self.hits += len(owner_ids) - len(missing_owner_ids)
+            self.misses += len(missing_owner_ids)
+        if missing_owner_ids:
+            print(f"Owners not in the directory: {missing_owner_ids}")
+            fetched = map_concurrently(get_owner_details, missing_owner_ids)
+            with self._lock:
+                for owner_id, owner in zip(missing_owner_ids, fetched):
+                    if owner:
+                        self.owners[owner_id] = to_owner_record(owner)
+                        self.dirty = True
+                    else:
+                        self.not_found.add(owner_id)
+                self.save_snapshot()
+        with self._lock:
+            return {owner_id: self.owners[owner_id] for owner_id in owner_ids if owner_id in self.owners}
+
+    def get_owner(self, owner_id):
+        return self.get_owners([owner_id]).get(str(owner_id)) if owner_id else None
+
+    def get_owner_summaries(self, owner_ids):
+        return {owner_id: to_owner_summary(owner) for owner_id, owner in self.get_owners(owner_ids).items()}
+
+
+owner_directory = OwnerDirectory()
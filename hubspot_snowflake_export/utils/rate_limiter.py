@@ -0,0 +1,122 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from hubspot_snowflake_export.utils.config import HUBSPOT_RATE_LIMIT_PER_SECOND, HUBSPOT_RATE_LIMIT_BURST, \
+    HUBSPOT_SEARCH_RATE_LIMIT_PER_SECOND, HUBSPOT_RETRY_BASE_DELAY, HUBSPOT_RETRY_MAX_DELAY
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every caller of one HubSpot rate limit.
+    The refill rate and remaining budget are corrected from HubSpot's
+    `X-HubSpot-RateLimit-*` response headers, and a 429 pauses every caller at once.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, tokens=1):
+        """
+        Take `tokens` from the bucket without blocking.
+        :return: seconds the caller has to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        limit = _header_number(headers, 'X-HubSpot-RateLimit-Max')
+        interval_ms = _header_number(headers, 'X-HubSpot-RateLimit-Interval-Milliseconds')
+        remaining = _header_number(headers, 'X-HubSpot-RateLimit-Remaining')
+        with self._lock:
+            self._refill(time.monotonic())
+            if limit and interval_ms:
+                self.rate = limit / (interval_ms / 1000)
+                self.capacity = limit
+            if remaining is not None:
+                # the server-side window is the source of truth, never spend more than it reports
+                self.tokens = min(self.tokens, remaining)
+
+
+def _header_number(headers, name):
+    value = headers.get(name) if headers else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def parse_retry_after(headers):
+    """
+    :return: seconds from a `Retry-After` header (delta-seconds or HTTP-date), None if absent
+    """
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=HUBSPOT_RETRY_BASE_DELAY, cap=HUBSPOT_RETRY_MAX_DELAY):
+    """Exponential backoff with full jitter for the given 0-based retry attempt."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_retryable(response):
+    if response.status_code not in RETRYABLE_STATUS_CODES:
+        return False
+    if response.status_code == 429:
+        try:
+            # the daily quota resets at midnight, retrying inside this invocation cannot succeed
+            return response.json().get('policyName') != 'DAILY'
+        except ValueError:
+            return True
+    return True
+
+
+def retry_delay(response, attempt):
+    retry_after = parse_retry_after(response.headers)
+    delay = backoff_delay(attempt)
+    if retry_after is not None:
+        return retry_after + delay / 10
+    if response.status_code == 429:
+        # HubSpot's rolling window is 10 seconds when no Retry-After is sent
+        interval_ms = _header_number(response.headers, 'X-HubSpot-RateLimit-Interval-Milliseconds') or 10000
+        return max(delay, interval_ms / 1000 / 2)
+    return delay
+
+
+hubspot_rate_limiter = TokenBucket(HUBSPOT_RATE_LIMIT_PER_SECOND, HUBSPOT_RATE_LIMIT_BURST)
+# CRM search endpoints have their own per-account limit and do not send rate limit headers
+hubspot_search_rate_limiter = TokenBucket(HUBSPOT_SEARCH_RATE_LIMIT_PER_SECOND, HUBSPOT_SEARCH_RATE_LIMIT_PER_SECOND)
@@ -0,0 +1,129 @@
+"""
+Change detection for HUBSPOT_DEALS.
+
+PROPERTIES_HASH is a hash of the deal properties we export, as returned by HubSpot. A deal whose
+stored PROPERTIES_HASH and COMPANY_ID match has its deal row skipped, without the owner and company
+lookups. Its line items are still diffed on every sync, they change (and a failed line item write is
+retried) without the deal's properties changing. ROW_HASH is a hash of the exported row after
+enrichment, the deal MERGEs only update rows whose ROW_HASH or PROPERTIES_HASH changed.
+
+Timestamps written on every sync (DEAL_UPDATED_ON, SPECIAL_FIELDS_UPDATED_ON, LAST_REFRESHED_ON)
+are left out of both hashes, they change on every HubSpot update including unexported properties.
+"""
+import hashlib
+from datetime import datetime, date
+
+from hubspot_snowflake_export.utils.config import SF_DEALS_TABLE
+from hubspot_snowflake_export.utils.concurrency import chunks
+from hubspot_snowflake_export.utils.sql import placeholders
+
+HASH_COLUMNS = ("ROW_HASH", "PROPERTIES_HASH")
+ROW_HASH_EXCLUDED_COLUMNS = ("DEAL_UPDATED_ON", "SPECIAL_FIELDS_UPDATED_ON", "LAST_REFRESHED_ON") + HASH_COLUMNS
+HASHED_DEAL_PROPERTIES = (
+    "dealname", "hubspot_owner_id", "dealstage", "pipeline", "expected_project_start_date", "closedate",
+    "engagement_type__cloned_", "expected_project_duration_in_months", "hs_all_collaborator_owner_ids",
+    "ns_project_id__finance_only_", "amount", "dealtype", "work_ahead", "delivery_lead", "solution_lead",
+    "revenue_type", "deal_currency_code", "n2026_book", "offering", "description", "tech_involved"
+)
+# MERGE condition for the deal statements, new rows are always inserted
+ROW_CHANGED_CONDITION = ("(target.ROW_HASH IS DISTINCT FROM source.ROW_HASH "
+                         "OR target.PROPERTIES_HASH IS DISTINCT FROM source.PROPERTIES_HASH)")
+
+STRING_TYPES = {str, type(None)}
+# content_hash format, stored in every HUBSPOT_DEALS row. Changing either value, normalize, the column
+# order or the JSON column text (jsonlib.dumps_column) rewrites every deal on the next sync.
+HASH_FIELD_SEPARATOR = '\x1f'
+HASH_NULL = '\x00'
+
+_hash_columns_ready = False
+
+
+def normalize(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def normalize_column(values):
+    """normalize over a list of values, with a fast path for columns of strings and None."""
+    if set(map(type, values)) <= STRING_TYPES:
+        return [value or None for value in values]
+    return [normalize(value) for value in values]
+
+
+def content_hash(values):
+    """sha1 of normalized values, None is hashed as HASH_NULL so it differs from every string."""
+    return hashlib.sha1(HASH_FIELD_SEPARATOR.join([HASH_NULL if value is None else str(value) for value in values])
+                        .encode('utf-8')).hexdigest()
+
+
+def row_hash(deal_row):
+    """:param deal_row: HUBSPOT_DEALS column -> value"""
+    return content_hash([normalize(deal_row[column]) for column in sorted(deal_row)
+                         if column not in ROW_HASH_EXCLUDED_COLUMNS])
+
+
+def row_hashes(columns):
+    """row_hash of every row of a column -> list of values dict, normalising one column at a time."""
+    names = sorted(column for column in columns if column not in ROW_HASH_EXCLUDED_COLUMNS)
+    normalized = [normalize_column(columns[name]) for name in names]
+    return [content_hash(row) for row in zip(*normalized)]
+
+
+def properties_hash(deal_properties):
+    return content_hash([normalize(deal_properties.get(name)) for name in HASHED_DEAL_PROPERTIES])
+
+
+def properties_hashes(properties):
+    """properties_hash of every deal_properties dict, normalising one property at a time."""
+    normalized = [normalize_column([deal_properties.get(name) for deal_properties in properties])
+                  for name in HASHED_DEAL_PROPERTIES]
+    return [content_hash(values) for values in zip(*normalized)]
+
+
+def ensure_hash_columns(sf_cursor):
+    """Add the hash columns to HUBSPOT_DEALS, once per container."""
+    global _hash_columns_ready
+    if _hash_columns_ready:
+        return
+    for column in HASH_COLUMNS:
+        sf_cursor.execute(f"ALTER TABLE {SF_DEALS_TABLE} ADD COLUMN IF NOT EXISTS {column} VARCHAR(40)")
+    _hash_columns_ready = True
+
+
+def filter_changed_deals(sf_cursor, deals, force=False, company_ids=None):
+    """
+    Drop the deals whose exported properties match the stored PROPERTIES_HASH, the deals whose row
+    has to be written. Callers still sync the line items of the deals dropped.
+    :param deals: deals as returned by HubSpot, with properties
+    :param force: keep every deal, e.g. to refresh owner or company names after they changed
+    :param company_ids: deal id -> id of its associated company, None when it has none. A deal
+        associated with another company than the stored COMPANY_ID is kept.
+    """
+    ensure_hash_columns(sf_cursor)
+    if force or not deals:
+        return deals
+    stored = {}
+    for deal_ids in chunks([deal['id'] for deal in deals], 1000):
+        sf_cursor.execute(
+            f"SELECT DEAL_ID, PROPERTIES_HASH, COMPANY_ID FROM {SF_DEALS_TABLE} "
+            f"WHERE DEAL_ID IN ({placeholders(len(deal_ids))})", deal_ids)
+        stored.update((str(deal_id), (stored_hash, company_id))
+                      for deal_id, stored_hash, company_id in sf_cursor.fetchall())
+    company_ids = {str(deal_id): company_id for deal_id, company_id in (company_ids or {}).items()}
+
+    def changed(deal):
+        stored_hash, stored_company_id = stored.get(str(deal['id']), (None, None))
+        if stored_hash != properties_hash(deal['properties']):
+            return True
+        return str(deal['id']) in company_ids and \
+            str(company_ids[str(deal['id'])] or '') != str(stored_company_id or '')
+
+    changed_deals = [deal for deal in deals if changed(deal)]
+    if len(changed_deals) < len(deals):
+        print(f"Skipping {len(deals) - len(changed_deals)} of {len(deals)} deal rows, exported properties unchanged")
+    return changed_deals
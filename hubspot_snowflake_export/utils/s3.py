@@ -1,21 +1,29 @@
-import json
+import random
+import time
 from datetime import datetime
 
-import boto3
 import pytz
 
-from hubspot_snowflake_export.utils.config import S3_BUCKET_NAME
+from hubspot_snowflake_export.utils.aws import get_client
+from hubspot_snowflake_export.utils.config import S3_BUCKET_NAME, SYNC_PROCESSING_TIMEOUT_HOURS
+from hubspot_snowflake_export.utils.jsonlib import loads, dumps_bytes
 
 bucket_name = S3_BUCKET_NAME
 file_key = 'deals-sync-info.json'
 
+# S3 error codes of a conditional put that lost to a concurrent write
+CONDITIONAL_WRITE_CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict')
+CONDITIONAL_WRITE_ATTEMPTS = 8
+# events that complete the PROCESSING status set by handle_sync_status
+SYNC_STATUS_EVENTS = ("MANUAL_SYNC", "MANUAL_SYNC_ASYNC", "MANUAL_SYNC_OLD", "FANOUT_SYNC", "SYNC_SHARD")
+
 def get_deals_last_sync_info():
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
 
     try:
         response = s3.get_object(Bucket=bucket_name, Key=file_key)
         file_content = response['Body'].read().decode('utf-8')
-        sync_info = json.loads(file_content)
+        sync_info = loads(file_content)
 
         return sync_info
 
@@ -24,21 +32,22 @@ def get_deals_last_sync_info():
         return None
 
 
-def update_deals_last_sync_time(event_name, status):
-    s3 = boto3.client('s3')
-
-    try:
-        response = s3.get_object(Bucket=bucket_name, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-        sync_info = json.loads(file_content)
+def update_deals_last_sync_time(event_name, status, watermark=None):
+    """
+    :param watermark: UTC time the sync covered deals modified up to, saved as the event's watermark
+    """
+    def update(sync_info):
         sync_info['update_event'] = event_name
         sync_info['last_sync_status'] = status
-        sync_info['sync_status'] = "COMPLETED"
+        # only the sync that set PROCESSING completes it, webhooks and scheduled fetches leave it alone
+        if event_name in SYNC_STATUS_EVENTS:
+            sync_info['sync_status'] = "COMPLETED"
         sync_info['last_updated_on'] = datetime.now(pytz.timezone('America/New_York')).isoformat()
+        if watermark:
+            advance(sync_info, event_name, watermark)
 
-        updated_json_content = json.dumps(sync_info)
-        s3.put_object(Bucket=bucket_name, Key=file_key, Body=updated_json_content.encode('utf-8'))
-
+    try:
+        update_json_object(file_key, update)
         print("Updated Sync Status to S3")
         return "success"
 
@@ -47,22 +56,155 @@ def update_deals_last_sync_time(event_name, status):
         return None
 
 
-def set_deal_sync_status(sync_status, sync_info=None):
-    s3 = boto3.client('s3')
+def set_deal_sync_status(sync_status):
+    def update(sync_info):
+        sync_info['sync_status'] = sync_status
 
     try:
-        if not sync_info:
-            response = s3.get_object(Bucket=bucket_name, Key=file_key)
-            file_content = response['Body'].read().decode('utf-8')
-            sync_info = json.loads(file_content)
-        sync_info['sync_status'] = sync_status
+        update_json_object(file_key, update)
+        print(f"Updated Sync Status - {sync_status} - to S3")
+        return "success"
 
-        updated_json_content = json.dumps(sync_info)
-        s3.put_object(Bucket=bucket_name, Key=file_key, Body=updated_json_content.encode('utf-8'))
+    except Exception as e:
+        print(f"Error updating S3: {e}")
+        return None
 
-        print(f"Updated Sync Status - {sync_status} - to S3")
+
+def is_processing(sync_info):
+    if sync_info.get('sync_status') != 'PROCESSING':
+        return False
+    processing_since = sync_info.get('processing_since')
+    if processing_since and time.time() - processing_since > SYNC_PROCESSING_TIMEOUT_HOURS * 3600:
+        print(f"Sync PROCESSING since {datetime.fromtimestamp(processing_since).isoformat()}, treating it as failed")
+        return False
+    return True
+
+
+def handle_sync_status():
+    """
+    Set the sync status to PROCESSING unless a sync is already running, in one conditional write, so two
+    requests at the same time cannot both start a sync.
+    :return: 'PROCESSING' when a sync is running, otherwise the time of the last sync
+    """
+    def claim(sync_info):
+        # runs again after a conflicting write, only the attempt that was written counts
+        claimed.clear()
+        if is_processing(sync_info):
+            return False
+        sync_info['sync_status'] = "PROCESSING"
+        sync_info['processing_since'] = time.time()
+        claimed.append(sync_info.get('last_updated_on'))
+
+    claimed = []
+    update_json_object(file_key, claim)
+    return claimed[-1] if claimed else 'PROCESSING'
+
+
+def advance(sync_info, event_name, watermark):
+    watermarks = sync_info.setdefault('watermarks', {})
+    if not watermarks.get(event_name) or watermarks[event_name] < watermark:
+        watermarks[event_name] = watermark
+
+
+def get_watermark(event_name):
+    """:return: the event's watermark, a UTC ISO time, None when it has none"""
+    sync_info = get_deals_last_sync_info() or {}
+    return sync_info.get('watermarks', {}).get(event_name)
+
+
+def advance_watermark(event_name, watermark):
+    """Move the event's watermark forward to watermark, never back."""
+    try:
+        update_json_object(file_key, lambda sync_info: advance(sync_info, event_name, watermark))
+        print(f"Advanced {event_name} watermark to {watermark}")
         return "success"
 
     except Exception as e:
         print(f"Error updating S3: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+def read_json_object(key):
+    """:return: content and ETag of key, (None, None) when it does not exist"""
+    s3 = get_client('s3')
+
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+    except Exception as e:
+        if error_code(e) in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    return loads(response['Body'].read()), response['ETag']
+
+
+def update_json_object(key, mutate, max_attempts=CONDITIONAL_WRITE_ATTEMPTS):
+    """
+    Read, change and write a JSON object with a conditional put, If-Match on the ETag read, or
+    If-None-Match when the object did not exist. A write by someone else in between fails the put,
+    and the change is applied again to what they wrote instead of overwriting it.
+    :param mutate: changes the content (a dict, empty when the object does not exist) in place,
+        returns False to leave the object as it is
+    :return: the content written or left as it is
+    """
+    s3 = get_client('s3')
+
+    for attempt in range(max_attempts):
+        content, etag = read_json_object(key)
+        content = content if content is not None else {}
+        if mutate(content) is False:
+            return content
+        conditions = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(Bucket=bucket_name, Key=key, Body=dumps_bytes(content), **conditions)
+            return content
+        except Exception as e:
+            if error_code(e) not in CONDITIONAL_WRITE_CONFLICTS:
+                raise
+            print(f"Concurrent write to {key}, retrying ({attempt + 1}/{max_attempts})")
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    raise RuntimeError(f"Could not update {key} after {max_attempts} concurrent writes")
+
+
+def get_json_object(key):
+    s3 = get_client('s3')
+
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        return loads(response['Body'].read())
+
+    except Exception as e:
+        print(f"Error reading {key} from S3: {e}")
+        return None
+
+
+def put_json_object(key, content):
+    s3 = get_client('s3')
+
+    try:
+        s3.put_object(Bucket=bucket_name, Key=key, Body=dumps_bytes(content))
+        return "success"
+
+    except Exception as e:
+        print(f"Error writing {key} to S3: {e}")
+        return None
+
+
+def create_json_object(key, content):
+    """
+    Write key only when it does not exist yet (S3 conditional write with If-None-Match).
+    :return: True when this call created the object, False when it already existed
+    """
+    s3 = get_client('s3')
+
+    try:
+        s3.put_object(Bucket=bucket_name, Key=key, Body=dumps_bytes(content), IfNoneMatch='*')
+        return True
+
+    except Exception as e:
+        if error_code(e) in CONDITIONAL_WRITE_CONFLICTS:
+            return False
+        raise
@@ -1,11 +1,10 @@
 import json
 
-import requests
-
 from .config import RRT_TENANT_ID, RRT_CLIENT_ID, RRT_CLIENT_SECRET
 
 
 def send_email(mail_to, subject, content, content_type="Text", email_cc_list=None, importance=None):
+    import requests
 
     if email_cc_list is None:
         email_cc_list = []
@@ -1,11 +1,26 @@
 import os
+import threading
+import time
+
 import snowflake.connector
 from snowflake.connector import ProgrammingError
 
+from hubspot_snowflake_export.utils.config import SF_CONNECTION_REUSE, SF_CONNECTION_VALIDATE_AFTER, \
+    SF_CONNECTION_MAX_AGE
+from hubspot_snowflake_export.utils.metrics import put_metric
+
 SF_ACCOUNT = os.getenv("SF_ACCOUNT")
 SF_USER = os.getenv("SF_USER")
 SF_PASSWORD = os.getenv("SF_PASSWORD")
 
+# Connection kept at module scope, so warm invocations of the same container skip the login.
+_shared_connection = None
+_shared_connection_key = None
+_shared_connection_created_at = 0.0
+_shared_connection_used_at = 0.0
+_shared_connection_lock = threading.Lock()
+connection_stats = {"reused": 0, "created": 0, "revalidated": 0, "expired": 0}
+
 def create_sf_connection(warehouse, database, schema, role):
     try:
         # Establish the connection
@@ -16,7 +31,11 @@ def create_sf_connection(warehouse, database, schema, role):
             warehouse=warehouse,
             database=database,
             schema=schema,
-            role=role
+            role=role,
+            # server-side binding with ?, so statements keep the same text across executions
+            paramstyle="qmark",
+            # heartbeat while the container is running, the idle check below covers frozen containers
+            client_session_keep_alive=True
         )
         print("Connection to Snowflake established successfully!")
         return connection
@@ -33,4 +52,85 @@ def close_sf_connection(connection):
         except Exception as e:
             print(f"Error closing connection: {e}")
     else:
-        print("No active connection to close.")
\ No newline at end of file
+        print("No active connection to close.")
+
+
+def is_connection_alive(connection):
+    if connection is None or connection.is_closed():
+        return False
+    try:
+        connection.cursor().execute("SELECT 1").fetchone()
+        return True
+    except Exception as e:
+        print(f"Snowflake connection failed the health check: {e}")
+        return False
+
+
+def get_sf_connection(warehouse, database, schema, role):
+    """
+    Snowflake connection shared across warm invocations of the Lambda container. A connection idle
+    for longer than SF_CONNECTION_VALIDATE_AFTER is checked with SELECT 1 and replaced with a new
+    login when the session has expired; one older than SF_CONNECTION_MAX_AGE is always replaced.
+    Return it with release_sf_connection instead of close_sf_connection.
+    """
+    global _shared_connection, _shared_connection_key, _shared_connection_created_at, _shared_connection_used_at
+    if SF_CONNECTION_REUSE != "True":
+        return create_sf_connection(warehouse, database, schema, role)
+
+    key = (warehouse, database, schema, role)
+    with _shared_connection_lock:
+        now = time.monotonic()
+        connection = _shared_connection if _shared_connection_key == key else None
+        if connection is not None and now - _shared_connection_created_at > SF_CONNECTION_MAX_AGE:
+            print("Snowflake connection reached its max age, reconnecting")
+            connection_stats["expired"] += 1
+            connection = None
+        elif connection is not None and now - _shared_connection_used_at > SF_CONNECTION_VALIDATE_AFTER:
+            connection_stats["revalidated"] += 1
+            if not is_connection_alive(connection):
+                connection_stats["expired"] += 1
+                connection = None
+        elif connection is not None and connection.is_closed():
+            connection = None
+
+        reused = connection is not None
+        if reused:
+            connection_stats["reused"] += 1
+        else:
+            if _shared_connection is not None:
+                close_sf_connection(_shared_connection)
+                _shared_connection = None
+            connection = create_sf_connection(warehouse, database, schema, role)
+            if connection is None:
+                return None
+            connection_stats["created"] += 1
+            _shared_connection, _shared_connection_key, _shared_connection_created_at = connection, key, now
+        _shared_connection_used_at = now
+
+    total = connection_stats["reused"] + connection_stats["created"]
+    print(f"Snowflake connection {'reused' if reused else 'created'} "
+          f"(reuse rate {connection_stats['reused'] / total:.0%} over {total} requests in this container)")
+    put_metric("SnowflakeConnectionReused", 1 if reused else 0)
+    return connection
+
+
+def release_sf_connection(connection):
+    """
+    Hand a connection from get_sf_connection back. The shared connection stays open for the next
+    invocation, any transaction left open by the caller is rolled back.
+    """
+    global _shared_connection_used_at
+    if connection is None:
+        return
+    if SF_CONNECTION_REUSE != "True" or connection is not _shared_connection:
+        close_sf_connection(connection)
+        return
+    try:
+        connection.rollback()
+    except Exception as e:
+        print(f"Error releasing connection, it will be revalidated on next use: {e}")
+        with _shared_connection_lock:
+            _shared_connection_used_at = float("-inf")
+        return
+    with _shared_connection_lock:
+        _shared_connection_used_at = time.monotonic()
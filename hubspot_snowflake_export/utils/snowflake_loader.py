@@ -0,0 +1,122 @@
+import gzip
+import os
+import tempfile
+import uuid
+from datetime import datetime, date
+
+from hubspot_snowflake_export.utils.config import SF_LOAD_METHOD, SF_COPY_MIN_ROWS, SF_COPY_FORMAT
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional, columnar loads fall back to gzip CSV without it
+    pyarrow = None
+
+SYNC_STAGE = "HUBSPOT_SYNC_STAGE"
+
+# Every non-null value is quoted, so an empty string stays '' and only unquoted empty fields load as NULL.
+# Backslashes are not escapes in unquoted fields, descriptions with Windows paths load as-is.
+CSV_FILE_FORMAT = ("TYPE = CSV COMPRESSION = GZIP FIELD_DELIMITER = ',' FIELD_OPTIONALLY_ENCLOSED_BY = '\"' "
+                   "EMPTY_FIELD_AS_NULL = TRUE ESCAPE_UNENCLOSED_FIELD = NONE")
+PARQUET_FILE_FORMAT = "TYPE = PARQUET"
+
+
+def use_copy(rows):
+    return SF_LOAD_METHOD == "COPY" and len(rows) >= SF_COPY_MIN_ROWS
+
+
+def to_csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'TRUE' if value else 'FALSE'
+    elif isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return '"' + value.replace('"', '""') + '"'
+
+
+def write_csv_gz(path, columns, rows):
+    keys = [key for _, key in columns]
+    write_csv_rows(path, ([row.get(key) for key in keys] for row in rows))
+
+
+def write_csv_rows(path, rows):
+    """:param rows: sequences of values, in the order of the file columns"""
+    with gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=1) as f:
+        for row in rows:
+            f.write(','.join(to_csv_field(value) for value in row))
+            f.write('\n')
+
+
+def to_arrow_array(values):
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        # mixed types, e.g. ids that are ints for some deals and strings for others
+        return pyarrow.array([None if value is None else str(value) for value in values], pyarrow.string())
+
+
+def write_parquet(path, columns, column_values):
+    table = pyarrow.table({key: to_arrow_array(column_values[key]) for _, key in columns})
+    pyarrow.parquet.write_table(table, path, compression="snappy")
+
+
+def use_parquet():
+    return pyarrow is not None and SF_COPY_FORMAT == "PARQUET"
+
+
+def copy_file_into(sf_cursor, table, columns, write_file, file_name, file_format, select_list, expressions):
+    """PUT the file write_file(path) creates to a temporary stage and COPY it into table."""
+    expressions = expressions or ()
+    sf_cursor.execute(f"CREATE TEMPORARY STAGE IF NOT EXISTS {SYNC_STAGE}")
+    prefix = f"{table.lower()}/{uuid.uuid4().hex}"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, file_name)
+        write_file(path)
+        compression = "SOURCE_COMPRESSION = GZIP " if file_name.endswith(".gz") else ""
+        sf_cursor.execute(f"PUT 'file://{path}' @{SYNC_STAGE}/{prefix}/ AUTO_COMPRESS = FALSE "
+                          f"{compression}OVERWRITE = TRUE")
+
+    target_columns = [column for column, _ in columns] + [column for column, _ in expressions]
+    select_list = list(select_list) + [expression for _, expression in expressions]
+    sf_cursor.execute(f"""
+        COPY INTO {table} ({', '.join(target_columns)})
+        FROM (SELECT {', '.join(select_list)} FROM @{SYNC_STAGE}/{prefix}/)
+        FILE_FORMAT = ({file_format})
+        ON_ERROR = ABORT_STATEMENT
+        PURGE = TRUE
+    """)
+    loaded = sum(row[3] for row in sf_cursor.fetchall() if len(row) > 3 and isinstance(row[3], int))
+    print(f"Copied {loaded} rows into {table}")
+    return loaded
+
+
+def copy_rows_into(sf_cursor, table, columns, rows, expressions=None):
+    """
+    Load rows into a table through a gzip CSV file PUT to a temporary stage and one COPY INTO,
+    which is much faster than executemany's batched INSERTs for large loads.
+    :param columns: (column, row key) pairs, written to the file in this order
+    :param expressions: (column, SQL expression) pairs COPY evaluates instead of a file value, e.g. CURRENT_TIMESTAMP()
+    :return: number of rows loaded
+    """
+    return copy_file_into(sf_cursor, table, columns, lambda path: write_csv_gz(path, columns, rows),
+                          f"{table.lower()}.csv.gz", CSV_FILE_FORMAT,
+                          [f"${position}" for position in range(1, len(columns) + 1)], expressions)
+
+
+def copy_columns_into(sf_cursor, table, columns, column_values, expressions=None):
+    """
+    copy_rows_into for data held as columns. Written as one Parquet file when SF_COPY_FORMAT is PARQUET
+    and pyarrow is installed, which skips formatting every value as CSV text, otherwise as gzip CSV.
+    :param column_values: row key -> list of values, all of the same length
+    """
+    if use_parquet():
+        return copy_file_into(sf_cursor, table, columns, lambda path: write_parquet(path, columns, column_values),
+                              f"{table.lower()}.parquet", PARQUET_FILE_FORMAT,
+                              [f'$1:"{key}"' for _, key in columns], expressions)
+    return copy_file_into(sf_cursor, table, columns,
+                          lambda path: write_csv_rows(path, zip(*(column_values[key] for _, key in columns))),
+                          f"{table.lower()}.csv.gz", CSV_FILE_FORMAT,
+                          [f"${position}" for position in range(1, len(columns) + 1)], expressions)
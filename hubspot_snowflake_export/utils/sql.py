@@ -0,0 +1,60 @@
+"""
+SQL text for bind-parameter statements (qmark paramstyle, see create_sf_connection).
+Each statement is built once per shape and cached, so every execution of the same upsert sends
+byte-identical SQL and the values travel as bindings. Snowflake can then reuse the compiled
+statement instead of compiling a new text with the values inlined for every deal.
+"""
+from functools import lru_cache
+
+
+def placeholders(count):
+    return ", ".join(["?"] * count)
+
+
+@lru_cache(maxsize=256)
+def merge_statement(table, columns, key_columns, row_count=1, update_columns=None, update_when=None):
+    """
+    MERGE whose source is a VALUES list of row_count rows of bind parameters.
+    :param columns: tuple of columns, in the order the parameters are bound
+    :param key_columns: tuple of columns matched between source and target
+    :param update_columns: tuple of columns updated on a match, every non-key column by default
+    :param update_when: extra condition for updating a matched row, matched rows failing it are left untouched
+    """
+    if update_columns is None:
+        update_columns = tuple(column for column in columns if column not in key_columns)
+    row_placeholder = f"({placeholders(len(columns))})"
+    return f"""
+        MERGE INTO {table} AS target
+        USING (SELECT * FROM VALUES {", ".join([row_placeholder] * row_count)}) AS source ({", ".join(columns)})
+        ON {" AND ".join(f"target.{column} = source.{column}" for column in key_columns)}
+        WHEN MATCHED{f" AND {update_when}" if update_when else ""} THEN
+            UPDATE SET {", ".join(f"target.{column} = source.{column}" for column in update_columns)}
+        WHEN NOT MATCHED THEN
+            INSERT ({", ".join(columns)})
+            VALUES ({", ".join(f"source.{column}" for column in columns)})
+    """
+
+
+@lru_cache(maxsize=64)
+def insert_statement(table, columns, expressions=()):
+    """
+    INSERT of one row of bind parameters, for executemany.
+    :param expressions: tuple of (column, SQL expression) pairs evaluated by Snowflake, e.g. CURRENT_TIMESTAMP()
+    """
+    all_columns = list(columns) + [column for column, _ in expressions]
+    values = [placeholders(len(columns))] + [expression for _, expression in expressions]
+    return f"INSERT INTO {table} ({', '.join(all_columns)}) VALUES ({', '.join(values)})"
+
+
+def row_values(rows, keys):
+    """Dict rows as tuples in the order of keys, for qmark executemany."""
+    return [tuple(row.get(key) for key in keys) for row in rows]
+
+
+def column_rows(column_values, keys):
+    """Rows of a key -> list of values dict as tuples in the order of keys, for qmark executemany."""
+    return list(zip(*(column_values[key] for key in keys)))
+
+
+def statement_cache_info():
+    return {"merge": merge_statement.cache_info(), "insert": insert_statement.cache_info()}
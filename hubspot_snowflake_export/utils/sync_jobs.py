@@ -0,0 +1,111 @@
+"""
+Checkpoints of MANUAL_SYNC jobs, kept in S3 next to deals-sync-info.json.
+
+A job syncs deals modified from sync_from to until in hs_lastmodifieddate windows, oldest first. Every
+window is committed chunk by chunk, and the job's checkpoint (the first millisecond not yet synced)
+moves past a window once all of it is loaded. An invocation running out of time saves the job and
+invokes the function again with its id, a failed job is resumed from its last finished window by
+sending MANUAL_SYNC with the job_id again.
+"""
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+
+from hubspot_snowflake_export.utils.aws import get_client
+from hubspot_snowflake_export.utils.config import SYNC_JOB_WINDOW_HOURS, SYNC_JOB_MAX_INVOCATIONS
+from hubspot_snowflake_export.utils.s3 import get_json_object, put_json_object
+
+JOB_KEY_PREFIX = 'sync-jobs/'
+# shortest window a job splits down to after windows that did not fit in one invocation
+MIN_WINDOW_MS = 60 * 1000
+# a finished job catches up again when its end is older than this, deals modified while it ran
+CATCH_UP_MS = 60 * 1000
+# options of the MANUAL_SYNC event kept with the job, later invocations only get the job_id
+JOB_EVENT_OPTIONS = ('force', 'chunk_size', 'shards')
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def to_iso_ms(epoch_ms):
+    return datetime.fromtimestamp(epoch_ms / 1000, tz=timezone.utc).isoformat(timespec='milliseconds') \
+        .replace('+00:00', 'Z')
+
+
+def job_key(job_id):
+    return f"{JOB_KEY_PREFIX}{job_id}.json"
+
+
+def new_job(sync_from_ms, event=None):
+    """:param event: the MANUAL_SYNC event, its JOB_EVENT_OPTIONS are saved with the job"""
+    return {
+        "job_id": uuid.uuid4().hex,
+        "options": {key: event[key] for key in JOB_EVENT_OPTIONS if key in (event or {})},
+        "checkpoint_ms": sync_from_ms,
+        "until_ms": now_ms(),
+        "window_ms": int(SYNC_JOB_WINDOW_HOURS * 3600 * 1000),
+        "status": "PROCESSING",
+        "synced": 0,
+        "windows": 0,
+        "invocations": 0,
+    }
+
+
+def load_job(job_id, event=None):
+    """:param event: the resuming event, gets the options the job was started with unless it sets them"""
+    job = get_json_object(job_key(job_id))
+    if job is None:
+        raise ValueError(f"Sync job {job_id} not found")
+    if event is not None:
+        for key, value in job.get("options", {}).items():
+            event.setdefault(key, value)
+    return job
+
+
+def save_job(job):
+    job["saved_at"] = to_iso_ms(now_ms())
+    if put_json_object(job_key(job["job_id"]), job) is None:
+        raise RuntimeError(f"Could not save sync job {job['job_id']}")
+
+
+def next_window(job):
+    """:return: (start, end) in ms of the job's next window, None when the job has nothing left"""
+    if job["checkpoint_ms"] >= job["until_ms"]:
+        if now_ms() - job["until_ms"] <= CATCH_UP_MS:
+            return None
+        job["until_ms"] = now_ms()
+    return job["checkpoint_ms"], min(job["checkpoint_ms"] + job["window_ms"], job["until_ms"])
+
+
+def finish_window(job, window_end_ms, synced, grow=False):
+    """:param grow: the window was small, double the next one up to SYNC_JOB_WINDOW_HOURS"""
+    job["checkpoint_ms"] = window_end_ms
+    job["synced"] += synced
+    job["windows"] += 1
+    if grow:
+        job["window_ms"] = min(job["window_ms"] * 2, max(int(SYNC_JOB_WINDOW_HOURS * 3600 * 1000), MIN_WINDOW_MS))
+
+
+def shrink_window(job):
+    """The current window did not fit in one invocation, resume with windows half as long."""
+    job["window_ms"] = max(job["window_ms"] // 2, MIN_WINDOW_MS)
+
+
+def continue_job(job, context):
+    """Save the job and invoke the function again to resume it."""
+    job["invocations"] += 1
+    if job["invocations"] >= SYNC_JOB_MAX_INVOCATIONS:
+        job["status"] = "FAILED"
+        save_job(job)
+        raise RuntimeError(f"Sync job {job['job_id']} stopped after {job['invocations']} invocations, "
+                           f"resume it with its job_id")
+    save_job(job)
+    get_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps({'event': 'MANUAL_SYNC', 'job_id': job["job_id"]})
+    )
+    print(f"Sync job {job['job_id']} continues in a new invocation from {to_iso_ms(job['checkpoint_ms'])}, "
+          f"{job['synced']} deals synced so far")
@@ -0,0 +1,12 @@
+"""
+Entry point of the webhook ingress Lambda behind /hubspot/deals/sync.
+
+It only validates the HubSpot webhook body and enqueues one message per deal for sqs_handler, so it
+imports nothing but the SQS client: no Snowflake connector, HubSpot client or sync modules.
+"""
+from .hubspot_events import handle_webhook_from_hubspot
+from .utils.aws import get_client
+
+
+def lambda_handler(event, context):
+    return handle_webhook_from_hubspot(event, get_client('sqs'))